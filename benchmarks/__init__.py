@@ -0,0 +1,5 @@
+'''Benchmarks of the views, ranking helpers and template tags
+
+The benchmark command generates synthetic catalogs in a test database and
+times the benchmarks of suite.py on them, see its help.
+'''
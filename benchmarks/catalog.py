@@ -0,0 +1,98 @@
+'''Synthetic catalogs of authors, books, users and their lists
+
+The rows are inserted with bulk_create, which doesn't send the signals, so
+the stats, daily counts and similarities are built afterwards the way the
+management commands would.
+'''
+
+from collections import Counter
+from datetime import timedelta
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from books import search, typeahead
+from books.cache import bump_generation
+from books.models import (
+    Author, Book, BookList, BookStats, DailyListingCount
+)
+from books.recommendations import build_similarities
+
+BATCH_SIZE = 1000
+# a few books are on many lists, most of them on a few
+POPULARITY_EXPONENT = 1.2
+RATED_SHARE = 0.7
+# the listings are spread over the last year
+HISTORY_DAYS = 365
+
+SCALES = {
+    'small': {'authors': 100, 'books': 1000, 'users': 100,
+              'listings': 5000},
+    'medium': {'authors': 1000, 'books': 10000, 'users': 1000,
+               'listings': 50000},
+    'large': {'authors': 10000, 'books': 100000, 'users': 10000,
+              'listings': 500000},
+}
+
+
+def generate_catalog(authors, books, users, listings, seed=0):
+    '''Fill the database with a random catalog
+
+    Params:
+        authors, books, users(int): number of each of them
+        listings(int): number of books on the lists of the users, at most
+            users * books
+        seed: of the random numbers, the same seed gives the same catalog
+    '''
+    rng = random.Random(seed)
+    Author.objects.bulk_create(
+        [Author(first_name=f'Firstname{i}', last_name=f'Lastname{i}')
+         for i in range(authors)],
+        batch_size=BATCH_SIZE)
+    author_ids = list(Author.objects.values_list('pk', flat=True))
+    Book.objects.bulk_create(
+        [Book(author_id=rng.choice(author_ids), title=f'Book title {i}',
+              first_published=rng.randint(1800, 2020))
+         for i in range(books)],
+        batch_size=BATCH_SIZE)
+    book_ids = list(Book.objects.values_list('pk', flat=True))
+    password = make_password(None)
+    User.objects.bulk_create(
+        [User(username=f'reader{i}', password=password,
+              last_login=timezone.now())
+         for i in range(users)],
+        batch_size=BATCH_SIZE)
+    user_ids = list(User.objects.values_list('pk', flat=True))
+
+    weights = [1 / (rank + 1) ** POPULARITY_EXPONENT
+               for rank in range(len(book_ids))]
+    pairs = set()
+    listings = min(listings, len(user_ids) * len(book_ids))
+    while len(pairs) < listings:
+        missing = listings - len(pairs)
+        pairs.update(zip(
+            rng.choices(user_ids, k=missing),
+            rng.choices(book_ids, weights=weights, k=missing)))
+    BookList.objects.bulk_create(
+        [BookList(user_id=user_id, book_id=book_id,
+                  rating=rng.randint(1, 5)
+                  if rng.random() < RATED_SHARE else None)
+         for user_id, book_id in sorted(pairs)],
+        batch_size=BATCH_SIZE)
+
+    today = timezone.localdate()
+    days = Counter(
+        (book_id, today - timedelta(days=rng.randrange(HISTORY_DAYS)))
+        for user_id, book_id in pairs)
+    DailyListingCount.objects.bulk_create(
+        [DailyListingCount(book_id=book_id, day=day, count=count)
+         for (book_id, day), count in days.items()],
+        batch_size=BATCH_SIZE)
+
+    BookStats.objects.rebuild(batch_size=BATCH_SIZE)
+    build_similarities(full=True)
+    search.reset_index()
+    typeahead.reset_index()
+    bump_generation()
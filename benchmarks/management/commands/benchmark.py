@@ -0,0 +1,113 @@
+'''Time the views, ranking helpers and template tags on synthetic catalogs
+
+    manage.py benchmark --scale small --scale medium --output results.json
+    manage.py benchmark --baseline results.json --threshold 0.2
+
+The catalogs are generated in a test database, like the one of the tests,
+which is destroyed afterwards. With a baseline, the command fails if any
+benchmark regressed (see benchmarks.suite.compare()).
+'''
+
+from datetime import datetime
+import json
+import platform
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases,
+    teardown_test_environment
+)
+
+from benchmarks.catalog import SCALES, generate_catalog
+from benchmarks.suite import compare, run_benchmarks
+from books import search, typeahead
+from books.cache import get_cache
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the views, ranking helpers and template tags on synthetic '
+        'catalogs in a test database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale', action='append', choices=SCALES,
+            help='Size of the catalog, can be repeated (default: small)')
+        parser.add_argument(
+            '--iterations', type=int, default=50,
+            help='Number of timed runs of each benchmark')
+        parser.add_argument(
+            '--benchmark', action='append', dest='benchmarks',
+            help='Only run this benchmark, can be repeated')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results to this file')
+        parser.add_argument(
+            '--baseline', help='Compare the results with this earlier output')
+        parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Slowdown of the median time considered a regression')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = {}
+            for scale in options['scale'] or ['small']:
+                results[scale] = self.run_scale(scale, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'seed': options['seed'],
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError(
+                    'Regressions from the baseline:\n'
+                    + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS(
+                'No regressions from the baseline.'))
+
+    def run_scale(self, scale, options):
+        call_command('flush', interactive=False, verbosity=0)
+        get_cache().clear()
+        search.reset_index()
+        typeahead.reset_index()
+        generate_catalog(seed=options['seed'], **SCALES[scale])
+        results = run_benchmarks(
+            options['iterations'], options['benchmarks'])
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{scale}: ' + ', '.join(
+                f'{count} {name}' for name, count in SCALES[scale].items())))
+        self.stdout.write(
+            f'{"benchmark":<26} {"ops/s":>9} {"p50 ms":>9} {"p99 ms":>9} '
+            f'{"queries":>7}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<26} {result["ops_per_sec"]:>9.1f} '
+                f'{result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+                f'{result["queries"]:>7}')
+        return results
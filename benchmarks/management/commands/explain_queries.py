@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.plans import check_plans, get_reader
+
+
+class Command(BaseCommand):
+    help = (
+        'Show the EXPLAIN plans of the hot querysets on the current database '
+        'and the indexes they fail to use'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Explain the queries of this user (default: the user with '
+                 'the longest list)')
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Fail if a plan has any problem')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'No user {options["user"]}.')
+        else:
+            user = get_reader()
+            if user is None:
+                raise CommandError('No books on any list to explain.')
+
+        failed = False
+        for hot_query, plan, problems in check_plans(user):
+            self.stdout.write(self.style.MIGRATE_HEADING(hot_query.name))
+            self.stdout.write(plan.text)
+            for problem in problems:
+                failed = True
+                self.stdout.write(self.style.WARNING(problem))
+            self.stdout.write('')
+        if failed and options['check']:
+            raise CommandError('Some plans have problems.')
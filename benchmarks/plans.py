@@ -0,0 +1,196 @@
+'''EXPLAIN plans of the hot querysets
+
+The querysets of the dashboard rankings, of the user's list and of the
+books which can still be added to it are the ones run the most. Each one is
+listed in HOT_QUERIES with the indexes its plan is expected to use, given by
+their table and leading columns so the check doesn't depend on the names
+the database gave them.
+
+On PostgreSQL the estimated rows of the sequential scans are checked too:
+a plan scanning more rows than the hot query allows is reported even if it
+uses the expected indexes. SQLite's plans have no estimates.
+
+check_plans() returns the problems found, the tests (see tests.py) run it on
+a generated catalog and the explain_queries command shows the plans on the
+real data. Run analyze() after generating a catalog, so the planner knows
+its size.
+'''
+
+import json
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+
+from books.forms import get_unlisted_books
+from books.models import Book, BookList, BookStats, DailyListingCount
+from books.views import (
+    get_most_read_books, get_recent_books, get_top_rated_books,
+    get_trending_books
+)
+
+SQLITE_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+SQLITE_SCAN = re.compile(r'\bSCAN (\S+)$')
+
+
+class HotQuery:
+    '''A queryset whose plan is checked
+
+    Params:
+        name(str): shown in the reports
+        get_queryset(callable): returns the queryset, called with a user
+        indexes(list): (model, leading columns) of the indexes the plan has
+            to use, any index of the model starting with these columns will
+            do
+        max_scanned_rows(int): maximum estimated rows of a sequential scan,
+            None if the query has to scan a table anyway
+    '''
+
+    def __init__(self, name, get_queryset, indexes=(), max_scanned_rows=1000):
+        self.name = name
+        self.get_queryset = get_queryset
+        self.indexes = indexes
+        self.max_scanned_rows = max_scanned_rows
+
+
+HOT_QUERIES = [
+    HotQuery('get_most_read_books', lambda user: get_most_read_books(),
+             indexes=[(BookStats, ['listing_count', 'book_id'])]),
+    HotQuery('get_recent_books', lambda user: get_recent_books(),
+             indexes=[(Book, ['added'])]),
+    HotQuery('get_top_rated_books', lambda user: get_top_rated_books(),
+             indexes=[(BookStats, ['score'])]),
+    HotQuery('get_trending_books', lambda user: get_trending_books(),
+             indexes=[(DailyListingCount, ['day'])]),
+    # the first pages, as KeysetPaginator reads them
+    HotQuery(
+        'book_list',
+        lambda user: BookList.objects.filter(
+            user=user).select_related('book__author').order_by(
+                'book__author__last_name', 'book__title', 'pk',
+        )[:settings.BOOKS_BOOKLIST_PAGE_SIZE + 1],
+        indexes=[(BookList, ['user_id'])]),
+    # the exclude of BookListAddForm, the books are scanned in their order
+    HotQuery(
+        'BookListAddForm books',
+        lambda user: get_unlisted_books(user).select_related(
+            'author').order_by(
+                'author__last_name', 'title', 'pk',
+        )[:settings.BOOKS_PICKER_PAGE_SIZE + 1],
+        indexes=[(BookList, ['user_id', 'book_id'])],
+        max_scanned_rows=None),
+]
+
+
+def get_indexes(model):
+    '''Columns of the indexes of the model's table by their name'''
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # introspection names the unique constraints, not their indexes
+            cursor.execute(f'PRAGMA index_list("{table}")')
+            names = [row[1] for row in cursor.fetchall()]
+            indexes = {}
+            for name in names:
+                cursor.execute(f'PRAGMA index_info("{name}")')
+                indexes[name] = [row[2] for row in cursor.fetchall()]
+            return indexes
+        return {
+            name: constraint['columns']
+            for name, constraint in connection.introspection.get_constraints(
+                cursor, table).items()
+            if constraint['index'] or constraint['unique']
+        }
+
+
+class Plan:
+    '''The plan of a queryset and what it reads
+
+    Attributes:
+        text(str): the plan as the database shows it
+        indexes(set): names of the indexes used
+        scans(list): (table, estimated rows or None) of the sequential scans
+    '''
+
+    def __init__(self, queryset):
+        self.text = queryset.explain()
+        self.indexes = set()
+        self.scans = []
+        if connection.vendor == 'postgresql':
+            self._read_postgresql(self._explain_json(queryset)[0]['Plan'])
+        elif connection.vendor == 'sqlite':
+            for line in self.text.splitlines():
+                self.indexes.update(SQLITE_INDEX.findall(line))
+                scan = SQLITE_SCAN.search(line)
+                if scan:
+                    self.scans.append((scan.group(1), None))
+
+    @staticmethod
+    def _explain_json(queryset):
+        '''The plan in the JSON format of PostgreSQL
+
+        Not with queryset.explain(): psycopg2 decodes the JSON, and Django
+        turns it into the repr of the decoded objects.
+        '''
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    def _read_postgresql(self, node):
+        if 'Index Name' in node:
+            self.indexes.add(node['Index Name'])
+        if node['Node Type'] == 'Seq Scan':
+            self.scans.append((node['Relation Name'], node['Plan Rows']))
+        for child in node.get('Plans', []):
+            self._read_postgresql(child)
+
+
+def check_plan(hot_query, plan):
+    '''Problems of the plan of a hot query, an empty list if it's fine'''
+    problems = []
+    for model, columns in hot_query.indexes:
+        names = {
+            name for name, index_columns in get_indexes(model).items()
+            if index_columns[:len(columns)] == columns
+        }
+        if not names & plan.indexes:
+            problems.append(
+                f'{hot_query.name}: no index of {model._meta.db_table} on '
+                f'({", ".join(columns)}) is used')
+    if hot_query.max_scanned_rows is not None:
+        for table, rows in plan.scans:
+            if rows is not None and rows > hot_query.max_scanned_rows:
+                problems.append(
+                    f'{hot_query.name}: {table} is scanned, about {rows} '
+                    f'rows, more than {hot_query.max_scanned_rows}')
+    return problems
+
+
+def analyze():
+    '''Update the statistics of the planner, e.g. after a bulk insert'''
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def get_reader():
+    '''The user with the longest list, whose queries are explained'''
+    reader = BookList.objects.values('user').annotate(
+        books=Count('pk')).order_by('-books', 'user').first()
+    return User.objects.get(pk=reader['user']) if reader else None
+
+
+def check_plans(user, hot_queries=HOT_QUERIES):
+    '''Explain the hot queries
+
+    Returns:
+        plans(list): (hot query, plan, problems) of each of them
+    '''
+    results = []
+    for hot_query in hot_queries:
+        plan = Plan(hot_query.get_queryset(user))
+        results.append((hot_query, plan, check_plan(hot_query, plan)))
+    return results
@@ -0,0 +1,148 @@
+'''The benchmarks and their measures
+
+Each benchmark is a function called repeatedly: once to warm up, once to
+count its queries and then the given number of times to time it. The
+results are plain dicts, so they can be saved as JSON and compared with a
+baseline later (see compare()).
+'''
+
+from itertools import cycle
+import math
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.template import Context, Template
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from books.cache import get_cache
+from books.forms import BookListAddForm
+from books.models import Book, BookList
+from books.views import (
+    annotate_book_cards, get_most_read_books, get_recent_books,
+    get_top_rated_books, get_trending_books
+)
+
+BOOK_CARDS = Template(
+    '{% load book_tags %}'
+    '{% for book in books %}{% book_card book %}{% endfor %}')
+# number of cards of the book_card benchmark, a page of the user's list
+CARDS = 24
+
+
+def percentile(durations, p):
+    '''The p-th percentile of sorted durations, by the nearest rank'''
+    rank = math.ceil(p / 100 * len(durations))
+    return durations[max(rank, 1) - 1]
+
+
+def measure(func, iterations):
+    '''Time a benchmark and count its queries
+
+    Returns:
+        result(dict): ops_per_sec, p50_ms, p99_ms and queries
+    '''
+    func()
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    # the captured queries are read from the log, which the next request resets
+    query_count = len(queries)
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / sum(durations),
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'queries': query_count,
+    }
+
+
+def get_benchmarks():
+    '''The benchmarks by name, for the catalog in the database
+
+    The user's benchmarks are run as the reader with the longest list.
+    '''
+    reader = User.objects.get(pk=BookList.objects.values('user').annotate(
+        books=Count('pk')).order_by('-books', 'user')[0]['user'])
+    client = Client()
+    client.force_login(reader)
+    booklist_ids = cycle(BookList.objects.filter(
+        user=reader).values_list('pk', flat=True))
+    ratings = cycle(range(1, 6))
+    books = list(annotate_book_cards(Book.objects).order_by('pk')[:CARDS])
+    dashboard = reverse('books:dashboard')
+
+    def dashboard_cold():
+        get_cache().clear()
+        client.get(dashboard)
+
+    def book_rate():
+        client.post(reverse('books:book_rate'), {
+            'booklist_id': next(booklist_ids), 'rating': next(ratings)})
+
+    return {
+        'dashboard (cold cache)': dashboard_cold,
+        'dashboard (warm cache)': lambda: client.get(dashboard),
+        'book_list': lambda: client.get(reverse('books:book_list')),
+        'book_list_add form': lambda: str(BookListAddForm(user=reader)),
+        'book_rate': book_rate,
+        'get_most_read_books': lambda: list(get_most_read_books()),
+        'get_recent_books': lambda: list(get_recent_books()),
+        'get_top_rated_books': lambda: list(get_top_rated_books()),
+        'get_trending_books': lambda: list(get_trending_books()),
+        'book_card tag': lambda: BOOK_CARDS.render(Context({'books': books})),
+    }
+
+
+def run_benchmarks(iterations, names=None):
+    '''Run the benchmarks on the catalog in the database
+
+    Params:
+        iterations(int): number of timed calls of each benchmark
+        names(iterable): only run these benchmarks, all of them if None
+    Returns:
+        results(dict): the result of each benchmark by its name
+    '''
+    benchmarks = get_benchmarks()
+    if names is not None:
+        benchmarks = {name: benchmarks[name] for name in names}
+    return {name: measure(func, iterations)
+            for name, func in benchmarks.items()}
+
+
+def compare(results, baseline, threshold):
+    '''Find the regressions of the results from a baseline
+
+    A benchmark regresses if its median time grew by more than the threshold
+    (a fraction of the baseline's) or if it makes more queries. Benchmarks
+    missing from either side are skipped.
+
+    Params:
+        results, baseline(dict): results of the benchmarks by scale
+        threshold(float): e.g. 0.2 for 20% slower
+    Returns:
+        regressions(list): a message for each of them
+    '''
+    regressions = []
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            if result['p50_ms'] > base['p50_ms'] * (1 + threshold):
+                regressions.append(
+                    f'{scale} {name}: median {base["p50_ms"]:.2f} ms -> '
+                    f'{result["p50_ms"]:.2f} ms')
+            if result['queries'] > base['queries']:
+                regressions.append(
+                    f'{scale} {name}: {base["queries"]} queries -> '
+                    f'{result["queries"]} queries')
+    return regressions
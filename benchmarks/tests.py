@@ -0,0 +1,136 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+
+from books.models import Author, Book, BookList, BookSimilarity, BookStats
+
+from . import plans
+from .catalog import generate_catalog
+from .suite import compare, percentile, run_benchmarks
+
+
+class CatalogTests(TestCase):
+
+    def test_generate_catalog(self):
+        generate_catalog(authors=5, books=20, users=4, listings=30)
+        self.assertEqual(Author.objects.count(), 5)
+        self.assertEqual(Book.objects.count(), 20)
+        self.assertEqual(User.objects.count(), 4)
+        self.assertEqual(BookList.objects.count(), 30)
+        self.assertEqual(BookStats.objects.count(), 20)
+        self.assertEqual(
+            sum(BookStats.objects.values_list('listing_count', flat=True)),
+            30)
+        self.assertTrue(BookSimilarity.objects.exists())
+
+    def test_listings_capped(self):
+        generate_catalog(authors=1, books=3, users=2, listings=10)
+        self.assertEqual(BookList.objects.count(), 6)
+
+
+class SuiteTests(TestCase):
+
+    def test_run_benchmarks(self):
+        generate_catalog(authors=5, books=20, users=4, listings=30)
+        results = run_benchmarks(
+            2, ['dashboard (warm cache)', 'get_most_read_books'])
+        self.assertEqual(
+            list(results), ['dashboard (warm cache)', 'get_most_read_books'])
+        self.assertEqual(results['get_most_read_books']['queries'], 1)
+        for result in results.values():
+            self.assertEqual(result['iterations'], 2)
+            self.assertGreater(result['ops_per_sec'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_percentile(self):
+        durations = list(range(1, 101))
+        self.assertEqual(percentile(durations, 50), 50)
+        self.assertEqual(percentile(durations, 99), 99)
+        self.assertEqual(percentile([3], 99), 3)
+
+    def test_compare(self):
+        baseline = {'small': {
+            'dashboard': {'p50_ms': 10, 'queries': 6},
+            'book_list': {'p50_ms': 10, 'queries': 4},
+        }}
+        results = {
+            'small': {
+                'dashboard': {'p50_ms': 11.9, 'queries': 6},
+                'book_list': {'p50_ms': 12.1, 'queries': 5},
+                'book_rate': {'p50_ms': 100, 'queries': 10},
+            },
+            'medium': {'dashboard': {'p50_ms': 100, 'queries': 6}},
+        }
+        self.assertEqual(compare(results, baseline, 0.2), [
+            'small book_list: median 10.00 ms -> 12.10 ms',
+            'small book_list: 4 queries -> 5 queries',
+        ])
+
+
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        generate_catalog(authors=1000, books=2000, users=100, listings=5000)
+        plans.analyze()
+        cls.reader = plans.get_reader()
+
+    def test_hot_queries(self):
+        # the catalog is too small for the scanned rows to tell anything,
+        # PostgreSQL rightly hashes its 2000 books in the joins instead of
+        # looking them up, see test_rankings_not_scanned
+        hot_queries = [
+            plans.HotQuery(hot_query.name, hot_query.get_queryset,
+                           hot_query.indexes, max_scanned_rows=None)
+            for hot_query in plans.HOT_QUERIES
+        ]
+        for hot_query, plan, problems in plans.check_plans(
+                self.reader, hot_queries):
+            with self.subTest(hot_query.name):
+                self.assertEqual(problems, [], plan.text)
+
+    def test_missing_index(self):
+        if connection.vendor == 'postgresql':
+            # any index on the title would be used, undone with the
+            # transaction of the test
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        hot_query = plans.HotQuery(
+            'by title', lambda user: Book.objects.filter(title='Book'),
+            indexes=[(Book, ['title'])], max_scanned_rows=None)
+        [(hot_query, plan, problems)] = plans.check_plans(
+            self.reader, [hot_query])
+        self.assertEqual(problems, [
+            'by title: no index of books_book on (title) is used'])
+
+    def test_rankings_not_scanned(self):
+        rankings = [
+            hot_query for hot_query in plans.HOT_QUERIES
+            if hot_query.name in {
+                'get_most_read_books', 'get_recent_books',
+                'get_top_rated_books',
+            }
+        ]
+        for hot_query, plan, problems in plans.check_plans(
+                self.reader, rankings):
+            with self.subTest(hot_query.name):
+                self.assertEqual(plan.scans, [], plan.text)
+
+    def test_scanned_rows(self):
+        hot_query = plans.HotQuery(
+            'all books', lambda user: Book.objects.all(),
+            max_scanned_rows=100)
+        plan = plans.Plan(Book.objects.all())
+        plan.scans = [('books_book', 2000)]
+        self.assertEqual(plans.check_plan(hot_query, plan), [
+            'all books: books_book is scanned, about 2000 rows, more than '
+            '100'])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('explain_queries', stdout=out)
+        self.assertIn('get_top_rated_books', out.getvalue())
+        self.assertIn('bookstats_score_idx', out.getvalue())
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookr.settings')
 
 application = get_asgi_application()
+
+# build the index of the search suggestions before serving any requests
+from books.typeahead import warm_up  # noqa: E402
+
+warm_up()
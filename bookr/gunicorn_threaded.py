@@ -0,0 +1,23 @@
+'''Gunicorn settings for threaded workers sharing a connection pool
+
+Use it in the Procfile with
+
+    web: gunicorn bookr.wsgi -c python:bookr.gunicorn_threaded --log-file -
+
+Each of the WEB_CONCURRENCY workers serves GUNICORN_THREADS requests at once,
+its threads share a pool of as many database connections (see
+DATABASE_POOL in bookr/settings/production.py). Set DATABASE_POOL=pgbouncer
+to use PgBouncer instead, its connections are shared by all the workers.
+'''
+
+import os
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# set before the workers load the settings
+raw_env = [
+    f'DATABASE_POOL={os.environ.get("DATABASE_POOL", "psycopg2")}',
+    f'DATABASE_POOL_SIZE={threads}',
+]
@@ -0,0 +1,243 @@
+'''Latency and query count metrics of the views
+
+MetricsMiddleware measures each request and adds it to the histograms of
+its view (by its URL name, e.g. books:dashboard):
+
+    request_seconds: wall time of the request
+    db_seconds, db_queries: time spent in the database and number of queries
+    db_connect_seconds: time spent connecting to the database, checking the
+        connections or taking them from the pool, recorded by the database
+        backend (see bookr.postgresql) with record_db_connect()
+    template_seconds: time spent rendering the templates, with the template
+        backend of this module
+    upstream_seconds: time spent waiting for OpenLibrary, recorded by its
+        clients with record_upstream()
+
+The database and upstream times are part of the template time when the
+queries or requests are made while rendering, e.g. by a lazy queryset, and
+all of them are part of the wall time. The time spent streaming a response
+isn't counted.
+
+The histograms have exponentially growing buckets and are kept in memory by
+each process, the metrics view shows them in the Prometheus text format to
+the staff. With several worker processes each scrape only sees the worker
+which served it.
+
+Settings:
+    METRICS_QUERY_BUDGET: maximum number of queries of a request, above it a
+        warning is logged, None to disable the warning
+'''
+
+from bisect import bisect_left
+from contextlib import ExitStack
+import contextvars
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import HttpResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends import django as django_backend
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the buckets, each one twice the previous one
+SECONDS_BUCKETS = tuple(0.0005 * 2 ** i for i in range(18))  # up to 65 s
+COUNT_BUCKETS = tuple(2 ** i for i in range(11))  # up to 1024
+
+METRICS = {
+    'request_seconds': ('Wall time of the requests', SECONDS_BUCKETS),
+    'db_seconds': ('Time spent in the database', SECONDS_BUCKETS),
+    'db_queries': ('Number of database queries', COUNT_BUCKETS),
+    'db_connect_seconds': ('Time spent acquiring database connections',
+                           SECONDS_BUCKETS),
+    'template_seconds': ('Time spent rendering templates', SECONDS_BUCKETS),
+    'upstream_seconds': ('Time spent waiting for OpenLibrary',
+                         SECONDS_BUCKETS),
+}
+
+
+class LogHistogram:
+    '''Number of observed values in buckets of exponentially growing size'''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last bucket is for the values above all the bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        '''(upper bound, number of values up to it) of each bucket'''
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry:
+    '''The histograms of each metric of each view'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (metric, view) -> histogram
+        self.histograms = {}
+
+    def observe(self, view, values):
+        with self.lock:
+            for metric, value in values.items():
+                histogram = self.histograms.get((metric, view))
+                if histogram is None:
+                    histogram = LogHistogram(METRICS[metric][1])
+                    self.histograms[metric, view] = histogram
+                histogram.observe(value)
+
+    def get(self, metric, view):
+        return self.histograms.get((metric, view))
+
+    def render(self):
+        '''The histograms in the Prometheus text format'''
+        lines = []
+        with self.lock:
+            for metric, (description, bounds) in METRICS.items():
+                name = f'bookr_{metric}'
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (other, view), histogram in sorted(
+                        self.histograms.items()):
+                    if other != metric:
+                        continue
+                    label = f'view="{escape_label(view)}"'
+                    for bound, count in histogram.cumulative_counts():
+                        le = bound if bound == '+Inf' else f'{bound:g}'
+                        lines.append(
+                            f'{name}_bucket{{{label},le="{le}"}} {count}')
+                    # all the digits, so the rate of a large sum still moves
+                    lines.append(f'{name}_sum{{{label}}} {histogram.sum!r}')
+                    lines.append(f'{name}_count{{{label}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+registry = Registry()
+
+
+class RequestMetrics:
+    '''The measures of one request, also the wrapper of its queries'''
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.db_connect_seconds = 0.0
+        self.template_seconds = 0.0
+        self.upstream_seconds = 0.0
+        self.rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.db_queries += 1
+
+
+# the metrics of the request being served, shared by its async tasks
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+def record_db_connect(seconds):
+    '''Add the time taken to acquire a database connection to the request'''
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.db_connect_seconds += seconds
+
+
+def record_upstream(seconds):
+    '''Add the duration of a call to an upstream API to the request'''
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.upstream_seconds += seconds
+
+
+class MetricsMiddleware:
+    '''Measure the requests, see the module docstring'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        elapsed = time.perf_counter() - start
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.view_name if resolver_match else 'unresolved'
+        registry.observe(view, {
+            'request_seconds': elapsed,
+            'db_seconds': metrics.db_seconds,
+            'db_queries': metrics.db_queries,
+            'db_connect_seconds': metrics.db_connect_seconds,
+            'template_seconds': metrics.template_seconds,
+            'upstream_seconds': metrics.upstream_seconds,
+        })
+        budget = settings.METRICS_QUERY_BUDGET
+        if budget is not None and metrics.db_queries > budget:
+            logger.warning(
+                '%s made %d queries, over the budget of %d (%s)',
+                view, metrics.db_queries, budget, request.path)
+        return response
+
+
+class Template(django_backend.Template):
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        # the templates rendered by this one are timed with it
+        if metrics is None or metrics.rendering:
+            return super().render(context, request)
+        metrics.rendering = True
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.rendering = False
+            metrics.template_seconds += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    '''The Django template backend, timing the rendering of the templates'''
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+@staff_member_required
+def metrics_view(request):
+    return HttpResponse(
+        registry.render(), content_type='text/plain; version=0.0.4')
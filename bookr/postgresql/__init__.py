@@ -0,0 +1,20 @@
+'''PostgreSQL backend with health checks and an optional connection pool
+
+Set ENGINE to 'bookr.postgresql' in DATABASES (see
+bookr/settings/production.py), it takes two more keys:
+
+    CONN_HEALTH_CHECKS: check a persistent connection with a SELECT 1 when a
+        request first uses it, and reconnect if it's broken (e.g. after the
+        database restarted), instead of failing the request
+    POOL: dict of MIN_SIZE and MAX_SIZE, to share a psycopg2
+        ThreadedConnectionPool between the threads of the process (e.g. the
+        threads of a gthread gunicorn worker). The connections are taken
+        from the pool on the first query of a request and given back when
+        Django closes them, so use it with CONN_MAX_AGE = 0. The pool opens
+        MIN_SIZE connections, the ones given back above it are closed, and
+        taking more than MAX_SIZE connections at once fails.
+
+The time spent connecting, checking the connections and taking them from
+the pool is added to the db_connect_seconds metric of the request (see
+bookr.metrics).
+'''
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+from django.db.backends.postgresql import base
+from django.utils.asyncio import async_unsafe
+from psycopg2 import pool
+
+from bookr.metrics import record_db_connect
+
+# (process id, alias) -> pool, created by the first connection: a forked
+# process inherits the pools of its parent but mustn't use their connections
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool(pool.ThreadedConnectionPool):
+    '''A pool whose connections are opened by a function
+
+    So they're set up by the backend like the connections it opens itself.
+    '''
+
+    def __init__(self, minconn, maxconn, connect):
+        self.connect = connect
+        super().__init__(minconn, maxconn)
+
+    def _connect(self, key=None):
+        connection = self.connect()
+        if key is not None:
+            self._used[key] = connection
+            self._rused[id(connection)] = key
+        else:
+            self._pool.append(connection)
+        return connection
+
+
+def is_usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        # without autocommit (e.g. a new connection of the pool) the query
+        # opened a transaction, in which Django couldn't set autocommit
+        if not connection.autocommit:
+            connection.rollback()
+    except base.Database.Error:
+        return False
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    '''The PostgreSQL backend, see the package docstring'''
+
+    # whether the connection was checked since the request started
+    health_check_done = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_checks = self.settings_dict.get(
+            'CONN_HEALTH_CHECKS', False)
+        self.pool_settings = self.settings_dict.get('POOL')
+
+    def get_pool(self, conn_params):
+        key = (os.getpid(), self.alias)
+        with _pools_lock:
+            connection_pool = _pools.get(key)
+            if connection_pool is None:
+                connection_pool = ConnectionPool(
+                    self.pool_settings['MIN_SIZE'],
+                    self.pool_settings['MAX_SIZE'],
+                    lambda: super(DatabaseWrapper, self).get_new_connection(
+                        conn_params))
+                _pools[key] = connection_pool
+            return connection_pool
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        if not self.pool_settings:
+            return super().get_new_connection(conn_params)
+        connection_pool = self.get_pool(conn_params)
+        # the pool keeps at most MAX_SIZE connections, once the broken ones
+        # are closed it opens a new one
+        for attempt in range(self.pool_settings['MAX_SIZE']):
+            connection = connection_pool.getconn()
+            if not self.health_checks or is_usable(connection):
+                return connection
+            connection_pool.putconn(connection, close=True)
+        return connection_pool.getconn()
+
+    def _close(self):
+        if self.pool_settings and self.connection is not None:
+            # the pool rolls back an open transaction, and drops the
+            # connection if it's closed
+            with self.wrap_database_errors:
+                self.get_pool(self.get_connection_params()).putconn(
+                    self.connection)
+        else:
+            super()._close()
+
+    @async_unsafe
+    def ensure_connection(self):
+        if self.connection is not None and self.health_check_done:
+            return
+        start = time.perf_counter()
+        try:
+            if (self.connection is not None and self.health_checks
+                    and not self.in_atomic_block
+                    and not is_usable(self.connection)):
+                self.close()
+            super().ensure_connection()
+        finally:
+            record_db_connect(time.perf_counter() - start)
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # checked again by the next request
+        self.health_check_done = False
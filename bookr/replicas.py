@@ -0,0 +1,133 @@
+'''Reads from the read replicas of the database
+
+The aliases of the replicas in DATABASES are listed in DATABASE_REPLICAS.
+ReplicaRouter sends the writes to the default database, even the writes of
+the objects read from a replica, and the reads to one of the replicas in two
+cases:
+
+    - the GET and HEAD requests of the views marked with read_only()
+    - the querysets returned by the functions decorated with
+      read_from_replica(), e.g. the rankings of the dashboard
+
+A replica lags behind the default database, so once a user wrote anything
+their requests read from the default database for DATABASE_REPLICA_STICKY
+seconds, e.g. they see the book they just added on their list. The time is
+kept in their session by ReplicaMiddleware. Reads in a transaction go to the
+default database too.
+
+Other users may see the data of the replica for as long as it lags, and so
+may the rankings cached from it (see books.cache).
+
+Settings:
+    DATABASE_REPLICAS: aliases of the replicas, reads go to a random one
+    DATABASE_REPLICA_STICKY: seconds after a write during which the user
+        reads from the default database
+'''
+
+import contextvars
+from functools import wraps
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SESSION_KEY = '_replica_sticky_until'
+
+
+class RequestState:
+    '''What the request being served read and wrote'''
+
+    def __init__(self, sticky):
+        # the user wrote lately, read from the default database
+        self.sticky = sticky
+        # the view is read only, read from a replica
+        self.read_only = False
+        self.wrote = False
+
+
+# the state of the request being served, shared by its async tasks
+_current = contextvars.ContextVar('replica_state', default=None)
+
+
+def get_replica():
+    '''Alias of a replica to read from, None to read from the default'''
+    state = _current.get()
+    if (not settings.DATABASE_REPLICAS
+            or state is not None and state.sticky
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+def read_only(view):
+    '''Mark a view whose GET and HEAD requests can read from a replica'''
+    view.replica_reads = True
+    return view
+
+
+def read_from_replica(func):
+    '''Make the queryset returned by func read from a replica'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        queryset = func(*args, **kwargs)
+        replica = get_replica()
+        return queryset if replica is None else queryset.using(replica)
+    return wrapper
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if state is not None and state.read_only:
+            return get_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None:
+            state.wrote = True
+        # the objects read from a replica are saved to the default database
+        instance = hints.get('instance')
+        if (instance is not None
+                and instance._state.db in settings.DATABASE_REPLICAS):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware:
+    '''Route the reads of the request, see the module docstring
+
+    It needs the session and the user, so it goes after
+    AuthenticationMiddleware.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RequestState(
+            sticky=request.session.get(SESSION_KEY, 0) > time.time())
+        token = _current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        if state.wrote and settings.DATABASE_REPLICAS:
+            request.session[SESSION_KEY] = (
+                time.time() + settings.DATABASE_REPLICA_STICKY)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (getattr(view_func, 'replica_reads', False)
+                and request.method in ('GET', 'HEAD')):
+            # a user who just signed up may not be on the replica yet
+            request.user.pk
+            _current.get().read_only = True
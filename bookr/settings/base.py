@@ -28,6 +28,14 @@ DATABASES = {
     'default': {}
 }
 
+# Read replicas, see bookr/replicas.py
+# aliases in DATABASES of the replicas, the read only views read from them
+# except for the users who wrote in the last DATABASE_REPLICA_STICKY seconds
+
+DATABASE_ROUTERS = ['bookr.replicas.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_STICKY = 10
+
 
 # Application definition
 
@@ -41,16 +49,20 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django_registration',
     'books',
+    'benchmarks',
     'material',
 ]
 
 MIDDLEWARE = [
+    # first, so it measures the other middleware too
+    'bookr.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # should be always 2nd here
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'bookr.replicas.ReplicaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -59,7 +71,8 @@ ROOT_URLCONF = 'bookr.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django backend, timing the rendering for bookr.metrics
+        'BACKEND': 'bookr.metrics.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -113,6 +126,105 @@ LOGOUT_REDIRECT_URL = 'books:dashboard'
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 
+# Cache of the dashboard rankings and pages, see books/cache.py
+# falls back to a local-memory cache if the alias isn't in CACHES
+# use a cache shared by all the workers (e.g. memcached) in production,
+# so a change seen by one worker invalidates the others' cache too
+
+BOOKS_CACHE = 'default'
+BOOKS_CACHE_TIMEOUT = 300
+
+# Prior of the scores of the top rated books, see books.models.BookStats
+# run the rebuild_book_stats command after changing them
+
+BOOKS_RATING_PRIOR_MEAN = 3.0
+BOOKS_RATING_PRIOR_VOTES = 2
+
+# Trending books: the listings of the last days, each day weighted by the
+# decay more than the day after it, the daily counts of the older days are
+# deleted
+
+BOOKS_TRENDING_DAYS = 7
+BOOKS_TRENDING_DECAY = 0.8
+
+# Number of books on a page of the user's list
+
+BOOKS_BOOKLIST_PAGE_SIZE = 24
+
+# Number of rows of the user's list read and written at once by its
+# download, see books/export.py
+
+BOOKS_EXPORT_CHUNK_SIZE = 2000
+
+# Number of books loaded at once by the picker of the existing books
+
+BOOKS_PICKER_PAGE_SIZE = 20
+
+# Maximum number of ratings sent to the batch rating view at once
+
+BOOKS_RATE_BATCH_SIZE = 100
+
+# Search of the books in our catalog, see books/search.py
+# OpenLibrary is only searched if there are fewer results than the minimum
+
+BOOKS_SEARCH_RESULTS = 10
+BOOKS_SEARCH_MIN_RESULTS = 3
+
+# Suggestions while typing a search, see books/typeahead.py
+# each book takes one entry, each author two, about 400 bytes per entry, so
+# every process serving requests holds about 80 MB and builds the index for
+# a few seconds when it starts
+
+BOOKS_TYPEAHEAD_RESULTS = 8
+BOOKS_TYPEAHEAD_MAX_ENTRIES = 200000
+
+# Books listed by the readers of a book, see books/recommendations.py
+# number of neighbours stored for each book, and the maximum number of
+# co-listed pairs counted at once, about 50 bytes per pair
+
+BOOKS_SIMILAR_BOOKS = 20
+BOOKS_SIMILARITY_MAX_PAIRS = 2000000
+
+# Books recommended on the user's list, cached until the list changes or
+# refreshed by the precompute_recommendations command for the users who
+# logged in during the last BOOKS_RECOMMENDATIONS_ACTIVE_DAYS
+
+BOOKS_RECOMMENDATIONS = 6
+BOOKS_RECOMMENDATIONS_TIMEOUT = 60 * 60 * 24
+BOOKS_RECOMMENDATIONS_ACTIVE_DAYS = 30
+
+
+# OpenLibrary API client, see books/openlibrary.py
+
+OPENLIBRARY_URL = 'https://openlibrary.org'
+OPENLIBRARY_CONNECT_TIMEOUT = 3.05
+OPENLIBRARY_READ_TIMEOUT = 10
+OPENLIBRARY_RETRIES = 2
+OPENLIBRARY_BACKOFF = 0.3
+OPENLIBRARY_POOL_SIZE = 10
+OPENLIBRARY_FAILURE_THRESHOLD = 5
+OPENLIBRARY_RESET_TIMEOUT = 30
+OPENLIBRARY_SEARCH_CACHE_TTL = 60 * 60 * 24
+OPENLIBRARY_BOOK_CACHE_TTL = 60 * 60 * 24 * 30
+OPENLIBRARY_CACHE_MAX_ENTRIES = 10000
+# number of search results whose details are fetched by the search
+OPENLIBRARY_SEARCH_DETAILS = 5
+
+# Imports of books from OpenLibrary, see books/jobs.py
+
+BOOKS_IMPORT_MAX_ATTEMPTS = 5
+BOOKS_IMPORT_RETRY_DELAY = 60
+
+# Per-view request metrics, see bookr/metrics.py
+# requests making more queries than the budget are logged as warnings
+
+METRICS_QUERY_BUDGET = 20
+
+# Serve the book search with the async view, only useful under ASGI
+
+BOOKS_ASYNC_SEARCH = os.environ.get('BOOKS_ASYNC_SEARCH') == '1'
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
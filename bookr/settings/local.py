@@ -27,5 +27,16 @@ DATABASES = {
         'PASSWORD': 'dev',
         'HOST': '127.0.0.1',
         'PORT': '5432',
-    }
+    },
+    # a second database to try out the read replicas (see
+    # bookr/replicas.py) by adding it to DATABASE_REPLICAS, the tests of the
+    # routing use it too
+    'replica': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'bookr_replica',
+        'USER': 'dev',
+        'PASSWORD': 'dev',
+        'HOST': '127.0.0.1',
+        'PORT': '5432',
+    },
 }
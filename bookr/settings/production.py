@@ -8,6 +8,7 @@ DJANGO_SETTINGS_MODULE=bookr.settings.production
 
 import dj_database_url
 import os
+from django.core.exceptions import ImproperlyConfigured
 from .base import *  # noqa ignore=F405
 
 
@@ -22,8 +23,44 @@ ALLOWED_HOSTS = ['django-bookr.herokuapp.com']
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 # For Heroku we need to use a database url
+#
+# DATABASE_POOL chooses how the connections are managed (see
+# bookr/postgresql):
+#   unset: each thread keeps its connection for up to 10 minutes
+#   pgbouncer: DATABASE_URL points to PgBouncer in transaction pooling mode,
+#       which can't keep the server-side cursors of QuerySet.iterator()
+#       between transactions
+#   psycopg2: the threads of each process share a pool keeping
+#       DATABASE_POOL_SIZE connections, e.g. with bookr/gunicorn_threaded.py,
+#       up to twice as many are opened at busy times
+# The persistent and pooled connections are checked when a request first
+# uses them.
+#
+# DATABASE_REPLICA_URLS lists the URLs of the read replicas, separated by
+# spaces, they're connected to like the database of DATABASE_URL (see
+# bookr/replicas.py).
+
+DATABASE_POOL = os.environ.get('DATABASE_POOL', '')
+if DATABASE_POOL not in ('', 'pgbouncer', 'psycopg2'):
+    raise ImproperlyConfigured(f'Unknown DATABASE_POOL {DATABASE_POOL}')
 
 DATABASES['default'] = dj_database_url.config(  # noqa ignore=F405
-    conn_max_age=600, ssl_require=True)
+    conn_max_age=600, ssl_require=True, engine='bookr.postgresql')
+DATABASE_REPLICAS = []
+for i, url in enumerate(os.environ.get('DATABASE_REPLICA_URLS', '').split()):
+    alias = f'replica{i + 1}'
+    DATABASES[alias] = dj_database_url.parse(  # noqa ignore=F405
+        url, conn_max_age=600, ssl_require=True, engine='bookr.postgresql')
+    DATABASE_REPLICAS.append(alias)
+
+for database in DATABASES.values():  # noqa ignore=F405
+    database['CONN_HEALTH_CHECKS'] = True
+    if DATABASE_POOL == 'pgbouncer':
+        database['DISABLE_SERVER_SIDE_CURSORS'] = True
+    elif DATABASE_POOL == 'psycopg2':
+        pool_size = int(os.environ.get('DATABASE_POOL_SIZE', 4))
+        database.update(
+            CONN_MAX_AGE=0,
+            POOL={'MIN_SIZE': pool_size, 'MAX_SIZE': 2 * pool_size})
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
@@ -16,8 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from . import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', metrics.metrics_view, name='metrics'),
     path('my/account/', include('django_registration.backends.one_step.urls')),
     path('my/account/', include('django.contrib.auth.urls')),
     path('', include('books.urls')),
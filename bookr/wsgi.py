@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookr.settings')
 
 application = get_wsgi_application()
+
+# build the index of the search suggestions before serving any requests
+from books.typeahead import warm_up  # noqa: E402
+
+warm_up()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Author, Book, BookList
+from .models import Author, Book, BookList, ImportJob
 
 
 class BookAdmin(admin.ModelAdmin):
@@ -9,6 +9,7 @@ class BookAdmin(admin.ModelAdmin):
         'author', 'title', 'first_published', 'number_of_listings',
         'average_rating', 'added')
     list_filter = ['author']
+    list_select_related = ('author', 'stats')
     search_fields = ['title']
 
 
@@ -18,6 +19,14 @@ class BookListAdmin(admin.ModelAdmin):
     list_filter = ['user', 'book']
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    model = ImportJob
+    list_display = (
+        'user', 'olid', 'status', 'attempts', 'run_after', 'created')
+    list_filter = ['status']
+
+
 admin.site.register(Author)
 admin.site.register(Book, BookAdmin)
 admin.site.register(BookList, BookListAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
@@ -0,0 +1,163 @@
+'''Cache of the dashboard rankings and pages, and per-user counts
+
+The cache also tells which worker prunes the old daily listing counts of the
+day, see claim_daily_pruning().
+
+Every cached value is keyed by a generation counter, which is bumped whenever
+a book or a booklist changes (see books.signals). Bumping the generation makes
+all the old keys unreachable, so nothing has to be deleted explicitly and the
+rankings cost no queries until the data actually changes.
+
+Settings:
+    BOOKS_CACHE: alias of the cache to use, if it isn't configured in
+        CACHES, a local-memory cache is used instead
+    BOOKS_CACHE_TIMEOUT: how long the values are kept, in seconds
+'''
+
+import time
+
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+GENERATION_KEY = 'books:generation'
+DEFAULT_TIMEOUT = 300
+# how long a worker may hold the lock while recomputing a ranking
+LOCK_TIMEOUT = 10
+# how long other workers wait for it if there is no stale value to serve
+LOCK_WAIT = 0.05
+LOCK_RETRIES = 20
+
+_fallback_cache = LocMemCache('books', {})
+
+
+def get_cache():
+    '''Get the cache configured by BOOKS_CACHE or the local-memory fallback'''
+    try:
+        return caches[getattr(settings, 'BOOKS_CACHE', 'default')]
+    except InvalidCacheBackendError:
+        return _fallback_cache
+
+
+def get_generation():
+    '''Get the current generation of the cached data'''
+    cache = get_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # start from the current time, so a generation evicted from the cache
+        # can't be reused with the values cached for it before
+        cache.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    '''Invalidate all the cached rankings
+
+    The generation is bumped right away and once more when the transaction is
+    committed, so values recomputed from uncommitted data in the meantime
+    don't outlive the transaction.
+    '''
+    _incr_generation()
+    transaction.on_commit(_incr_generation)
+
+
+def _incr_generation():
+    cache = get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        get_generation()
+
+
+def get_timeout():
+    return getattr(settings, 'BOOKS_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def cached_value(name, compute):
+    '''Get a value of the current generation, compute it on a miss
+
+    Only one worker computes a missing value at a time; the others serve the
+    value of the previous generation meanwhile, or wait for a short while if
+    there isn't any.
+
+    Params:
+        name(str): name of the value, part of the cache key
+        compute(callable): returns the value to cache, mustn't be None
+    Returns:
+        value: the cached or freshly computed value
+    '''
+    cache = get_cache()
+    key = f'books:{name}:{get_generation()}'
+    stale_key = f'books:{name}:stale'
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    locked = cache.add(lock_key, True, timeout=LOCK_TIMEOUT)
+    if not locked:
+        value = cache.get(stale_key)
+        for _ in range(LOCK_RETRIES):
+            if value is not None:
+                return value
+            time.sleep(LOCK_WAIT)
+            value = cache.get(key)
+        # the other worker is taking too long, compute it ourselves
+
+    try:
+        value = compute()
+        cache.set(key, value, timeout=get_timeout())
+        cache.set(stale_key, value, timeout=None)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+def cached_ranking(name, func):
+    '''Get a ranking from the cache, compute it with func on a miss
+
+    Params:
+        name(str): name of the ranking, part of the cache key
+        func(callable): returns the ranking as an iterable of books
+    Returns:
+        ranking(list): the evaluated ranking
+    '''
+    return cached_value(name, lambda: list(func()))
+
+
+def claim_daily_pruning(day):
+    '''Whether the caller is the first to prune the old daily counts on the day
+
+    The claim is kept in the cache for a day, so the counts are pruned at
+    most once a day by each cache, even if the pruning fails.
+    '''
+    return get_cache().add(
+        f'books:daily_pruning:{day.isoformat()}', True, timeout=24 * 60 * 60)
+
+
+def _booklist_count_key(user_id):
+    return f'books:booklist_count:{user_id}'
+
+
+def get_booklist_count(user):
+    '''Get the number of books on the user's list
+
+    The count is cached until a booklist of the user is added or deleted.
+    '''
+    cache = get_cache()
+    key = _booklist_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = user.booklist_set.count()
+        cache.set(key, count, timeout=get_timeout())
+    return count
+
+
+def invalidate_booklist_count(user_id):
+    '''Forget the cached count, now and when the transaction is committed'''
+    key = _booklist_count_key(user_id)
+    get_cache().delete(key)
+    transaction.on_commit(lambda: get_cache().delete(key))
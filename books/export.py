@@ -0,0 +1,89 @@
+'''Download of a user's booklist as CSV or JSON
+
+The rows are read with a server-side cursor, BOOKS_EXPORT_CHUNK_SIZE at a
+time, and written out as they come, so the memory used doesn't depend on the
+length of the list. The query resolves the overrides of the booklists (see
+BookListManager.resolve_overrides()) and returns tuples instead of models.
+
+Without server-side cursors (e.g. behind PgBouncer, see
+bookr/settings/production.py) the database driver fetches all the rows at
+once, but they're still not turned into models.
+
+Settings:
+    BOOKS_EXPORT_CHUNK_SIZE: number of rows read and written at once
+'''
+
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import BookList
+
+FIELDS = ('title', 'author', 'year', 'cover', 'rating', 'added')
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+
+def get_rows(user):
+    '''The user's booklist in the order of the list, as tuples of FIELDS'''
+    booklists = BookList.objects.resolve_overrides().filter(
+        user=user
+    ).order_by(
+        'book__author__last_name', 'book__title', 'pk'
+    ).values_list(
+        'listed_title', 'listed_author', 'listed_year', 'listed_cover',
+        'rating', 'added'
+    )
+    # the rows are read after the view returned, with the database chosen
+    # for its request (see bookr.replicas)
+    return booklists.using(booklists.db).iterator(
+        chunk_size=settings.BOOKS_EXPORT_CHUNK_SIZE)
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Echo:
+    '''A file whose writes return what's written, for csv.writer'''
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for chunk in chunks(rows, settings.BOOKS_EXPORT_CHUNK_SIZE):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+
+def stream_json(rows):
+    '''A JSON array of objects with the FIELDS'''
+    separator = '\n'
+    yield '['
+    for chunk in chunks(rows, settings.BOOKS_EXPORT_CHUNK_SIZE):
+        lines = []
+        for row in chunk:
+            lines.append(separator + json.dumps(
+                dict(zip(FIELDS, row)), cls=DjangoJSONEncoder))
+            separator = ',\n'
+        yield ''.join(lines)
+    yield '\n]\n'
+
+
+def stream(user, format):
+    '''Chunks of the export of the user's booklist in the format'''
+    rows = get_rows(user)
+    return stream_csv(rows) if format == 'csv' else stream_json(rows)
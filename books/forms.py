@@ -1,31 +1,47 @@
 from django import forms
+from django.db.models import Exists, OuterRef
+from django.urls import reverse_lazy
 
 from .models import BookList, Book
 
 
+def get_unlisted_books(user):
+    '''Books which aren't on the user's list yet'''
+    return Book.objects.filter(~Exists(
+        BookList.objects.filter(user=user, book=OuterRef('pk'))))
+
+
+class BookPicker(forms.Widget):
+    '''Hidden input of the picked book with a searchable list of the books
+
+    The books are loaded page by page from the book_picker view, so rendering
+    the widget doesn't query the books at all.
+    '''
+    template_name = 'books/widgets/book_picker.html'
+    url = reverse_lazy('books:book_picker')
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['url'] = self.url
+        return context
+
+
 class BookListAddForm(forms.ModelForm):
     '''Form for adding books to the user's list from the existing books'''
 
     class Meta:
         model = BookList
         fields = ('book',)
+        widgets = {'book': BookPicker}
 
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user')
         super().__init__(*args, **kwargs)
-        self.fields['book'].queryset = Book.objects.exclude(
-            booklist__user=self.user)
+        # only the submitted book is looked up when validating
+        self.fields['book'].queryset = get_unlisted_books(self.user)
 
     def save(self):
         book = super().save(commit=False)
         book.user = self.user
         book.save()
         return book
-
-
-class SearchResultsForm(forms.Form):
-    book = forms.ChoiceField(widget=forms.RadioSelect)
-
-    def __init__(self, book_choices, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields['book'].choices = book_choices
@@ -0,0 +1,103 @@
+'''Queue of the book imports from OpenLibrary
+
+Adding a book found on OpenLibrary only enqueues an ImportJob, so the request
+doesn't wait for OpenLibrary. The jobs are processed by the
+process_import_jobs command. A worker claims a due job in a short
+transaction, skipping the rows locked by other workers, which counts the
+attempt and postpones the job as if it failed. So several workers can run at
+once, no lock is held while OpenLibrary is fetched, and the job of a crashed
+worker is retried later.
+
+Failed jobs are retried with exponential backoff, until they run out of
+attempts or the book data turn out to be unusable. Errors other than the ones
+of OpenLibrary (e.g. a book that can't be saved) are logged and retried the
+same way.
+
+Settings:
+    BOOKS_IMPORT_MAX_ATTEMPTS: how many times is a job tried
+    BOOKS_IMPORT_RETRY_DELAY: seconds before the first retry, doubled for
+        each further one
+'''
+
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import openlibrary
+from .models import ImportJob
+from .openlibrary import InvalidBookData, OpenLibraryError, parse_book
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_import(user, olid):
+    '''Enqueue the import of a book, unless it's already waiting
+
+    Returns:
+        job(ImportJob): the job, None if the olid can't be an OpenLibrary ID
+    '''
+    if not olid or len(olid) > ImportJob._meta.get_field('olid').max_length:
+        return None
+    job, created = ImportJob.objects.get_or_create(
+        user=user, olid=olid, status=ImportJob.PENDING)
+    return job
+
+
+def retry_delay(attempts):
+    '''Seconds to wait after the attempts before the next one'''
+    return settings.BOOKS_IMPORT_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def claim_next_job():
+    '''The next due job, its attempt counted and the retry scheduled'''
+    with transaction.atomic():
+        job = ImportJob.objects.select_for_update(skip_locked=True).filter(
+            status=ImportJob.PENDING, run_after__lte=timezone.now()
+        ).order_by('run_after', 'pk').first()
+        if job is None:
+            return None
+        if job.attempts >= settings.BOOKS_IMPORT_MAX_ATTEMPTS:
+            # the worker of the last attempt stopped before it ended
+            job.status = ImportJob.FAILED
+            job.last_error = 'The last attempt was interrupted'
+        else:
+            job.attempts += 1
+            job.run_after = timezone.now() + timedelta(
+                seconds=retry_delay(job.attempts))
+        job.save()
+    return job
+
+
+def process_next_job():
+    '''Process the next due job
+
+    Returns:
+        job(ImportJob): the processed job, None if there wasn't any
+    '''
+    job = claim_next_job()
+    if job is not None and job.status == ImportJob.PENDING:
+        run_job(job)
+    return job
+
+
+def run_job(job):
+    '''Import the book of a claimed job, and save how it went'''
+    try:
+        book = parse_book(openlibrary.get_book(job.olid))
+        with transaction.atomic():
+            job.booklist, created = openlibrary.import_book(job.user, book)
+    except Exception as e:
+        if not isinstance(e, OpenLibraryError):
+            logger.exception('%s failed', job)
+        job.last_error = str(e) or e.__class__.__name__
+        if isinstance(e, InvalidBookData) or (
+                job.attempts >= settings.BOOKS_IMPORT_MAX_ATTEMPTS):
+            job.status = ImportJob.FAILED
+        # else retried at the run_after set by claim_next_job()
+    else:
+        job.status = ImportJob.DONE
+        job.last_error = ''
+    job.save()
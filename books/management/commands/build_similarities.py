@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute the books listed by the readers of each book, only for the '
+        'books whose listings changed since the last run unless --full'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Recompute the similar books of all the books')
+        parser.add_argument(
+            '--max-pairs', type=int,
+            help='Maximum number of co-listed pairs counted at once')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.start = time.monotonic()
+        books = recommendations.build_similarities(
+            full=options['full'], max_pairs=options['max_pairs'],
+            progress=self.report)
+        engine = 'numpy' if recommendations.sparse is None else 'scipy'
+        self.stdout.write(self.style.SUCCESS(
+            f'Similar books of {books} books computed with {engine} '
+            f'in {time.monotonic() - self.start:.2f} s.'))
+
+    def report(self, done, total):
+        if self.verbosity > 1:
+            self.stdout.write(
+                f'{done}/{total} books, '
+                f'{time.monotonic() - self.start:.1f} s')
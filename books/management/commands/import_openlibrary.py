@@ -0,0 +1,253 @@
+'''Import books from the OpenLibrary data dumps
+
+The dumps (https://openlibrary.org/developers/dumps) are tab separated files,
+one record per line: type, key, revision, last modified and the JSON data.
+They are read line by line (gzipped or not), so the memory used doesn't
+depend on the size of the dump.
+
+The works and editions only refer to their authors by key, so the authors
+dump has to be indexed first, the names are kept in an SQLite file on disk:
+
+    manage.py import_openlibrary --authors ol_dump_authors.txt.gz \\
+        ol_dump_works.txt.gz
+
+Later imports can reuse the same index without the --authors option.
+Every batch is committed on its own, the progress report shows the offset
+to resume from with --offset if the import is interrupted.
+'''
+
+import gzip
+import json
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from books.cache import bump_generation
+from books.models import Author, Book, BookStats
+from books.openlibrary import COVER_URL, parse_year, split_name
+
+# the field of the publication date of each type of book record
+BOOK_TYPES = {
+    b'/type/work': 'first_publish_date',
+    b'/type/edition': 'publish_date',
+}
+# SQLite has a limit on the number of variables in a query
+LOOKUP_SIZE = 500
+
+
+def open_dump(path):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+
+
+def read_dump(path, offset=0):
+    '''Yield the offset after each record, its type and its data'''
+    with open_dump(path) as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            fields = line.rstrip(b'\n').split(b'\t', 4)
+            if len(fields) == 5:
+                yield offset, fields[0], fields[4]
+
+
+def parse_record(record_type, data):
+    '''Extract the author key and the fields of a book from a work or edition
+
+    Returns:
+        (author_key, book) or None if some of the required data are missing
+    '''
+    try:
+        data = json.loads(data)
+        author = data['authors'][0]
+        author_key = author.get('author', author)['key']
+        year = parse_year(data[BOOK_TYPES[record_type]])
+        title = data['title']
+        # missing covers are -1
+        covers = [cover for cover in data.get('covers', []) if cover > 0]
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError):
+        return None
+    return author_key, {
+        'title': title[:Book._meta.get_field('title').max_length],
+        'first_published': year,
+        'cover': COVER_URL.format(covers[0]) if covers else '',
+    }
+
+
+class AuthorIndex:
+    '''Names of the authors by their OpenLibrary key, stored on disk'''
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS author '
+            '(key TEXT PRIMARY KEY, name TEXT NOT NULL)')
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM author').fetchone()[0]
+
+    def add(self, authors):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO author VALUES (?, ?)', authors)
+
+    def get_names(self, keys):
+        keys = list(keys)
+        names = {}
+        for i in range(0, len(keys), LOOKUP_SIZE):
+            chunk = keys[i:i + LOOKUP_SIZE]
+            names.update(self.db.execute(
+                'SELECT key, name FROM author WHERE key IN ({})'.format(
+                    ', '.join('?' * len(chunk))),
+                chunk))
+        return names
+
+    def close(self):
+        self.db.close()
+
+
+class Command(BaseCommand):
+    help = 'Import books from an OpenLibrary works or editions dump'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'dump', help='Works or editions dump, may be gzipped')
+        parser.add_argument(
+            '--authors',
+            help='Authors dump to index before the import, may be gzipped')
+        parser.add_argument(
+            '--author-index', default='openlibrary_authors.sqlite3',
+            help='SQLite file of the author names by their key')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of records inserted at once')
+        parser.add_argument(
+            '--offset', type=int, default=0,
+            help='Resume the import of the dump from this byte offset')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        index = AuthorIndex(options['author_index'])
+        try:
+            if options['authors']:
+                self.index_authors(index, options['authors'], batch_size)
+            if not len(index):
+                raise CommandError(
+                    'The author index is empty, use --authors to build it.')
+            self.import_books(
+                index, options['dump'], options['offset'], batch_size)
+        finally:
+            index.close()
+
+    def index_authors(self, index, path, batch_size):
+        progress = Progress(self, 'authors')
+        batch = []
+        for offset, record_type, data in read_dump(path):
+            progress.rows += 1
+            if record_type != b'/type/author':
+                continue
+            try:
+                data = json.loads(data)
+                batch.append((data['key'], data['name']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if len(batch) >= batch_size:
+                index.add(batch)
+                batch = []
+                progress.report(offset)
+        index.add(batch)
+        progress.report(None)
+
+    def import_books(self, index, path, offset, batch_size):
+        progress = Progress(self, 'books')
+        batch = []
+        for offset, record_type, data in read_dump(path, offset):
+            progress.rows += 1
+            record = parse_record(record_type, data)
+            if record is None:
+                progress.skipped += 1
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                progress.skipped += self.import_batch(index, batch)
+                batch = []
+                progress.report(offset)
+        progress.skipped += self.import_batch(index, batch)
+        progress.report(None)
+        if progress.rows > progress.skipped:
+            bump_generation()
+
+    @transaction.atomic
+    def import_batch(self, index, batch):
+        '''Insert the books of a batch, their stats and their missing authors
+
+        Returns:
+            the number of records skipped because their author is unknown
+        '''
+        max_length = Author._meta.get_field('first_name').max_length
+        names = {
+            key: tuple(part[:max_length] for part in split_name(name))
+            for key, name in index.get_names(
+                {author_key for author_key, book in batch}).items()
+        }
+        authors = list(set(names.values()))
+        # authors which already exist are left alone thanks to unique_author
+        Author.objects.bulk_create(
+            [Author(first_name=first_name, last_name=last_name)
+             for first_name, last_name in authors],
+            batch_size=LOOKUP_SIZE, ignore_conflicts=True)
+        author_ids = {}
+        for i in range(0, len(authors), LOOKUP_SIZE):
+            first_names, last_names = zip(*authors[i:i + LOOKUP_SIZE])
+            author_ids.update(
+                ((first_name, last_name), pk)
+                for pk, first_name, last_name in Author.objects.filter(
+                    first_name__in=first_names, last_name__in=last_names,
+                ).values_list('pk', 'first_name', 'last_name'))
+
+        books = {}
+        for author_key, book in batch:
+            author_id = author_ids.get(names.get(author_key))
+            if author_id is not None:
+                # the editions of a work are usually next to each other
+                books.setdefault(
+                    (author_id, book['title'], book['first_published']),
+                    Book(author_id=author_id, **book))
+        Book.objects.bulk_create(
+            books.values(), batch_size=LOOKUP_SIZE, ignore_conflicts=True)
+        # bulk_create doesn't send post_save, create the stats of the new
+        # books like books.signals does
+        book_authors = list({author_id for author_id, _, _ in books})
+        for i in range(0, len(book_authors), LOOKUP_SIZE):
+            BookStats.objects.bulk_create(
+                [BookStats(book_id=pk) for pk in Book.objects.filter(
+                    author_id__in=book_authors[i:i + LOOKUP_SIZE],
+                    stats__isnull=True,
+                ).values_list('pk', flat=True)],
+                batch_size=LOOKUP_SIZE, ignore_conflicts=True)
+        return sum(names.get(author_key) is None for author_key, book in batch)
+
+
+class Progress:
+    '''Report the number of processed rows and their rate'''
+
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.rows = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+
+    def report(self, offset):
+        rate = self.rows / max(time.monotonic() - self.start, 1e-6)
+        message = (f'{self.name}: {self.rows} rows, {self.skipped} skipped, '
+                   f'{rate:.0f} rows/s')
+        if offset is None:
+            self.command.stdout.write(self.command.style.SUCCESS(
+                f'{message}, done.'))
+        elif self.command.verbosity:
+            self.command.stdout.write(f'{message}, resume from {offset}')
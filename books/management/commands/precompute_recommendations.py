@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import os
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from books.cache import get_cache
+from books.recommendations import precompute_recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute and cache the recommended books of the users who logged in '
+        'lately, run it after build_similarities'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            default=settings.BOOKS_RECOMMENDATIONS_ACTIVE_DAYS,
+            help='Only the users who logged in during the last days')
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Number of processes computing the recommendations')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of users whose recommendations are computed at once')
+
+    def handle(self, *args, **options):
+        if isinstance(get_cache(), LocMemCache):
+            self.stderr.write(
+                'The recommendations are cached in a local-memory cache, '
+                "which the web processes don't share, configure BOOKS_CACHE.")
+        start = time.monotonic()
+        since = timezone.now() - timedelta(days=options['days'])
+        user_ids = list(User.objects.filter(
+            last_login__gte=since).order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        batches = [user_ids[i:i + batch_size]
+                   for i in range(0, len(user_ids), batch_size)]
+
+        if options['processes'] > 1 and len(batches) > 1:
+            # the forked processes mustn't share our database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                    options['processes'], initializer=django.setup) as pool:
+                users = sum(pool.map(precompute_recommendations, batches))
+        else:
+            users = sum(map(precompute_recommendations, batches))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Recommendations of {users} users computed '
+            f'in {time.monotonic() - start:.2f} s.'))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from books.jobs import process_next_job
+from books.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = 'Process the queue of book imports from OpenLibrary'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit when there are no more due jobs')
+        parser.add_argument(
+            '--sleep', type=float, default=2,
+            help='Seconds to wait when there are no due jobs')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = process_next_job()
+            if job is not None:
+                self.report(job)
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
+
+    def report(self, job):
+        if job.status == ImportJob.DONE:
+            self.stdout.write(self.style.SUCCESS(f'{job}: done'))
+        elif job.status == ImportJob.FAILED:
+            self.stdout.write(self.style.ERROR(
+                f'{job}: failed after {job.attempts} attempt(s): '
+                f'{job.last_error}'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'{job}: will retry after {job.run_after}: {job.last_error}'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from books.models import BookStats
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the book stats (including the scores of the top rated '
+        'books) from the booklists and report any drift'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report the drift, don't fix it")
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of books processed at once')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drift = BookStats.objects.rebuild(
+                dry_run=options['dry_run'],
+                batch_size=options['batch_size'])
+
+        for old, fresh in drift:
+            if old is None:
+                self.stdout.write(f'Book {fresh.book_id}: stats were missing')
+                continue
+            self.stdout.write(
+                f'Book {fresh.book_id}: '
+                f'listings {old.listing_count} -> {fresh.listing_count}, '
+                f'ratings {old.rating_count} -> {fresh.rating_count}, '
+                f'rating sum {old.rating_sum} -> {fresh.rating_sum}, '
+                f'score {old.score:.4f} -> {fresh.score:.4f}'
+            )
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('No drift found.'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(
+                f'Found drift in {len(drift)} book(s), nothing changed.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Fixed drift in {len(drift)} book(s).'))
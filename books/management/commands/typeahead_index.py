@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books.typeahead import build_index
+
+
+class Command(BaseCommand):
+    help = 'Build the index of the search suggestions and report its size'
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        index = build_index()
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'{len(index)} entries (maximum {index.max_entries}), '
+            f'{index.memory_usage() / 1024 / 1024:.1f} MiB, '
+            f'built in {elapsed:.2f} s')
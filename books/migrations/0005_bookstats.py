@@ -0,0 +1,50 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_book_stats(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    BookStats = apps.get_model('books', 'BookStats')
+    books = Book.objects.annotate(
+        listing_count=models.Count('booklist'),
+        rating_sum=models.Sum('booklist__rating'),
+        rating_count=models.Count('booklist__rating'),
+    ).values_list('pk', 'listing_count', 'rating_sum', 'rating_count')
+    BookStats.objects.bulk_create(
+        (
+            BookStats(
+                book_id=book_id, listing_count=listing_count,
+                rating_sum=rating_sum or 0, rating_count=rating_count,
+                average_rating=(
+                    rating_sum / rating_count if rating_count else None)
+            ) for book_id, listing_count, rating_sum, rating_count in books
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0004_booklist_override_cover'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='books.book')),
+                ('listing_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('average_rating', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'book stats',
+            },
+        ),
+        migrations.RunPython(
+            populate_book_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0005_bookstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['last_name'], name='author_last_name_idx'),
+        ),
+    ]
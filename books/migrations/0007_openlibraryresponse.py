@@ -0,0 +1,32 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0006_author_last_name_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenLibraryResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('search', 'search results'), ('book', 'book data')], max_length=10)),
+                ('key', models.CharField(max_length=200)),
+                ('data', models.JSONField()),
+                ('fetched', models.DateTimeField()),
+                ('last_used', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='openlibraryresponse',
+            index=models.Index(fields=['kind', 'last_used'], name='openlibrary_lru_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='openlibraryresponse',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='unique_openlibrary_response'),
+        ),
+    ]
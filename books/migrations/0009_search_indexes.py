@@ -0,0 +1,43 @@
+# Generated by Django 3.1.12 on 2026-10-18 15:02
+
+from django.db import migrations
+
+# the expressions have to be the same as the ones in books/search.py
+CREATE_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    "CREATE INDEX book_title_search_idx ON books_book "
+    "USING gin (to_tsvector('english', title))",
+    'CREATE INDEX book_title_trgm_idx ON books_book '
+    'USING gin (title gin_trgm_ops)',
+    "CREATE INDEX author_name_search_idx ON books_author "
+    "USING gin (to_tsvector('english', first_name || ' ' || last_name))",
+]
+DROP_INDEXES = [
+    'DROP INDEX IF EXISTS book_title_search_idx',
+    'DROP INDEX IF EXISTS book_title_trgm_idx',
+    'DROP INDEX IF EXISTS author_name_search_idx',
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # the other databases use the inverted index of books/search.py
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in CREATE_INDEXES:
+            schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in DROP_INDEXES:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0008_importjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
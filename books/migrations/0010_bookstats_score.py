@@ -0,0 +1,38 @@
+# Generated by Django 3.1.12 on 2026-10-18 15:31
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+
+def populate_scores(apps, schema_editor):
+    BookStats = apps.get_model('books', 'BookStats')
+    prior_votes = settings.BOOKS_RATING_PRIOR_VOTES
+    prior_sum = prior_votes * settings.BOOKS_RATING_PRIOR_MEAN
+    BookStats.objects.filter(rating_count__gt=0).update(
+        score=models.ExpressionWrapper(
+            (Cast('rating_sum', models.FloatField()) + prior_sum)
+            / (models.F('rating_count') + prior_votes),
+            output_field=models.FloatField()
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0009_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookstats',
+            name='score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='bookstats',
+            index=models.Index(fields=['-score', '-listing_count'], name='bookstats_score_idx'),
+        ),
+        migrations.RunPython(populate_scores, migrations.RunPython.noop),
+    ]
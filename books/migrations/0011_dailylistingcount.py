@@ -0,0 +1,51 @@
+# Generated by Django 3.1.12 on 2026-10-18 16:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import TruncDate
+
+
+def count_daily_listings(apps, schema_editor):
+    BookList = apps.get_model('books', 'BookList')
+    DailyListingCount = apps.get_model('books', 'DailyListingCount')
+    counts = BookList.objects.annotate(
+        day=TruncDate('added'),
+    ).values('book_id', 'day').annotate(
+        count=models.Count('pk'),
+    ).order_by().values_list('book_id', 'day', 'count')
+    DailyListingCount.objects.bulk_create(
+        (
+            DailyListingCount(book_id=book_id, day=day, count=count)
+            for book_id, day, count in counts
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0010_bookstats_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyListingCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_listings', to='books.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dailylistingcount',
+            index=models.Index(fields=['day'], name='dailylistingcount_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailylistingcount',
+            constraint=models.UniqueConstraint(fields=('book', 'day'), name='unique_daily_listing_count'),
+        ),
+        migrations.RunPython(
+            count_daily_listings, migrations.RunPython.noop),
+    ]
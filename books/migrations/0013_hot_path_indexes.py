@@ -0,0 +1,55 @@
+# Generated by Django 3.1.12 on 2026-10-18 17:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('books', '0012_booksimilarity'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='author',
+            name='author_last_name_idx',
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['last_name', 'first_name'], name='author_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['added'], name='book_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booklist',
+            index=models.Index(fields=['book', 'rating'], name='booklist_book_rating_idx'),
+        ),
+        # the index above starts with the book, unique_booklist with the user
+        migrations.AlterField(
+            model_name='booklist',
+            name='book',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='books.book'),
+        ),
+        migrations.AlterField(
+            model_name='booklist',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='booklist',
+            index=models.Index(fields=['updated'], name='booklist_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookstats',
+            index=models.Index(fields=['-listing_count', 'book'], name='bookstats_listings_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookstats',
+            index=models.Index(condition=models.Q(similarities_stale=True), fields=['book'], name='bookstats_stale_idx'),
+        ),
+    ]
@@ -1,5 +1,18 @@
+from datetime import timedelta
+
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import (
+    Case, Count, F, FloatField, IntegerField, Sum, Value, When
+)
+from django.db.models.expressions import ExpressionWrapper
+from django.db.models.functions import Cast, Coalesce, Concat, NullIf
+from django.dispatch import Signal
+from django.utils import timezone
+
+# sent by BookList.objects.rate() (which doesn't send post_save) with the user
+# and the new ratings by booklist id
+booklist_rated = Signal()
 
 
 class Author(models.Model):
@@ -11,6 +24,13 @@ class Author(models.Model):
             models.UniqueConstraint(
                 fields=['first_name', 'last_name'], name='unique_author')
         ]
+        indexes = [
+            # booklists are ordered by the author's last name, then the title
+            # (unique_book already indexes books by author and title), the
+            # authors by their last then first name
+            models.Index(
+                fields=['last_name', 'first_name'], name='author_name_idx'),
+        ]
 
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
@@ -30,25 +50,119 @@ class Book(models.Model):
                 fields=['author', 'title', 'first_published'],
                 name='unique_book')
         ]
+        indexes = [
+            # the recent books and the last modification of the dashboard
+            models.Index(fields=['added'], name='book_added_idx'),
+        ]
 
     def __str__(self):
         return f'{self.author}: {self.title}'
 
     @property
     def number_of_listings(self):
-        '''Calculates how many times was a book listed by users'''
-        self._number_of_listings = self.booklist_set.count()
+        '''How many times was a book listed by users'''
+        self._number_of_listings = self.get_stats().listing_count
         return self._number_of_listings
 
     @property
     def average_rating(self):
-        '''Calculates average rating'''
-        self._average_rating = self.booklist_set.aggregate(
-            models.Avg('rating'))['rating__avg']
+        '''Average rating of the book, None if it wasn't rated yet'''
+        self._average_rating = self.get_stats().average_rating
         return self._average_rating
 
+    def get_stats(self):
+        '''Get the denormalized stats of the book
+
+        Books created without signals (e.g. with bulk_create) may not have
+        stats yet, these are built from the booklists on first access.
+        '''
+        try:
+            return self.stats
+        except BookStats.DoesNotExist:
+            BookStats.objects.rebuild(book_ids=[self.pk])
+            self.stats = BookStats.objects.get(book_id=self.pk)
+            return self.stats
+
     def add_to_booklist(self, user, rating=None):
-        return self.booklist_set.get_or_create(user=user, rating=rating)
+        '''Get or create the booklist of the user for the book
+
+        A book already on the list keeps its rating.
+        '''
+        return self.booklist_set.get_or_create(
+            user=user, defaults={'rating': rating})
+
+
+class BookListManager(models.Manager):
+
+    def resolve_overrides(self):
+        '''Annotate what the booklists show in place of their book's
+
+        The title, author, year and cover are the overrides of the booklist,
+        the book's when they're empty, like get_title() and the other getters
+        but without loading the books.
+        '''
+        return self.annotate(
+            listed_title=Coalesce(
+                NullIf('override_title', Value('')), 'book__title'),
+            listed_author=Coalesce(
+                NullIf('override_author', Value('')),
+                Concat('book__author__first_name', Value(' '),
+                       'book__author__last_name')),
+            listed_year=Coalesce(
+                NullIf('override_year', Value(0)), 'book__first_published'),
+            listed_cover=Coalesce(
+                NullIf('override_cover', Value('')), 'book__cover'),
+        )
+
+    def rate(self, user, ratings):
+        '''Set the ratings of some of the user's booklist items
+
+        The ratings are written with a single UPDATE, only the rating and the
+        updated time are changed. The stats of the books are shifted by the
+        differences to the previous ratings.
+
+        Params:
+            ratings(dict): the new ratings by booklist id
+        Returns:
+            ratings(dict): the ratings of the user's items by booklist id,
+                the ids of other users' items are left out
+        '''
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            old_ratings = {
+                pk: (book_id, rating)
+                for pk, book_id, rating in self.using(using).filter(
+                    user=user, pk__in=ratings,
+                ).select_for_update().values_list('pk', 'book_id', 'rating')
+            }
+            changed = {
+                pk: ratings[pk] for pk, (_, rating) in old_ratings.items()
+                if rating != ratings[pk]
+            }
+            if not changed:
+                return {pk: ratings[pk] for pk in old_ratings}
+            self.using(using).filter(pk__in=changed).update(
+                rating=Case(
+                    *(When(pk=pk, then=Value(rating))
+                      for pk, rating in changed.items()),
+                    output_field=IntegerField()
+                ),
+                updated=timezone.now()
+            )
+
+            deltas = {}
+            for pk, rating in changed.items():
+                book_id, old_rating = old_ratings[pk]
+                delta = deltas.setdefault(
+                    book_id, {'rating_sum': 0, 'ratings': 0})
+                delta['rating_sum'] += rating - (old_rating or 0)
+                delta['ratings'] += old_rating is None
+            for book_id, delta in deltas.items():
+                BookStats.objects.db_manager(using).apply_delta(
+                    book_id, **delta)
+
+        booklist_rated.send(sender=self.model, user=user, ratings=changed)
+        return {pk: ratings[pk] for pk in old_ratings}
 
 
 class BookList(models.Model):
@@ -59,11 +173,14 @@ class BookList(models.Model):
         (4, '4'),
         (5, '5'),
     )
+    # indexed by unique_booklist
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
+        db_index=False,
     )
-    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    # indexed by booklist_book_rating_idx
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, db_index=False)
     rating = models.IntegerField(choices=RATING_CHOICES, null=True, blank=True)
     override_title = models.CharField(max_length=50, blank=True)
     override_author = models.CharField(max_length=50, blank=True)
@@ -73,15 +190,44 @@ class BookList(models.Model):
     added = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = BookListManager()
+
+    # (book_id, rating) as last read from or written to the database,
+    # used to work out how a save changes the stats of the book
+    _stats_state = None
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=['user', 'book'], name='unique_booklist')
         ]
+        # unique_booklist indexes the lists of the users
+        indexes = [
+            # the listings and ratings of the books, summed by their stats
+            models.Index(
+                fields=['book', 'rating'], name='booklist_book_rating_idx'),
+            # the last modification of the dashboard
+            models.Index(fields=['updated'], name='booklist_updated_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} lists {self.book}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'book_id' in field_names and 'rating' in field_names:
+            instance._stats_state = (instance.book_id, instance.rating)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # the stats of the book are updated by a post_save receiver,
+        # run it in the same transaction as the save itself
+        using = kwargs.get('using') or router.db_for_write(
+            type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
     def get_title(self):
         return self.override_title if self.override_title else self.book.title
 
@@ -99,3 +245,322 @@ class BookList(models.Model):
             return self.override_year
         else:
             return self.book.first_published
+
+
+class BookStatsManager(models.Manager):
+
+    def apply_delta(self, book_id, listings=0, rating_sum=0, ratings=0):
+        '''Shift the counters of a book by the given amounts
+
+        This is a single UPDATE relative to the stored values, so concurrent
+        writers can't overwrite each other's changes. The average and the
+        score are derived from the new sum and count in the same statement.
+        '''
+        if not (listings or rating_sum or ratings):
+            return
+        prior_votes, prior_sum = get_rating_prior()
+        if listings:
+            # the neighbours of the book are recomputed by the next
+            # build_similarities, see books.recommendations
+            extra = {'similarities_stale': True}
+        else:
+            extra = {}
+        self.filter(book_id=book_id).update(
+            **extra,
+            listing_count=F('listing_count') + listings,
+            rating_sum=F('rating_sum') + rating_sum,
+            rating_count=F('rating_count') + ratings,
+            average_rating=ExpressionWrapper(
+                Cast(F('rating_sum') + rating_sum, FloatField())
+                / NullIf(F('rating_count') + ratings, 0),
+                output_field=FloatField()
+            ),
+            score=Case(
+                When(rating_count__gt=-ratings, then=ExpressionWrapper(
+                    (Cast(F('rating_sum') + rating_sum, FloatField())
+                     + prior_sum)
+                    / (F('rating_count') + ratings + prior_votes),
+                    output_field=FloatField()
+                )),
+                default=Value(0.0),
+                output_field=FloatField()
+            )
+        )
+
+    def rebuild(self, book_ids=None, dry_run=False, batch_size=1000):
+        '''Recalculate the stats from the booklists
+
+        Params:
+            book_ids(iterable): only rebuild these books, all if None
+            dry_run(bool): only look for drift, don't write anything
+            batch_size(int): number of books processed at once
+        Returns:
+            drift(list): (stored, recalculated) pairs of BookStats which
+                didn't match, stored is None if the row was missing
+        '''
+        books = Book.objects.order_by('pk')
+        if book_ids is not None:
+            books = books.filter(pk__in=book_ids)
+        fresh_values = books.annotate(
+            listing_count=Count('booklist'),
+            rating_sum=Sum('booklist__rating'),
+            rating_count=Count('booklist__rating'),
+        ).values_list('pk', 'listing_count', 'rating_sum', 'rating_count')
+
+        drift = []
+        batch = []
+        for values in fresh_values.iterator(chunk_size=batch_size):
+            batch.append(values)
+            if len(batch) >= batch_size:
+                drift += self._rebuild_batch(batch, dry_run)
+                batch = []
+        if batch:
+            drift += self._rebuild_batch(batch, dry_run)
+        return drift
+
+    def _rebuild_batch(self, batch, dry_run):
+        stored = self.in_bulk([values[0] for values in batch])
+        drift = []
+        for book_id, listing_count, rating_sum, rating_count in batch:
+            fresh = BookStats(
+                book_id=book_id, listing_count=listing_count,
+                rating_sum=rating_sum or 0, rating_count=rating_count)
+            fresh.average_rating = fresh.calculate_average()
+            fresh.score = fresh.calculate_score()
+            old = stored.get(book_id)
+            if old is None or not old.matches(fresh):
+                drift.append((old, fresh))
+        if not dry_run:
+            self.bulk_create(
+                [fresh for old, fresh in drift if old is None])
+            self.bulk_update(
+                [fresh for old, fresh in drift if old is not None],
+                # the listings drifted, so their similar books may have too
+                ['listing_count', 'rating_sum', 'rating_count',
+                 'average_rating', 'score', 'similarities_stale'])
+        return drift
+
+
+def get_rating_prior():
+    '''Prior of the rating scores: (number of votes, sum of their ratings)'''
+    votes = settings.BOOKS_RATING_PRIOR_VOTES
+    return votes, votes * settings.BOOKS_RATING_PRIOR_MEAN
+
+
+class BookStats(models.Model):
+    '''Listing and rating counters of a book
+
+    Kept up to date incrementally whenever a booklist is created, rated or
+    deleted (see books.signals), so reading them doesn't need to aggregate
+    the booklists.
+
+    The score is the Bayesian average of the ratings, the ratings of the book
+    with BOOKS_RATING_PRIOR_VOTES more votes of BOOKS_RATING_PRIOR_MEAN, so a
+    book with a few high ratings doesn't outrank a book with many of them.
+    '''
+    book = models.OneToOneField(
+        Book, on_delete=models.CASCADE, primary_key=True,
+        related_name='stats')
+    listing_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    average_rating = models.FloatField(null=True, blank=True)
+    # 0 for books without ratings, so they're ranked last
+    score = models.FloatField(default=0)
+    # set when the book is listed or unlisted, so only the books whose
+    # listings changed get their similar books recomputed
+    similarities_stale = models.BooleanField(default=True)
+
+    objects = BookStatsManager()
+
+    class Meta:
+        verbose_name_plural = 'book stats'
+        indexes = [
+            # the top rated books are read in the order of this index
+            models.Index(
+                fields=['-score', '-listing_count'],
+                name='bookstats_score_idx'),
+            # the most read books are read in the order of this index
+            models.Index(
+                fields=['-listing_count', 'book'],
+                name='bookstats_listings_idx'),
+            # the few stale books, claimed by build_similarities
+            models.Index(
+                fields=['book'], condition=models.Q(similarities_stale=True),
+                name='bookstats_stale_idx'),
+        ]
+
+    def __str__(self):
+        return f'Stats of {self.book}'
+
+    def calculate_average(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
+    def calculate_score(self):
+        if not self.rating_count:
+            return 0.0
+        prior_votes, prior_sum = get_rating_prior()
+        return (self.rating_sum + prior_sum) / (
+            self.rating_count + prior_votes)
+
+    def matches(self, other):
+        '''Check if two stats hold the same numbers'''
+        if (self.listing_count, self.rating_sum, self.rating_count) != (
+                other.listing_count, other.rating_sum, other.rating_count):
+            return False
+        if abs(self.score - other.score) >= 1e-9:
+            return False
+        if self.average_rating is None or other.average_rating is None:
+            return self.average_rating == other.average_rating
+        return abs(self.average_rating - other.average_rating) < 1e-9
+
+
+class DailyListingCountManager(models.Manager):
+
+    def increment(self, book_id, day):
+        '''Count a new listing of the book on the day'''
+        if self.filter(book_id=book_id, day=day).update(count=F('count') + 1):
+            return
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(book_id=book_id, day=day, count=1)
+        except IntegrityError:
+            # created by a concurrent listing in the meantime
+            self.filter(book_id=book_id, day=day).update(
+                count=F('count') + 1)
+
+    def prune(self, today):
+        '''Delete the counts of the days before the trending window
+
+        Returns:
+            deleted(int): number of counts deleted
+        '''
+        first_day = today - timedelta(days=settings.BOOKS_TRENDING_DAYS - 1)
+        deleted, _ = self.filter(day__lt=first_day).delete()
+        return deleted
+
+
+class DailyListingCount(models.Model):
+    '''Number of times a book was added to the lists on a day
+
+    Counted when the booklists are created (see books.signals), so the
+    trending books are summed from the counts of the last few days instead
+    of the booklists. Removing a book from a list doesn't change the counts.
+    The counts older than the trending window are pruned once a day.
+    '''
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name='daily_listings')
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    objects = DailyListingCountManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['book', 'day'], name='unique_daily_listing_count')
+        ]
+        indexes = [
+            models.Index(fields=['day'], name='dailylistingcount_day_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book} listed {self.count} time(s) on {self.day}'
+
+
+class BookSimilarity(models.Model):
+    '''A book listed by the readers of another book
+
+    Only the top BOOKS_SIMILAR_BOOKS neighbours of each book are stored, by
+    rank, see books.recommendations.
+    '''
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name='similarities')
+    similar_book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name='+')
+    # 0 for the most similar book
+    rank = models.PositiveSmallIntegerField()
+    # cosine similarity of the readers of both books
+    score = models.FloatField()
+
+    class Meta:
+        verbose_name_plural = 'book similarities'
+        constraints = [
+            # also the index the similar books are read with
+            models.UniqueConstraint(
+                fields=['book', 'rank'], name='unique_book_similarity_rank')
+        ]
+
+    def __str__(self):
+        return f'{self.similar_book} similar to {self.book} ({self.score:.2f})'
+
+
+class OpenLibraryResponse(models.Model):
+    '''Cached response of the OpenLibrary API, see books.openlibrary'''
+    SEARCH = 'search'
+    BOOK = 'book'
+    KIND_CHOICES = (
+        (SEARCH, 'search results'),
+        (BOOK, 'book data'),
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # normalized search query or OpenLibrary ID
+    key = models.CharField(max_length=200)
+    data = models.JSONField()
+    fetched = models.DateTimeField()
+    last_used = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'key'], name='unique_openlibrary_response')
+        ]
+        indexes = [
+            models.Index(
+                fields=['kind', 'last_used'],
+                name='openlibrary_lru_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} for {self.key}'
+
+
+class ImportJob(models.Model):
+    '''Import of a book from OpenLibrary to a user's list
+
+    The jobs are processed by the process_import_jobs command, see books.jobs.
+    '''
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    # OpenLibrary ID of the edition
+    olid = models.CharField(max_length=20)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    booklist = models.ForeignKey(
+        BookList, on_delete=models.SET_NULL, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'run_after'], name='importjob_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'Import of {self.olid} for {self.user.username}'
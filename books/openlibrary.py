@@ -0,0 +1,548 @@
+'''Client of the OpenLibrary API
+
+All the calls go through one pooled requests session with connect and read
+timeouts and bounded retries. A circuit breaker stops calling OpenLibrary for
+a while after repeated failures, so a struggling upstream makes the search
+fail fast instead of tying up the workers.
+
+search() and get_book() keep the responses in the database (see
+OpenLibraryResponse), each kind with its own time to live and a maximum
+number of entries, the least recently used ones are evicted above that.
+The searches also get the details of their top editions (see
+get_search_details() and search_async()), which are cached like the ones
+of get_book(), so adding a book found by a search doesn't call the API
+again.
+
+For ASGI deployments there is an asynchronous client too (using httpx), see
+search_async(), which gets the details of the top editions concurrently.
+
+Settings:
+    OPENLIBRARY_URL: base URL of the API
+    OPENLIBRARY_CONNECT_TIMEOUT, OPENLIBRARY_READ_TIMEOUT: in seconds
+    OPENLIBRARY_RETRIES: how many times a failed request is retried
+    OPENLIBRARY_BACKOFF: backoff factor between the retries, in seconds
+    OPENLIBRARY_POOL_SIZE: number of connections kept alive
+    OPENLIBRARY_FAILURE_THRESHOLD: failures in a row which open the circuit
+    OPENLIBRARY_RESET_TIMEOUT: how long the circuit stays open, in seconds
+    OPENLIBRARY_SEARCH_CACHE_TTL, OPENLIBRARY_BOOK_CACHE_TTL: how long are
+        the responses cached, in seconds
+    OPENLIBRARY_CACHE_MAX_ENTRIES: maximum number of cached responses
+        of each kind
+'''
+
+import asyncio
+from datetime import timedelta
+import hashlib
+import re
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bookr.metrics import record_upstream
+from .models import Author, Book, OpenLibraryResponse
+
+COVER_URL = 'https://covers.openlibrary.org/b/id/{}-M.jpg'
+YEAR = re.compile(r'\d{4}')
+RETRY_STATUSES = (500, 502, 503, 504)
+# don't write the last use of a cached response more often than this
+LAST_USED_PRECISION = timedelta(minutes=1)
+
+
+class OpenLibraryError(Exception):
+    '''OpenLibrary couldn't be reached or sent an unexpected response'''
+
+
+class OpenLibraryUnavailable(OpenLibraryError):
+    '''OpenLibrary isn't called at all, as it failed too many times lately'''
+
+
+class InvalidBookData(OpenLibraryError):
+    '''The book is missing or incomplete, asking again won't help'''
+
+
+class CircuitBreaker:
+    '''Stop calling a failing service for a while
+
+    After failure_threshold failures in a row the circuit opens and no calls
+    are allowed for reset_timeout seconds. Then a single trial call is let
+    through (half-open state): if it succeeds the circuit closes, otherwise
+    it opens again. A trial which neither succeeded nor failed (e.g. it was
+    interrupted) is ended with end_trial(), the next call is the trial.
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running:
+                return False
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or (
+                    self.failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+
+    def end_trial(self):
+        with self.lock:
+            self.trial_running = False
+
+
+class OpenLibraryClient:
+
+    def __init__(
+            self, base_url, connect_timeout, read_timeout, retries=2,
+            backoff_factor=0.3, pool_size=10, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker(5, 30)
+        retry = Retry(
+            total=retries, backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES, raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, params):
+        '''Get a JSON document from the API
+
+        Raises:
+            OpenLibraryUnavailable: the circuit breaker is open
+            OpenLibraryError: the request failed, even after the retries
+        '''
+        if not self.breaker.allow_request():
+            raise OpenLibraryUnavailable('OpenLibrary is unavailable')
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                f'{self.base_url}{path}', params=params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            self.breaker.record_failure()
+            raise OpenLibraryError(str(e)) from e
+        else:
+            self.breaker.record_success()
+        finally:
+            record_upstream(time.perf_counter() - start)
+            # an unexpected error mustn't leave the circuit half-open
+            self.breaker.end_trial()
+        return data
+
+    def search(self, q, limit=10):
+        '''Search for books, return the matching documents'''
+        data = self.get('/search.json', {'q': q})
+        try:
+            return data['docs'][:limit]
+        except (KeyError, TypeError) as e:
+            raise OpenLibraryError('Unexpected search response') from e
+
+    def get_book(self, olid):
+        '''Get the data of an edition by its OpenLibrary ID'''
+        data = self.get(
+            '/api/books', {'bibkeys': olid, 'format': 'json', 'jscmd': 'data'})
+        try:
+            return data[olid]
+        except (KeyError, TypeError) as e:
+            raise InvalidBookData(f'Book {olid} not found') from e
+
+    def get_books(self, olids):
+        '''Get the data of several editions in one request
+
+        Returns:
+            books(dict): OpenLibrary ID -> data, the ones not found are missing
+        '''
+        data = self.get('/api/books', {
+            'bibkeys': ','.join(olids), 'format': 'json', 'jscmd': 'data'})
+        if not isinstance(data, dict):
+            raise OpenLibraryError('Unexpected books response')
+        return {olid: data[olid] for olid in olids if olid in data}
+
+
+class AsyncOpenLibraryClient:
+    '''Asynchronous counterpart of OpenLibraryClient
+
+    httpx has no retries on responses, so these are done here, with the
+    same backoff as urllib3's.
+    '''
+
+    def __init__(
+            self, base_url, connect_timeout, read_timeout, retries=2,
+            backoff_factor=0.3, pool_size=10, breaker=None):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker or CircuitBreaker(5, 30)
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip('/'),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size)
+        )
+
+    async def get(self, path, params):
+        '''Get a JSON document from the API, see OpenLibraryClient.get'''
+        if not self.breaker.allow_request():
+            raise OpenLibraryUnavailable('OpenLibrary is unavailable')
+        try:
+            for attempt in range(self.retries + 1):
+                retry = attempt < self.retries
+                start = time.perf_counter()
+                try:
+                    response = await self.client.get(path, params=params)
+                    if retry and response.status_code in RETRY_STATUSES:
+                        await self._backoff(attempt)
+                        continue
+                    response.raise_for_status()
+                    data = response.json()
+                except httpx.TransportError as e:
+                    if retry:
+                        await self._backoff(attempt)
+                        continue
+                    self.breaker.record_failure()
+                    raise OpenLibraryError(str(e)) from e
+                except (httpx.HTTPStatusError, ValueError) as e:
+                    self.breaker.record_failure()
+                    raise OpenLibraryError(str(e)) from e
+                finally:
+                    record_upstream(time.perf_counter() - start)
+                self.breaker.record_success()
+                return data
+        finally:
+            # e.g. the task was cancelled, see OpenLibraryClient.get
+            self.breaker.end_trial()
+
+    async def _backoff(self, attempt):
+        await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def search(self, q, limit=10):
+        data = await self.get('/search.json', {'q': q})
+        try:
+            return data['docs'][:limit]
+        except (KeyError, TypeError) as e:
+            raise OpenLibraryError('Unexpected search response') from e
+
+    async def get_book(self, olid):
+        data = await self.get(
+            '/api/books', {'bibkeys': olid, 'format': 'json', 'jscmd': 'data'})
+        try:
+            return data[olid]
+        except (KeyError, TypeError) as e:
+            raise InvalidBookData(f'Book {olid} not found') from e
+
+
+def split_name(name):
+    '''Split the name of an author to first and last name'''
+    # assume that the last word is the last name
+    name = name.rsplit(' ', 1)
+    return tuple(name) if len(name) == 2 else ('', name[0])
+
+
+def parse_year(date):
+    '''The year of a publish date, some are full dates, some just years
+
+    Raises:
+        ValueError: there's no year in the date
+    '''
+    match = YEAR.search(date)
+    if match is None:
+        raise ValueError(f'No year in {date!r}')
+    return int(match.group())
+
+
+def parse_book(data):
+    '''Extract the fields of our models from the data of an edition
+
+    Returns:
+        book(dict): first_name, last_name, title, first_published and cover
+    Raises:
+        OpenLibraryError: some of the required data are missing
+    '''
+    try:
+        first_name, last_name = split_name(data['authors'][0]['name'])
+        first_published = parse_year(data['publish_date'])
+        title = data['title']
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise InvalidBookData('Incomplete book data') from e
+    return {
+        'first_name': first_name,
+        'last_name': last_name,
+        'title': title,
+        'first_published': first_published,
+        'cover': data.get('cover', {}).get('medium', ''),
+    }
+
+
+def import_book(user, book):
+    '''Add a book parsed by parse_book to the user's list
+
+    The author and the book are created if they aren't in the db yet.
+    '''
+    # check if the author in already the db
+    # if not, add it
+    author, a_created = Author.objects.get_or_create(
+        first_name=book['first_name'], last_name=book['last_name'])
+    # check if we book is already in the db
+    # if not, add it
+    book_obj, b_created = Book.objects.get_or_create(
+        author=author, title=book['title'],
+        first_published=book['first_published'])
+    if b_created and book['cover']:
+        book_obj.cover = book['cover']
+        book_obj.save()
+    return book_obj.add_to_booklist(user)
+
+
+def get_doc_olid(doc):
+    '''Get the OpenLibrary ID of the edition representing a search result'''
+    if 'cover_edition_key' in doc:
+        return doc['cover_edition_key']
+    return doc['edition_key'][0]
+
+
+def get_doc_olids(docs):
+    '''Get the OpenLibrary IDs of the search results which have one'''
+    olids = []
+    for doc in docs:
+        try:
+            olids.append(get_doc_olid(doc))
+        except (KeyError, IndexError, TypeError):
+            continue
+    return olids
+
+
+def normalize_query(q):
+    '''Normalize a search query, so trivially different ones share the cache
+
+    Queries too long to be a key are replaced by their hash.
+    '''
+    q = ' '.join(q.lower().split())
+    if len(q) > 200:
+        q = hashlib.sha256(q.encode()).hexdigest()
+    return q
+
+
+def search(q):
+    '''Search for books on OpenLibrary, use the cached results if possible'''
+    key = normalize_query(q)
+    docs = _get_cached(OpenLibraryResponse.SEARCH, key)
+    if docs is None:
+        docs = get_client().search(q)
+        _set_cached(OpenLibraryResponse.SEARCH, key, docs)
+    return docs
+
+
+def get_book(olid):
+    '''Get the data of an edition, use the cached data if possible'''
+    book = _get_cached(OpenLibraryResponse.BOOK, olid)
+    if book is None:
+        book = get_client().get_book(olid)
+        _set_cached(OpenLibraryResponse.BOOK, olid, book)
+    return book
+
+
+def get_search_details(docs, details=5):
+    '''Get the details of the top editions of search results
+
+    The editions which aren't cached yet are fetched in one request.
+
+    Returns:
+        books(dict): OpenLibrary ID -> data of the top editions, those which
+            couldn't be fetched are missing
+    '''
+    olids = get_doc_olids(docs[:details])
+    books = _get_cached_many(OpenLibraryResponse.BOOK, olids)
+    missing = [olid for olid in olids if olid not in books]
+    if missing:
+        try:
+            fetched = get_client().get_books(missing)
+        except OpenLibraryError:
+            fetched = {}
+        for olid, book in fetched.items():
+            books[olid] = book
+            _set_cached(OpenLibraryResponse.BOOK, olid, book)
+    return books
+
+
+async def search_async(q, details=5):
+    '''Search for books and get the details of the top editions
+
+    The details of the editions are fetched concurrently, unless they are
+    cached already.
+
+    Returns:
+        docs(list): the search results
+        books(dict): OpenLibrary ID -> data of the top editions, those which
+            couldn't be fetched are missing
+    '''
+    client = get_async_client()
+    key = normalize_query(q)
+    docs = await sync_to_async(_get_cached)(OpenLibraryResponse.SEARCH, key)
+    if docs is None:
+        docs = await client.search(q)
+        await sync_to_async(_set_cached)(
+            OpenLibraryResponse.SEARCH, key, docs)
+
+    olids = get_doc_olids(docs[:details])
+    books = await sync_to_async(_get_cached_many)(
+        OpenLibraryResponse.BOOK, olids)
+    missing = [olid for olid in olids if olid not in books]
+    fetched = await asyncio.gather(
+        *(client.get_book(olid) for olid in missing),
+        return_exceptions=True
+    )
+    for olid, book in zip(missing, fetched):
+        if isinstance(book, OpenLibraryError):
+            books.pop(olid, None)
+        elif isinstance(book, BaseException):
+            raise book
+        else:
+            books[olid] = book
+            await sync_to_async(_set_cached)(
+                OpenLibraryResponse.BOOK, olid, book)
+    return docs, books
+
+
+def _get_ttl(kind):
+    if kind == OpenLibraryResponse.SEARCH:
+        return timedelta(seconds=settings.OPENLIBRARY_SEARCH_CACHE_TTL)
+    return timedelta(seconds=settings.OPENLIBRARY_BOOK_CACHE_TTL)
+
+
+def _get_cached(kind, key):
+    now = timezone.now()
+    cached = OpenLibraryResponse.objects.filter(
+        kind=kind, key=key, fetched__gt=now - _get_ttl(kind)).first()
+    if cached is None:
+        return None
+    if cached.last_used < now - LAST_USED_PRECISION:
+        OpenLibraryResponse.objects.filter(pk=cached.pk).update(last_used=now)
+    return cached.data
+
+
+def _get_cached_many(kind, keys):
+    now = timezone.now()
+    cached = OpenLibraryResponse.objects.filter(
+        kind=kind, key__in=keys, fetched__gt=now - _get_ttl(kind))
+    data = {}
+    for response in cached:
+        data[response.key] = response.data
+    cached.filter(last_used__lt=now - LAST_USED_PRECISION).update(
+        last_used=now)
+    return data
+
+
+def _set_cached(kind, key, data):
+    now = timezone.now()
+    OpenLibraryResponse.objects.update_or_create(
+        kind=kind, key=key,
+        defaults={'data': data, 'fetched': now, 'last_used': now})
+    _evict(kind)
+
+
+def _evict(kind):
+    '''Delete the least recently used responses above the maximum'''
+    responses = OpenLibraryResponse.objects.filter(kind=kind)
+    cutoff = responses.order_by('-last_used', '-pk').values_list(
+        'last_used', 'pk')[
+            settings.OPENLIBRARY_CACHE_MAX_ENTRIES - 1:
+            settings.OPENLIBRARY_CACHE_MAX_ENTRIES]
+    if cutoff:
+        last_used, pk = cutoff[0]
+        responses.filter(
+            Q(last_used__lt=last_used) | Q(last_used=last_used, pk__lt=pk)
+        ).delete()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''Get the client shared by the whole process'''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenLibraryClient(
+                settings.OPENLIBRARY_URL,
+                connect_timeout=settings.OPENLIBRARY_CONNECT_TIMEOUT,
+                read_timeout=settings.OPENLIBRARY_READ_TIMEOUT,
+                retries=settings.OPENLIBRARY_RETRIES,
+                backoff_factor=settings.OPENLIBRARY_BACKOFF,
+                pool_size=settings.OPENLIBRARY_POOL_SIZE,
+                breaker=CircuitBreaker(
+                    settings.OPENLIBRARY_FAILURE_THRESHOLD,
+                    settings.OPENLIBRARY_RESET_TIMEOUT)
+            )
+        return _client
+
+
+# an httpx client can't be shared by event loops
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    '''Get the asynchronous client of the running event loop
+
+    It shares the circuit breaker with the synchronous client.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOpenLibraryClient(
+            settings.OPENLIBRARY_URL,
+            connect_timeout=settings.OPENLIBRARY_CONNECT_TIMEOUT,
+            read_timeout=settings.OPENLIBRARY_READ_TIMEOUT,
+            retries=settings.OPENLIBRARY_RETRIES,
+            backoff_factor=settings.OPENLIBRARY_BACKOFF,
+            pool_size=settings.OPENLIBRARY_POOL_SIZE,
+            breaker=get_client().breaker
+        )
+    return client
+
+
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    global _client
+    if setting.startswith('OPENLIBRARY_'):
+        with _client_lock:
+            _client = None
+        _async_clients.clear()
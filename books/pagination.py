@@ -0,0 +1,158 @@
+'''Keyset (cursor) pagination
+
+Instead of an OFFSET, which makes the database walk all the skipped rows,
+each page starts right after the ordering values of the last row of the
+previous page. Fetching a page costs the same no matter how deep it is.
+'''
+
+import base64
+import binascii
+import json
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Decode a cursor, return None if it's not valid'''
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def get_field(model, lookup):
+    '''The model field of a lookup, e.g. author__last_name'''
+    *relations, name = lookup.split('__')
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    return model._meta.pk if name == 'pk' else model._meta.get_field(name)
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, previous_cursor, next_cursor):
+        self.object_list = object_list
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+
+class KeysetPaginator:
+    '''Paginate a queryset by the values of its ordering
+
+    Params:
+        queryset(QuerySet): the objects to paginate
+        ordering(tuple): ascending field lookups, the last one must be unique
+            (e.g. the pk) so the ordering is total
+        per_page(int): maximum number of objects on a page
+    '''
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        '''Get the page after or before the given cursor
+
+        Without a valid cursor, the first page is returned.
+        '''
+        after = self._values(after)
+        before = self._values(before)
+        if after is not None:
+            return self._page_after(after)
+        if before is not None:
+            return self._page_before(before)
+        return self._page_after(None)
+
+    def _values(self, cursor):
+        '''The ordering values of a cursor, None if it's not valid
+
+        The cursors come from the URL, any value which doesn't fit its field
+        (e.g. a null or a string for the pk) would fail the query.
+        '''
+        values = decode_cursor(cursor) if cursor else None
+        if values is None or len(values) != len(self.ordering):
+            return None
+        try:
+            values = [
+                get_field(self.queryset.model, field).to_python(value)
+                for field, value in zip(self.ordering, values)
+                if isinstance(value, (str, int, float))
+            ]
+        except (ValidationError, TypeError, ValueError):
+            return None
+        return values if len(values) == len(self.ordering) else None
+
+    def _page_after(self, values):
+        queryset = self.queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, 'gt'))
+        objects = list(queryset[:self.per_page + 1])
+        has_next = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        return KeysetPage(
+            objects,
+            # we came here from a previous page
+            self._cursor(objects[0]) if values is not None and objects
+            else None,
+            self._cursor(objects[-1]) if has_next else None
+        )
+
+    def _page_before(self, values):
+        queryset = self.queryset.order_by(
+            *(f'-{field}' for field in self.ordering)
+        ).filter(self._seek(values, 'lt'))
+        objects = list(queryset[:self.per_page + 1])
+        has_previous = len(objects) > self.per_page
+        objects = objects[:self.per_page][::-1]
+        return KeysetPage(
+            objects,
+            self._cursor(objects[0]) if has_previous else None,
+            # we came here from a next page
+            self._cursor(objects[-1]) if objects else None
+        )
+
+    def _seek(self, values, lookup):
+        '''Filter for rows ordered after (gt) or before (lt) the values
+
+        (a, b, c) > (x, y, z) is expanded to
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        '''
+        conditions = []
+        for i, field in enumerate(self.ordering):
+            equal = {f: v for f, v in zip(self.ordering[:i], values[:i])}
+            conditions.append(Q(**equal, **{f'{field}__{lookup}': values[i]}))
+        return reduce(lambda a, b: a | b, conditions)
+
+    def _cursor(self, obj):
+        values = []
+        for field in self.ordering:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return encode_cursor(values)
@@ -0,0 +1,392 @@
+'''Books listed by the readers of a book ("readers who listed this also
+listed")
+
+The listings are seen as a book by user matrix, the similarity of two books
+is the cosine similarity of their rows: the number of users who listed both
+of them, divided by the geometric mean of their numbers of listings. The
+build_similarities command computes the top BOOKS_SIMILAR_BOOKS neighbours
+of the books offline and stores them in BookSimilarity, so reading them is a
+single indexed query (see get_similar_books()).
+
+The co-listings are counted with a sparse matrix product when scipy is
+installed, with numpy only otherwise, by generating the pairs of books of
+each user's list. Either way the books are processed in blocks of at most
+BOOKS_SIMILARITY_MAX_PAIRS pairs, which bounds the memory used.
+
+The books recommended to a user are scored from the neighbours of the books
+of their list (see recommend_books()). They're cached per user until the
+user's list changes (see books.signals), and the precompute_recommendations
+command refreshes them for the active users in a pool of processes after
+the similarities are rebuilt.
+
+Listing or unlisting a book marks it stale (see BookStats.apply_delta), and
+the next build only recomputes the stale books, the books sharing a reader
+with them and the books which had them as neighbours, the other books'
+neighbours can't have changed.
+'''
+
+from collections import defaultdict
+from itertools import chain
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+import numpy as np
+
+from .cache import get_cache
+from .models import BookList, BookSimilarity, BookStats
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+# SQLite has a limit on the number of variables in a query
+LOOKUP_SIZE = 500
+
+
+def chunks(values, size=LOOKUP_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def top_per_group(groups, items, scores, k):
+    '''The k best scored items of each group
+
+    The ties are broken by the item, so the results are repeatable.
+
+    Returns:
+        (group, item, rank, score) arrays, sorted by group and rank
+    '''
+    order = np.lexsort((items, -scores, groups))
+    groups, items, scores = groups[order], items[order], scores[order]
+    starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    ranks = np.arange(len(groups)) - np.repeat(
+        starts, np.diff(np.append(starts, len(groups))))
+    top = ranks < k
+    return groups[top], items[top], ranks[top], scores[top]
+
+
+class ListingMatrix:
+    '''The listings as a sparse book by user matrix
+
+    The books and users are numbered by the order of their ids, the rows of
+    the matrix are the indexes of the books in book_ids.
+    '''
+
+    def __init__(self, book_ids, user_ids):
+        self.book_ids, self.books = np.unique(book_ids, return_inverse=True)
+        user_ids, self.users = np.unique(user_ids, return_inverse=True)
+        self.n_books = len(self.book_ids)
+        self.n_users = len(user_ids)
+        # number of listings of each book and of each user
+        self.book_sizes = np.bincount(self.books, minlength=self.n_books)
+        self.user_sizes = np.bincount(self.users, minlength=self.n_users)
+        # the books of each user are user_books[user_starts[user]:...]
+        order = np.argsort(self.users, kind='stable')
+        self.user_books = self.books[order]
+        self.user_starts = np.cumsum(self.user_sizes) - self.user_sizes
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix(
+                (np.ones(len(self.books), dtype=np.int32),
+                 (self.books, self.users)),
+                shape=(self.n_books, self.n_users))
+
+    @classmethod
+    def load(cls):
+        listings = BookList.objects.order_by().values_list(
+            'book_id', 'user_id')
+        pairs = np.fromiter(
+            chain.from_iterable(listings.iterator(chunk_size=10000)),
+            dtype=np.int64).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    def rows_of(self, book_ids):
+        '''Rows of the books, the books without listings are left out'''
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        if not self.n_books:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.searchsorted(self.book_ids, book_ids)
+        rows = np.minimum(rows, self.n_books - 1)
+        return rows[self.book_ids[rows] == book_ids]
+
+    def co_listed(self, rows):
+        '''The books sharing a reader with the books, including themselves'''
+        selected = np.zeros(self.n_books, dtype=bool)
+        selected[rows] = True
+        readers = np.zeros(self.n_users, dtype=bool)
+        readers[self.users[selected[self.books]]] = True
+        return np.unique(self.books[readers[self.users]])
+
+    def pair_counts(self):
+        '''Number of co-listed pairs of each book, with itself'''
+        return np.bincount(
+            self.books, weights=self.user_sizes[self.users],
+            minlength=self.n_books)
+
+    def blocks(self, rows, max_pairs):
+        '''Split the rows so that each block has about max_pairs pairs'''
+        if not len(rows):
+            return []
+        block = (np.cumsum(self.pair_counts()[rows]) - 1) // max_pairs
+        return np.split(rows, np.flatnonzero(np.diff(block)) + 1)
+
+    def co_listings(self, rows):
+        '''Number of readers of the books of the rows and each other book
+
+        Returns:
+            (left, right, count) arrays, left in rows and right != left
+        '''
+        if sparse is not None:
+            product = (self.matrix[rows] @ self.matrix.T).tocoo()
+            left, right = rows[product.row], product.col.astype(np.int64)
+            counts = product.data.astype(np.int64)
+        else:
+            left, right, counts = self._co_listings_numpy(rows)
+        other = left != right
+        return left[other], right[other], counts[other]
+
+    def _co_listings_numpy(self, rows):
+        # each listing of the rows is paired with all the books of its user
+        selected = np.zeros(self.n_books, dtype=bool)
+        selected[rows] = True
+        listings = np.flatnonzero(selected[self.books])
+        users = self.users[listings]
+        sizes = self.user_sizes[users]
+        left = np.repeat(self.books[listings], sizes)
+        offsets = np.arange(len(left)) - np.repeat(np.cumsum(sizes) - sizes,
+                                                   sizes)
+        right = self.user_books[np.repeat(self.user_starts[users], sizes)
+                                + offsets]
+        pairs, counts = np.unique(
+            left * self.n_books + right, return_counts=True)
+        return pairs // self.n_books, pairs % self.n_books, counts
+
+    def neighbours(self, rows, k):
+        '''The k most similar books of the books of the rows
+
+        Returns:
+            (left, right, rank, score) arrays, sorted by left and rank
+        '''
+        left, right, counts = self.co_listings(rows)
+        scores = counts / np.sqrt(
+            self.book_sizes[left].astype(np.float64)
+            * self.book_sizes[right])
+        return top_per_group(left, right, scores, k)
+
+    def save(self, rows, k):
+        '''Replace the stored neighbours of the books of the rows'''
+        left, right, ranks, scores = self.neighbours(rows, k)
+        similarities = [
+            BookSimilarity(
+                book_id=book_id, similar_book_id=similar_book_id, rank=rank,
+                score=score)
+            for book_id, similar_book_id, rank, score in zip(
+                self.book_ids[left].tolist(), self.book_ids[right].tolist(),
+                ranks.tolist(), scores.tolist())
+        ]
+        with transaction.atomic():
+            for book_ids in chunks(self.book_ids[rows].tolist()):
+                BookSimilarity.objects.filter(book_id__in=book_ids).delete()
+            BookSimilarity.objects.bulk_create(similarities, batch_size=1000)
+
+
+def claim_stale_books():
+    '''Clear the stale flags of the books
+
+    Returns:
+        book_ids(list): the books which were stale
+    '''
+    with transaction.atomic():
+        book_ids = list(BookStats.objects.select_for_update().filter(
+            similarities_stale=True).values_list('book_id', flat=True))
+        # only the locked rows, a book listed in the meantime stays stale
+        for chunk in chunks(book_ids):
+            BookStats.objects.filter(pk__in=chunk).update(
+                similarities_stale=False)
+    return book_ids
+
+
+def mark_stale(book_ids):
+    for chunk in chunks(book_ids):
+        BookStats.objects.filter(pk__in=chunk).update(similarities_stale=True)
+
+
+def get_books_similar_to(book_ids):
+    '''The books which have one of the books among their neighbours'''
+    similar_to = set()
+    for chunk in chunks(book_ids):
+        similar_to.update(BookSimilarity.objects.filter(
+            similar_book_id__in=chunk).values_list('book_id', flat=True))
+    return sorted(similar_to)
+
+
+def build_similarities(full=False, k=None, max_pairs=None, progress=None):
+    '''Compute and store the most similar books
+
+    Params:
+        full(bool): recompute all the books, not only the stale ones and the
+            books sharing a reader with them
+        k(int): number of neighbours stored, BOOKS_SIMILAR_BOOKS by default
+        max_pairs(int): size of the blocks, BOOKS_SIMILARITY_MAX_PAIRS by
+            default
+        progress(callable): called with the number of books done and the
+            number of books to do after each block
+    Returns:
+        books(int): number of books whose neighbours were recomputed
+    '''
+    if k is None:
+        k = settings.BOOKS_SIMILAR_BOOKS
+    if max_pairs is None:
+        max_pairs = settings.BOOKS_SIMILARITY_MAX_PAIRS
+    stale = claim_stale_books()
+    try:
+        matrix = ListingMatrix.load()
+        if full:
+            rows = np.arange(matrix.n_books)
+        else:
+            # the books which had a stale book as neighbour may have lost
+            # their readers in common
+            rows = np.union1d(
+                matrix.co_listed(matrix.rows_of(stale)),
+                matrix.rows_of(get_books_similar_to(stale)))
+        done = 0
+        for block in matrix.blocks(rows, max_pairs):
+            matrix.save(block, k)
+            done += len(block)
+            if progress is not None:
+                progress(done, len(rows))
+        # the books which aren't listed anymore have no neighbours
+        BookSimilarity.objects.filter(~Exists(
+            BookList.objects.filter(book=OuterRef('book')))).delete()
+    except BaseException:
+        mark_stale(stale)
+        raise
+    return len(rows)
+
+
+def get_similar_books(book_ids, limit=None):
+    '''The most similar books of the books, in one query
+
+    Returns:
+        similar_books(dict): book id -> its similar books with their
+        authors, the most similar first
+    '''
+    if limit is None:
+        limit = settings.BOOKS_SIMILAR_BOOKS
+    similarities = BookSimilarity.objects.filter(
+        book_id__in=book_ids, rank__lt=limit,
+    ).select_related('similar_book__author').order_by('book_id', 'rank')
+    similar_books = defaultdict(list)
+    for similarity in similarities:
+        similar_books[similarity.book_id].append(similarity.similar_book)
+    return similar_books
+
+
+def recommend_books(user_ids, limit=None):
+    '''Recommend books to the users from the similar books of their lists
+
+    A book is scored by the sum of its similarities to the books of the
+    user's list, each weighted by the user's rating of the book, or by
+    BOOKS_RATING_PRIOR_MEAN if it isn't rated yet. The books already on the
+    list aren't recommended.
+
+    Returns:
+        recommendations(dict): user id -> ids of the recommended books, the
+        best first, for each of the users
+    '''
+    if limit is None:
+        limit = settings.BOOKS_RECOMMENDATIONS
+    recommendations = {user_id: [] for user_id in user_ids}
+    for chunk in chunks(list(user_ids)):
+        booklists = BookList.objects.filter(user__in=chunk)
+        listings = list(booklists.values_list('user_id', 'book_id', 'rating'))
+        similarities = list(BookSimilarity.objects.filter(
+            book__in=booklists.values('book'),
+        ).order_by('book_id').values_list(
+            'book_id', 'similar_book_id', 'score'))
+        if not similarities:
+            continue
+        users, books, ratings = zip(*listings)
+        weights = np.array(
+            [settings.BOOKS_RATING_PRIOR_MEAN if rating is None else rating
+             for rating in ratings], dtype=np.float64)
+        users, books = score_recommendations(
+            np.array(users, dtype=np.int64), np.array(books, dtype=np.int64),
+            weights,
+            [np.array(column) for column in zip(*similarities)],
+            limit)
+        for user_id, book_id in zip(users.tolist(), books.tolist()):
+            recommendations[user_id].append(book_id)
+    return recommendations
+
+
+def score_recommendations(users, books, weights, similarities, limit):
+    '''Score the recommendations of recommend_books() for all the users
+
+    Params:
+        users, books, weights: arrays of the listings of the users
+        similarities: (book, similar book, score) arrays, sorted by book
+    Returns:
+        (user, book) arrays of the recommendations, by user and rank
+    '''
+    similar_to, similar_books, scores = similarities
+    # the similar books of each listing
+    starts = np.searchsorted(similar_to, books, 'left')
+    sizes = np.searchsorted(similar_to, books, 'right') - starts
+    offsets = np.arange(sizes.sum()) - np.repeat(
+        np.cumsum(sizes) - sizes, sizes)
+    similar = np.repeat(starts, sizes) + offsets
+    # sum the scores of each (user, similar book) pair
+    user_ids, users = np.unique(users, return_inverse=True)
+    span = max(books.max(), similar_books.max()) + 1
+    keys, pairs = np.unique(
+        np.repeat(users, sizes) * span + similar_books[similar],
+        return_inverse=True)
+    totals = np.bincount(
+        pairs.ravel(), weights=np.repeat(weights, sizes) * scores[similar])
+    unlisted = ~np.isin(keys, users * span + books)
+    users, books, ranks, totals = top_per_group(
+        keys[unlisted] // span, keys[unlisted] % span, totals[unlisted],
+        limit)
+    return user_ids[users], books
+
+
+def _recommendations_key(user_id):
+    return f'books:recommendations:{user_id}'
+
+
+def get_recommendations(user):
+    '''Ids of the books recommended to the user, the best first
+
+    The recommendations are cached until the user's list changes.
+    '''
+    cache = get_cache()
+    key = _recommendations_key(user.pk)
+    book_ids = cache.get(key)
+    if book_ids is None:
+        book_ids = recommend_books([user.pk])[user.pk]
+        cache.set(
+            key, book_ids, timeout=settings.BOOKS_RECOMMENDATIONS_TIMEOUT)
+    return book_ids
+
+
+def precompute_recommendations(user_ids):
+    '''Compute and cache the recommendations of the users
+
+    Returns:
+        users(int): number of users whose recommendations were cached
+    '''
+    recommendations = recommend_books(user_ids)
+    get_cache().set_many(
+        {_recommendations_key(user_id): book_ids
+         for user_id, book_ids in recommendations.items()},
+        timeout=settings.BOOKS_RECOMMENDATIONS_TIMEOUT)
+    return len(recommendations)
+
+
+def invalidate_recommendations(user_id):
+    '''Forget the cached recommendations, now and on commit'''
+    key = _recommendations_key(user_id)
+    get_cache().delete(key)
+    transaction.on_commit(lambda: get_cache().delete(key))
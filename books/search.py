@@ -0,0 +1,223 @@
+'''Full-text search of the books in our catalog by their title and author
+
+On PostgreSQL the search uses the full-text search of the database with the
+GIN indexes created by the 0009_search_indexes migration, and trigram
+similarity of the titles, so slightly misspelled titles are found too.
+
+On other databases (e.g. SQLite when running the tests) a simple inverted
+index is kept in memory instead. It's built on the first search and updated
+by the signals of the books and authors saved by the same process, so it
+doesn't see the changes made by other processes until they restart.
+
+All the words of the query have to match the beginning of a word of the
+title or of the author's name.
+
+Settings:
+    BOOKS_SEARCH_RESULTS: maximum number of results
+'''
+
+from bisect import bisect_left
+from collections import defaultdict
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db import connections, router
+
+from .models import Author, Book
+
+WORD = re.compile(r'\w+')
+SEARCH_CONFIG = 'english'
+
+# the expressions have to be the same as the ones of the indexes
+POSTGRESQL_SEARCH = f'''
+    WITH query AS (
+        SELECT to_tsquery('{SEARCH_CONFIG}', %(any)s) AS any_word,
+               to_tsquery('{SEARCH_CONFIG}', %(all)s) AS all_words
+    ), document AS (
+        SELECT book.id, book.title,
+               to_tsvector('{SEARCH_CONFIG}', book.title) ||
+               to_tsvector('{SEARCH_CONFIG}',
+                           author.first_name || ' ' || author.last_name)
+               AS vector
+          FROM {Book._meta.db_table} book
+          JOIN {Author._meta.db_table} author ON author.id = book.author_id
+         WHERE book.id IN (
+                   SELECT id FROM {Book._meta.db_table}, query
+                    WHERE to_tsvector('{SEARCH_CONFIG}', title) @@ any_word
+                       OR title %% %(q)s
+                   UNION
+                   SELECT book.id
+                     FROM {Author._meta.db_table} author
+                     JOIN {Book._meta.db_table} book
+                          ON book.author_id = author.id,
+                          query
+                    WHERE to_tsvector('{SEARCH_CONFIG}',
+                                      first_name || ' ' || last_name)
+                          @@ any_word
+               )
+    )
+    SELECT id FROM document, query
+     WHERE vector @@ all_words OR title %% %(q)s
+     ORDER BY ts_rank(vector, all_words) + similarity(title, %(q)s) DESC, id
+     LIMIT %(limit)s
+'''
+
+
+def tokenize(text):
+    '''Lowercase words of a text without accents'''
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return WORD.findall(text)
+
+
+def search_books(q, limit=None):
+    '''Find the books of the catalog by their title and author
+
+    Returns:
+        books(list): the best matches first, with their authors
+    '''
+    if limit is None:
+        limit = settings.BOOKS_SEARCH_RESULTS
+    using = router.db_for_read(Book)
+    if connections[using].vendor == 'postgresql':
+        # the database handles the accents
+        words = WORD.findall(q.lower())
+        ids = _search_postgresql(using, q, words, limit) if words else []
+    else:
+        words = tokenize(q)
+        ids = get_index().search(words, limit) if words else []
+    books = Book.objects.using(using).select_related('author').in_bulk(ids)
+    return [books[pk] for pk in ids if pk in books]
+
+
+def _search_postgresql(using, q, words, limit):
+    with connections[using].cursor() as cursor:
+        cursor.execute(POSTGRESQL_SEARCH, {
+            'any': ' | '.join(f'{word}:*' for word in words),
+            'all': ' & '.join(f'{word}:*' for word in words),
+            'q': q,
+            'limit': limit,
+        })
+        return [pk for pk, in cursor.fetchall()]
+
+
+class InvertedIndex:
+    '''Books by the words of their title and author's name, in memory'''
+
+    # a word of the title counts more than a word of the author's name
+    TITLE_WEIGHT = 2
+    AUTHOR_WEIGHT = 1
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # word -> {book id: weight}
+        self.postings = defaultdict(dict)
+        # book id -> its words
+        self.documents = {}
+        # sorted words for the prefix lookups, rebuilt when needed
+        self._vocabulary = None
+
+    def add(self, book_id, title, author_name):
+        weights = {word: self.AUTHOR_WEIGHT for word in tokenize(author_name)}
+        weights.update(
+            (word, self.TITLE_WEIGHT) for word in tokenize(title))
+        with self.lock:
+            self.remove(book_id)
+            for word, weight in weights.items():
+                if word not in self.postings:
+                    self._vocabulary = None
+                self.postings[word][book_id] = weight
+            self.documents[book_id] = list(weights)
+
+    def remove(self, book_id):
+        with self.lock:
+            for word in self.documents.pop(book_id, ()):
+                postings = self.postings[word]
+                postings.pop(book_id, None)
+                if not postings:
+                    del self.postings[word]
+                    self._vocabulary = None
+
+    def get_vocabulary(self):
+        with self.lock:
+            if self._vocabulary is None:
+                self._vocabulary = sorted(self.postings)
+            return self._vocabulary
+
+    def matches(self, prefix):
+        '''Best weight of each book with a word starting with the prefix'''
+        vocabulary = self.get_vocabulary()
+        matches = {}
+        for i in range(bisect_left(vocabulary, prefix), len(vocabulary)):
+            word = vocabulary[i]
+            if not word.startswith(prefix):
+                break
+            for book_id, weight in self.postings.get(word, {}).items():
+                # exact matches count more than the prefix ones
+                weight += word == prefix
+                if weight > matches.get(book_id, 0):
+                    matches[book_id] = weight
+        return matches
+
+    def search(self, words, limit):
+        scores = None
+        with self.lock:
+            for word in words:
+                matches = self.matches(word)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {book_id: score + matches[book_id]
+                              for book_id, score in scores.items()
+                              if book_id in matches}
+                if not scores:
+                    return []
+        ranking = sorted(
+            scores, key=lambda book_id: (-scores[book_id], book_id))
+        return ranking[:limit]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''The inverted index of the catalog, built on the first call'''
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = InvertedIndex()
+            books = Book.objects.values_list(
+                'pk', 'title', 'author__first_name', 'author__last_name')
+            for pk, title, first_name, last_name in books.iterator():
+                index.add(pk, title, f'{first_name} {last_name}')
+            _index = index
+        return _index
+
+
+def reset_index():
+    '''Drop the inverted index, it's rebuilt on the next search'''
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def index_book(book):
+    '''Update the book in the inverted index, if it's built already'''
+    if _index is not None:
+        _index.add(book.pk, book.title, str(book.author))
+
+
+def unindex_book(book_id):
+    if _index is not None:
+        _index.remove(book_id)
+
+
+def index_author(author):
+    '''Update the books of the author in the inverted index'''
+    if _index is not None:
+        for book in author.book_set.all():
+            book.author = author
+            index_book(book)
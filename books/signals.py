@@ -0,0 +1,146 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import recommendations, search, typeahead
+from .cache import (
+    bump_generation, claim_daily_pruning, invalidate_booklist_count
+)
+from .models import (
+    Author, Book, BookList, BookStats, DailyListingCount, booklist_rated
+)
+
+
+def _listing_delta(rating, sign=1):
+    '''Stats delta of adding (sign=1) or removing (sign=-1) one listing'''
+    return {
+        'listings': sign,
+        'rating_sum': sign * (rating or 0),
+        'ratings': sign * (rating is not None),
+    }
+
+
+@receiver(post_save, sender=Book)
+def create_book_stats(sender, instance, created, raw, **kwargs):
+    if not created:
+        return
+    if raw:
+        # fixtures may have loaded the booklists of this book already
+        BookStats.objects.rebuild(book_ids=[instance.pk])
+    else:
+        BookStats.objects.create(book=instance)
+
+
+@receiver(post_save, sender=BookList)
+def update_book_stats_on_save(
+        sender, instance, created, raw, update_fields, **kwargs):
+    new_state = (instance.book_id, instance.rating)
+    old_state = instance._stats_state
+    instance._stats_state = new_state
+    if update_fields is not None and not {'book', 'rating'} & set(
+            update_fields):
+        return
+
+    if created:
+        BookStats.objects.apply_delta(
+            instance.book_id, **_listing_delta(instance.rating))
+    elif old_state is None:
+        # we don't know what was stored before (e.g. loading fixtures)
+        BookStats.objects.rebuild(book_ids=[instance.book_id])
+    elif old_state != new_state:
+        old_book_id, old_rating = old_state
+        if old_book_id == instance.book_id:
+            removed = _listing_delta(old_rating, -1)
+            added = _listing_delta(instance.rating)
+            BookStats.objects.apply_delta(instance.book_id, **{
+                key: added[key] + removed[key] for key in added})
+        else:
+            BookStats.objects.apply_delta(
+                old_book_id, **_listing_delta(old_rating, -1))
+            BookStats.objects.apply_delta(
+                instance.book_id, **_listing_delta(instance.rating))
+
+
+@receiver(post_save, sender=BookList)
+def count_daily_listing(sender, instance, created, raw, **kwargs):
+    if not created:
+        return
+    DailyListingCount.objects.increment(
+        instance.book_id, timezone.localdate(instance.added))
+    # the first listing of the day drops the counts out of the trending
+    # window, the fixtures may load old listings on purpose
+    today = timezone.localdate()
+    if not raw and claim_daily_pruning(today):
+        DailyListingCount.objects.prune(today)
+
+
+@receiver(post_delete, sender=BookList)
+def update_book_stats_on_delete(sender, instance, **kwargs):
+    book_id, rating = instance._stats_state or (
+        instance.book_id, instance.rating)
+    BookStats.objects.apply_delta(book_id, **_listing_delta(rating, -1))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=BookList)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=BookList)
+@receiver(booklist_rated, sender=BookList)
+def invalidate_rankings(sender, **kwargs):
+    bump_generation()
+
+
+@receiver(post_delete, sender=BookList)
+def invalidate_booklist_count_on_delete(sender, instance, **kwargs):
+    invalidate_booklist_count(instance.user_id)
+
+
+@receiver(post_save, sender=BookList)
+def invalidate_booklist_count_on_create(sender, instance, created, **kwargs):
+    if created:
+        invalidate_booklist_count(instance.user_id)
+
+
+@receiver(post_save, sender=BookList)
+@receiver(post_delete, sender=BookList)
+def invalidate_recommendations(sender, instance, **kwargs):
+    recommendations.invalidate_recommendations(instance.user_id)
+
+
+@receiver(booklist_rated, sender=BookList)
+def invalidate_recommendations_on_rate(sender, user, **kwargs):
+    recommendations.invalidate_recommendations(user.pk)
+
+
+@receiver(post_save, sender=Book)
+def index_book_on_save(sender, instance, raw, **kwargs):
+    if raw:
+        # the authors of the fixtures may not be loaded yet
+        search.reset_index()
+        typeahead.reset_index()
+    else:
+        search.index_book(instance)
+        typeahead.index_book(instance)
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book_on_delete(sender, instance, **kwargs):
+    search.unindex_book(instance.pk)
+    typeahead.unindex_book(instance.pk)
+
+
+@receiver(post_save, sender=Author)
+def index_author_on_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        search.reset_index()
+        typeahead.reset_index()
+    elif not created:
+        search.index_author(instance)
+        typeahead.index_author(instance)
+
+
+@receiver(post_delete, sender=Author)
+def unindex_author_on_delete(sender, instance, **kwargs):
+    typeahead.unindex_author(instance.pk)
@@ -5,10 +5,17 @@ register = template.Library()
 
 @register.inclusion_tag('books/_card_book.html')
 def book_card(book):
+    # use the stats annotated by views.annotate_book_cards if available
+    number_of_listings = getattr(book, 'num_lists', None)
+    if number_of_listings is None:
+        number_of_listings = book.number_of_listings
+        avg_rating = book.average_rating
+    else:
+        avg_rating = book.avg_rating
     return {
         'cover': book.cover, 'author': book.author, 'title': book.title,
-        'number_of_listings': book.number_of_listings,
-        'avg_rating': book.average_rating
+        'number_of_listings': number_of_listings,
+        'avg_rating': avg_rating
         }
 
 
@@ -1,14 +1,50 @@
-from django.contrib.auth.models import User
+import asyncio
+from datetime import timedelta
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Sum
 from django.db.utils import IntegrityError
 from django.template import Template, Context
-from django.test import TestCase
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+    override_settings
+)
 from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+
+from bookr import metrics, replicas
 
+from .cache import bump_generation, cached_ranking, get_cache, get_generation
 from .forms import BookListAddForm
-from .models import Author, Book, BookList
+from .jobs import enqueue_import, process_next_job
+from .models import (
+    Author, Book, BookList, BookSimilarity, BookStats, DailyListingCount,
+    ImportJob, OpenLibraryResponse
+)
+from .pagination import encode_cursor
+from . import openlibrary, recommendations, search, typeahead
+from .openlibrary import CircuitBreaker, reset_client
 from .views import (
     get_recent_books, get_most_read_books, create_book_choices,
-    get_top_rated_books
+    get_top_rated_books, get_trending_books, annotate_book_cards,
+    book_search_async
 )
 
 
@@ -38,6 +74,129 @@ class DashboardViewEmptyDBTests(TestCase):
         self.assertContains(response, 'No books added yet.')
 
 
+class DashboardViewQueryCountTests(TestCase):
+    '''Test that rendering the dashboard doesn't query per book card'''
+
+    fixtures = ['full_db.json']
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_query_budget(self):
+        # one query for each of the four rankings
+        # and two for the Last-Modified header
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('books:dashboard'))
+        self.assertEqual(len(response.context['top_books']), 5)
+        self.assertEqual(len(response.context['most_read_books']), 5)
+        self.assertEqual(len(response.context['recent_books']), 5)
+
+    def test_query_budget_cached(self):
+        self.client.get(reverse('books:dashboard'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('books:dashboard'))
+
+
+class DashboardPageCacheTests(TestCase):
+    '''Test the caching of the whole dashboard for anonymous users'''
+
+    fixtures = ['fewusers.json', 'booklist_without_ratings']
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_page_cached_for_anonymous_users(self):
+        response = self.client.get(reverse('books:dashboard'))
+        self.assertTemplateUsed(response, 'books/index.html')
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('books:dashboard'))
+        self.assertTemplateNotUsed(cached, 'books/index.html')
+        self.assertEqual(cached.content, response.content)
+
+    def test_page_not_cached_for_users(self):
+        self.client.force_login(User.objects.get(pk=2))
+        self.client.get(reverse('books:dashboard'))
+        response = self.client.get(reverse('books:dashboard'))
+        self.assertTemplateUsed(response, 'books/index.html')
+        self.assertContains(response, 'Welcome back, joe!')
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_fragments_shared_with_users(self):
+        self.client.get(reverse('books:dashboard'))
+        self.client.force_login(User.objects.get(pk=2))
+        # only the session and the user, the sections are in the cache
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('books:dashboard'))
+        self.assertContains(response, 'The Catcher in the Rye')
+
+    def test_conditional_get_etag(self):
+        response = self.client.get(reverse('books:dashboard'))
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                reverse('books:dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertTemplateNotUsed(response, 'books/index.html')
+
+    def test_conditional_get_last_modified(self):
+        response = self.client.get(reverse('books:dashboard'))
+        response = self.client.get(
+            reverse('books:dashboard'),
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_on_delete(self):
+        etag = self.client.get(reverse('books:dashboard'))['ETag']
+        BookList.objects.get(pk=1).delete()
+        response = self.client.get(
+            reverse('books:dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class RankingsCacheTests(TestCase):
+
+    fixtures = ['fewusers.json', 'booklist_without_ratings']
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_cached_until_data_changes(self):
+        top = cached_ranking('top_rated', get_top_rated_books)
+        self.assertNotEqual(top[0].pk, 7)
+        with self.assertNumQueries(0):
+            cached_ranking('top_rated', get_top_rated_books)
+
+        bl = BookList.objects.get(pk=12)
+        bl.rating = 5
+        bl.save()
+        top = cached_ranking('top_rated', get_top_rated_books)
+        self.assertEqual(top[0].pk, 7)
+
+    def test_delete_invalidates(self):
+        most_read = cached_ranking('most_read', get_most_read_books)
+        self.assertEqual(most_read[0].pk, 1)
+        BookList.objects.filter(book_id=1).delete()
+        most_read = cached_ranking('most_read', get_most_read_books)
+        self.assertNotEqual(most_read[0].pk, 1)
+
+    def test_stale_value_served_while_locked(self):
+        recent = cached_ranking('recent', get_recent_books)
+        bump_generation()
+        # another worker is recomputing the ranking
+        get_cache().add(f'books:recent:{get_generation()}:lock', True)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                cached_ranking('recent', get_recent_books), recent)
+
+    @override_settings(BOOKS_CACHE='does-not-exist')
+    def test_local_memory_fallback(self):
+        self.assertIsInstance(get_cache(), LocMemCache)
+        cached_ranking('recent', get_recent_books)
+        with self.assertNumQueries(0):
+            cached_ranking('recent', get_recent_books)
+
+
 class DashboardViewHelperFunctionsTests(TestCase):
     '''Test dashboard with fixtures with a few data'''
 
@@ -56,6 +215,51 @@ class DashboardViewHelperFunctionsTests(TestCase):
             ]
         )
 
+    def test_daily_listings_counted(self):
+        today = timezone.localdate()
+        # the listings of the fixtures are counted on the day they were added
+        self.assertEqual(
+            DailyListingCount.objects.aggregate(total=Sum('count'))['total'],
+            BookList.objects.count())
+        user = User.objects.get(pk=1)
+        BookList.objects.create(user=user, book_id=2)
+        BookList.objects.create(user=User.objects.get(pk=3), book_id=2)
+        count = DailyListingCount.objects.get(book_id=2, day=today)
+        self.assertEqual(count.count, 2)
+
+    @override_settings(BOOKS_TRENDING_DAYS=7)
+    def test_daily_listings_pruned(self):
+        get_cache().clear()
+        today = timezone.localdate()
+        DailyListingCount.objects.create(
+            book_id=3, day=today - timedelta(days=6), count=1)
+        BookList.objects.create(user=User.objects.get(pk=1), book_id=2)
+        # the counts of the fixtures are out of the window
+        self.assertEqual(
+            sorted(DailyListingCount.objects.values_list('book_id', 'day')),
+            [(2, today), (3, today - timedelta(days=6))])
+
+        # pruned once a day
+        DailyListingCount.objects.create(
+            book_id=4, day=today - timedelta(days=7), count=1)
+        BookList.objects.create(user=User.objects.get(pk=3), book_id=2)
+        self.assertTrue(DailyListingCount.objects.filter(book_id=4).exists())
+        self.assertEqual(DailyListingCount.objects.prune(today), 1)
+
+    @override_settings(BOOKS_TRENDING_DAYS=7, BOOKS_TRENDING_DECAY=0.5)
+    def test_trending_books(self):
+        # the listings of the fixtures are too old
+        self.assertEqual(list(get_trending_books()), [])
+        today = timezone.localdate()
+        for book_id, age, count in (
+                (1, 0, 2), (2, 1, 3), (3, 6, 50), (4, 7, 100), (5, 0, 1)):
+            DailyListingCount.objects.create(
+                book_id=book_id, day=today - timedelta(days=age), count=count)
+        # 3 * 0.5 = 1.5 and 50 * 0.5 ** 6 = 0.78, book 4 is out of the window
+        with self.assertNumQueries(1):
+            books = [book.pk for book in get_trending_books()]
+        self.assertEqual(books, [1, 2, 5, 3])
+
     def test_recently_added_books(self):
         books = get_recent_books()
         self.assertQuerysetEqual(
@@ -69,58 +273,56 @@ class DashboardViewHelperFunctionsTests(TestCase):
             ]
         )
 
-    # BUG: for some strange reason this test fails, altough the operations
-    # are succesful and the ordering in the real app works
-    # def test_top_rated_books(self):
-    #     '''Test the correct ordering of top rated books
-
-    #     book1 is rated for 5, 5, 5 = avg 5
-    #     book2 is rated for 4 = 4
-    #     book3 is rated for 3 = 3
-    #     book6 is rated for 4,3 = 3.5
-    #     book7 is rated for 2 = 2
-    #     book9 is rated for 5 = 5
-    #     Order: book1, book9, book2, book6, book3
-    #     '''
-
-    #     bl = BookList.objects.get(pk=1)
-    #     bl.rating = 5
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=8)
-    #     bl.rating = 5
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=10)
-    #     bl.rating = 5
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=14)
-    #     bl.rating = 4
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=15)
-    #     bl.rating = 3
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=16)
-    #     bl.rating = 4
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=17)
-    #     bl.rating = 3
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=12)
-    #     bl.rating = 2
-    #     bl.save()
-    #     bl = BookList.objects.get(pk=3)
-    #     bl.rating = 5
-    #     bl.save()
-    #     books = get_top_rated_books()
-    #     self.assertQuerysetEqual(
-    #         books,
-    #         [
-    #             repr(Book.objects.get(pk=1)),
-    #             repr(Book.objects.get(pk=9)),
-    #             repr(Book.objects.get(pk=2)),
-    #             repr(Book.objects.get(pk=6)),
-    #             repr(Book.objects.get(pk=3)),
-    #         ]
-    #     )
+    def test_top_rated_books(self):
+        '''Test the correct ordering of top rated books
+
+        book1 is rated for 5, 5, 5 = avg 5
+        book2 is rated for 4 = 4
+        book3 is rated for 3 = 3
+        book6 is rated for 4,3 = 3.5
+        book7 is rated for 2 = 2
+        book9 is rated for 5 = 5
+        Order: book1, book9, book2, book6, book3
+        '''
+
+        bl = BookList.objects.get(pk=1)
+        bl.rating = 5
+        bl.save()
+        bl = BookList.objects.get(pk=8)
+        bl.rating = 5
+        bl.save()
+        bl = BookList.objects.get(pk=10)
+        bl.rating = 5
+        bl.save()
+        bl = BookList.objects.get(pk=14)
+        bl.rating = 4
+        bl.save()
+        bl = BookList.objects.get(pk=15)
+        bl.rating = 3
+        bl.save()
+        bl = BookList.objects.get(pk=16)
+        bl.rating = 4
+        bl.save()
+        bl = BookList.objects.get(pk=17)
+        bl.rating = 3
+        bl.save()
+        bl = BookList.objects.get(pk=12)
+        bl.rating = 2
+        bl.save()
+        bl = BookList.objects.get(pk=3)
+        bl.rating = 5
+        bl.save()
+        books = get_top_rated_books()
+        self.assertQuerysetEqual(
+            books,
+            [
+                repr(Book.objects.get(pk=1)),
+                repr(Book.objects.get(pk=9)),
+                repr(Book.objects.get(pk=2)),
+                repr(Book.objects.get(pk=6)),
+                repr(Book.objects.get(pk=3)),
+            ]
+        )
 
 
 class AuthorModelTests(TestCase):
@@ -184,6 +386,13 @@ class BookModelTests(TestCase):
             BookList.objects.filter(user=self.user, book=self.book).count()
         )
 
+    def test_add_to_booklist_method_with_rated_duplicate(self):
+        '''Test if the book is already rated on the user's booklist'''
+        BookList.objects.create(user=self.user, book=self.book, rating=3)
+        bl_item, created = self.book.add_to_booklist(self.user)
+        self.assertFalse(created)
+        self.assertEqual(bl_item.rating, 3)
+
     def test_number_of_listings(self):
         '''Test if the number_of_listing property is calculated properly
 
@@ -222,6 +431,113 @@ class BookModelTests(TestCase):
         self.assertEqual(4.5, book3.average_rating)
 
 
+class BookStatsTests(TestCase):
+    '''Test the incremental maintenance of the denormalized book stats'''
+
+    fixtures = ['fewusers.json', 'booklist_without_ratings']
+
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+
+    def test_stats_created_with_book(self):
+        author = Author.objects.get(pk=1)
+        book = Book.objects.create(
+            author=author, title='New book', first_published=2000)
+        self.assertEqual(book.stats.listing_count, 0)
+        self.assertIsNone(book.stats.average_rating)
+
+    def test_stats_loaded_from_fixtures(self):
+        stats = BookStats.objects.get(book_id=1)
+        self.assertEqual(stats.listing_count, 3)
+        self.assertEqual(stats.rating_count, 0)
+
+    def test_stats_updated_on_create(self):
+        book = Book.objects.get(pk=7)
+        book.add_to_booklist(self.user, 4)
+        stats = BookStats.objects.get(book=book)
+        self.assertEqual(stats.listing_count, 2)
+        self.assertEqual(stats.rating_sum, 4)
+        self.assertEqual(stats.rating_count, 1)
+        self.assertEqual(stats.average_rating, 4)
+
+    def test_stats_updated_on_rate(self):
+        self.client.force_login(self.user)
+        self.client.post(
+            reverse('books:book_rate'), {'booklist_id': 1, 'rating': 5})
+        self.client.post(
+            reverse('books:book_rate'), {'booklist_id': 1, 'rating': 2})
+        stats = BookStats.objects.get(book_id=1)
+        self.assertEqual(stats.listing_count, 3)
+        self.assertEqual(stats.rating_sum, 2)
+        self.assertEqual(stats.rating_count, 1)
+        self.assertEqual(stats.average_rating, 2)
+
+    def test_stats_updated_on_delete(self):
+        bl = BookList.objects.get(pk=1)
+        bl.rating = 3
+        bl.save()
+        self.client.force_login(self.user)
+        self.client.get(reverse('books:book_list_delete', kwargs={'pk': 1}))
+        stats = BookStats.objects.get(book_id=1)
+        self.assertEqual(stats.listing_count, 2)
+        self.assertEqual(stats.rating_count, 0)
+        self.assertIsNone(stats.average_rating)
+
+    def test_rebuild_command_reports_and_fixes_drift(self):
+        BookStats.objects.filter(book_id=1).update(listing_count=10)
+        BookStats.objects.filter(book_id=2).delete()
+        out = StringIO()
+        call_command('rebuild_book_stats', dry_run=True, stdout=out)
+        self.assertIn('Book 1: listings 10 -> 3', out.getvalue())
+        self.assertIn('Book 2: stats were missing', out.getvalue())
+        self.assertEqual(
+            BookStats.objects.get(book_id=1).listing_count, 10)
+
+        call_command('rebuild_book_stats', stdout=StringIO())
+        self.assertEqual(BookStats.objects.get(book_id=1).listing_count, 3)
+        self.assertEqual(BookStats.objects.get(book_id=2).listing_count, 1)
+        out = StringIO()
+        call_command('rebuild_book_stats', stdout=out)
+        self.assertIn('No drift found.', out.getvalue())
+
+    @override_settings(BOOKS_RATING_PRIOR_MEAN=3, BOOKS_RATING_PRIOR_VOTES=2)
+    def test_score(self):
+        stats = BookStats.objects.get(book_id=1)
+        self.assertEqual(stats.score, 0)
+        for pk, rating in ((1, 5), (8, 4)):
+            bl = BookList.objects.get(pk=pk)
+            bl.rating = rating
+            bl.save()
+        stats.refresh_from_db()
+        # (5 + 4 + 2 * 3) / (2 + 2)
+        self.assertEqual(stats.score, 3.75)
+        BookList.objects.get(pk=8).delete()
+        BookList.objects.get(pk=1).delete()
+        stats.refresh_from_db()
+        self.assertEqual(stats.score, 0)
+
+    @override_settings(BOOKS_RATING_PRIOR_MEAN=3, BOOKS_RATING_PRIOR_VOTES=5)
+    def test_score_smoothed(self):
+        # one 5 star rating against three 4 star ones
+        BookList.objects.filter(book_id=1).update(rating=4)
+        BookList.objects.filter(pk=2).update(rating=5)
+        BookStats.objects.rebuild()
+        books = list(get_top_rated_books())
+        self.assertEqual(books[0].pk, 1)
+        self.assertEqual(books[1].pk, BookList.objects.get(pk=2).book_id)
+
+    def test_rebuild_command_fixes_score(self):
+        BookList.objects.filter(pk=1).update(rating=5)
+        BookStats.objects.rebuild()
+        with override_settings(BOOKS_RATING_PRIOR_VOTES=10):
+            out = StringIO()
+            call_command('rebuild_book_stats', dry_run=True, stdout=out)
+            self.assertIn('score 3.6667 -> 3.1818', out.getvalue())
+            call_command('rebuild_book_stats', stdout=StringIO())
+        self.assertAlmostEqual(
+            BookStats.objects.get(book_id=1).score, 35 / 11)
+
+
 class BookListModelTests(TestCase):
 
     fixtures = ['fewusers.json', 'threebooks.json']
@@ -287,6 +603,78 @@ class BookListViewTests(TestCase):
         self.assertContains(response, 'Franny and Zooey')
 
 
+@override_settings(BOOKS_BOOKLIST_PAGE_SIZE=4)
+class BookListPaginationTests(TestCase):
+
+    fixtures = ['fewusers.json', 'ninebooks.json']
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.get(pk=2)
+        for book in Book.objects.all():
+            BookList.objects.create(user=self.user, book=book)
+        self.expected = list(BookList.objects.filter(
+            user=self.user).order_by(
+                'book__author__last_name', 'book__title', 'pk'))
+        self.client.force_login(self.user)
+
+    def test_walk_forward_and_back(self):
+        response = self.client.get(reverse('books:book_list'))
+        page1 = response.context['mybooks']
+        self.assertEqual(page1.object_list, self.expected[:4])
+        self.assertFalse(page1.has_previous())
+
+        response = self.client.get(
+            reverse('books:book_list'), {'after': page1.next_cursor})
+        page2 = response.context['mybooks']
+        self.assertEqual(page2.object_list, self.expected[4:8])
+
+        response = self.client.get(
+            reverse('books:book_list'), {'after': page2.next_cursor})
+        page3 = response.context['mybooks']
+        self.assertEqual(page3.object_list, self.expected[8:])
+        self.assertFalse(page3.has_next())
+
+        response = self.client.get(
+            reverse('books:book_list'), {'before': page3.previous_cursor})
+        self.assertEqual(
+            response.context['mybooks'].object_list, self.expected[4:8])
+        response = self.client.get(
+            reverse('books:book_list'), {'before': page2.previous_cursor})
+        self.assertEqual(
+            response.context['mybooks'].object_list, self.expected[:4])
+        self.assertFalse(response.context['mybooks'].has_previous())
+
+    def test_invalid_cursor(self):
+        for cursor in ['not a cursor', encode_cursor([None, None, None]),
+                       encode_cursor(['a', 'b', 'c']),
+                       encode_cursor(['a', 'b', [1]]),
+                       encode_cursor(['a', 'b'])]:
+            for direction in ['after', 'before']:
+                response = self.client.get(
+                    reverse('books:book_list'), {direction: cursor})
+                self.assertEqual(
+                    response.context['mybooks'].object_list,
+                    self.expected[:4])
+
+    def test_query_count(self):
+        self.client.get(reverse('books:book_list'))
+        # session, user, the page and the pending imports,
+        # the total count is cached
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('books:book_list'))
+        self.assertContains(response, 'You have 9 books on your list')
+
+    def test_count_invalidated(self):
+        self.client.get(reverse('books:book_list'))
+        BookList.objects.filter(user=self.user).first().delete()
+        response = self.client.get(reverse('books:book_list'))
+        self.assertContains(response, 'You have 8 books on your list')
+        Book.objects.get(pk=1).add_to_booklist(self.user)
+        response = self.client.get(reverse('books:book_list'))
+        self.assertContains(response, 'You have 9 books on your list')
+
+
 class BookListAddFormTest(TestCase):
 
     fixtures = ['fewusers.json', 'threebooks.json']
@@ -315,19 +703,21 @@ class BookListAddFormTest(TestCase):
 
     def test_book_field(self):
         form = BookListAddForm(user=self.user)
-        # book field length should = number of all books + empty value
-        self.assertEqual(len(form["book"]), 4)
+        # the books are loaded by the picker, not rendered as choices
+        with self.assertNumQueries(0):
+            html = str(form["book"])
+        self.assertIn(reverse('books:book_picker'), html)
+        self.assertNotIn('Catcher', html)
 
     def test_existing_books_exluded(self):
         '''
-        Books already on the user's list shouldn't be included
-        in the book field
+        Books already on the user's list shouldn't be valid choices
         '''
         BookList.objects.create(book=self.book, user=self.user)
-        form = BookListAddForm(user=self.user)
-        # book field length should =
-        # number of all books + empty value - 1 book already in the list
-        self.assertEqual(len(form["book"]), 3)
+        form = BookListAddForm({"book": self.book.pk}, user=self.user)
+        with self.assertNumQueries(1):
+            self.assertFalse(form.is_valid())
+        self.assertIn('book', form.errors)
         self.assertNotIn(self.book, form["book"].field.queryset)
 
 
@@ -364,6 +754,51 @@ class BookListAddViewTests(TestCase):
         self.assertRedirects(response, reverse('books:book_list'))
 
 
+class BookPickerViewTests(TestCase):
+
+    fixtures = ['fewusers.json', 'ninebooks.json']
+
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        self.client.force_login(self.user)
+        search.reset_index()
+
+    @override_settings(BOOKS_PICKER_PAGE_SIZE=4)
+    def test_pages(self):
+        BookList.objects.filter(user=self.user).delete()
+        BookList.objects.create(user=self.user, book_id=1)
+        with self.assertNumQueries(3):
+            # session, user and books
+            data = self.client.get(reverse('books:book_picker')).json()
+        pks = [book['pk'] for book in data['books']]
+        while data['next']:
+            data = self.client.get(
+                reverse('books:book_picker'), {'after': data['next']}).json()
+            pks += [book['pk'] for book in data['books']]
+        self.assertEqual(
+            sorted(pks),
+            list(Book.objects.exclude(pk=1).order_by('pk').values_list(
+                'pk', flat=True)))
+        self.assertEqual(len(pks), len(set(pks)))
+
+    @override_settings(BOOKS_PICKER_PAGE_SIZE=4)
+    def test_invalid_cursor(self):
+        first = self.client.get(reverse('books:book_picker')).json()
+        for cursor in ['not a cursor', encode_cursor([None, None, None]),
+                       encode_cursor(['a', 'b', 'c'])]:
+            data = self.client.get(
+                reverse('books:book_picker'), {'after': cursor}).json()
+            self.assertEqual(data, first)
+
+    def test_search(self):
+        book = Book.objects.exclude(booklist__user=self.user).first()
+        data = self.client.get(
+            reverse('books:book_picker'), {'q': book.title}).json()
+        self.assertEqual(data['books'][0], {
+            'pk': book.pk, 'label': f'{book} ({book.first_published})'})
+        self.assertIsNone(data['next'])
+
+
 class BookListEditViewTest(TestCase):
 
     fixtures = ['fewusers.json', 'booklist_without_ratings']
@@ -429,6 +864,79 @@ class BookListDeleteViewTest(TestCase):
             BookList.objects.get(pk=1)
 
 
+@override_settings(BOOKS_EXPORT_CHUNK_SIZE=2)
+class BookListExportViewTests(TestCase):
+
+    fixtures = ['fewusers.json', 'threebooks.json']
+
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        for book in Book.objects.all():
+            BookList.objects.create(user=self.user, book=book)
+        BookList.objects.filter(book_id=2).update(
+            override_title='Franny', override_author='Salinger',
+            override_year=1955, override_cover='https://example.com/f.jpg')
+        BookList.objects.rate(
+            self.user, {BookList.objects.get(book_id=2).pk: 5})
+        self.client.force_login(self.user)
+
+    def get_content(self, format):
+        response = self.client.get(
+            reverse('books:book_list_export', args=[format]))
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_url_logged_out(self):
+        self.client.logout()
+        response = self.client.get('/my/books/export.csv')
+        self.assertRedirects(
+            response,
+            f"{reverse('login')}?next=/my/books/export.csv")
+
+    def test_unknown_format(self):
+        response = self.client.get('/my/books/export.xml')
+        self.assertEqual(response.status_code, 404)
+
+    def test_csv(self):
+        lines = self.get_content('csv').splitlines()
+        self.assertEqual(lines[0], 'title,author,year,cover,rating,added')
+        self.assertEqual(
+            [line.split(',')[:5] for line in lines[1:]], [
+                ['Franny', 'Salinger', '1955', 'https://example.com/f.jpg',
+                 '5'],
+                ['Nine stories', 'J. D. Salinger', '1953',
+                 'https://covers.openlibrary.org/w/id/392623-M.jpg', ''],
+                ['The Catcher in the Rye', 'J. D. Salinger', '1951',
+                 'https://covers.openlibrary.org/w/id/8423522-M.jpg', ''],
+            ])
+
+    def test_json(self):
+        rows = json.loads(self.get_content('json'))
+        self.assertEqual(len(rows), 3)
+        booklist = BookList.objects.get(book_id=1)
+        self.assertEqual(rows[2], {
+            'title': booklist.get_title(),
+            'author': str(booklist.get_author()),
+            'year': booklist.get_year(),
+            'cover': booklist.get_cover(),
+            'rating': None,
+            'added': DjangoJSONEncoder().default(booklist.added),
+        })
+
+    def test_empty_list(self):
+        BookList.objects.all().delete()
+        self.assertEqual(json.loads(self.get_content('json')), [])
+        self.assertEqual(
+            self.get_content('csv'),
+            'title,author,year,cover,rating,added\r\n')
+
+    def test_one_query(self):
+        response = self.client.get(
+            reverse('books:book_list_export', args=['csv']))
+        with self.assertNumQueries(1):
+            b''.join(response.streaming_content)
+
+
 class BookSearchViewTests(TestCase):
 
     fixtures = ['fewusers.json', 'threebooks.json']
@@ -485,6 +993,327 @@ class BookSearchViewTests(TestCase):
         )
 
 
+class CatalogSearchTests(TestCase):
+
+    fixtures = ['threebooks.json']
+
+    def setUp(self):
+        search.reset_index()
+
+    def titles(self, q):
+        return [book.title for book in search.search_books(q)]
+
+    def test_search_by_title(self):
+        self.assertEqual(self.titles('nine stor'), ['Nine stories'])
+        self.assertEqual(self.titles('Franny'), ['Franny and Zooey'])
+        self.assertEqual(self.titles('stories nine'), ['Nine stories'])
+        self.assertEqual(self.titles('nine rye'), [])
+
+    def test_search_by_author_and_title(self):
+        self.assertEqual(len(self.titles('SALINGER')), 3)
+        self.assertEqual(
+            self.titles('salinger catcher'), ['The Catcher in the Rye'])
+        self.assertEqual(self.titles(' ,. '), [])
+
+    def test_title_matches_first(self):
+        author = Author.objects.create(first_name='Franny', last_name='Doe')
+        Book.objects.create(author=author, title='Zooey', first_published=1)
+        self.assertEqual(
+            self.titles('franny'), ['Franny and Zooey', 'Zooey'])
+
+    def test_index_updated(self):
+        self.assertEqual(self.titles('carpenters'), [])
+        book = Book.objects.create(
+            author_id=1, title='Raise High the Roof Beam, Carpenters',
+            first_published=1963)
+        self.assertEqual(self.titles('roof carpenters'), [book.title])
+
+        author = Author.objects.get(pk=1)
+        author.last_name = 'Salingér'
+        author.save()
+        self.assertEqual(self.titles('salinger carpenters'), [book.title])
+
+        book.delete()
+        self.assertEqual(self.titles('carpenters'), [])
+
+    def test_limit(self):
+        self.assertEqual(len(search.search_books('salinger', limit=2)), 2)
+
+
+class TypeaheadTests(TestCase):
+
+    fixtures = ['fewusers.json', 'threebooks.json']
+
+    def setUp(self):
+        typeahead.reset_index()
+
+    def labels(self, prefix):
+        response = self.client.get(
+            reverse('books:book_typeahead'), {'q': prefix})
+        return [s['label'] for s in response.json()['suggestions']]
+
+    def test_prefix_index(self):
+        index = typeahead.PrefixIndex(max_entries=10)
+        index.add_author(1, 'J. D.', 'Salinger')
+        index.add_book(1, 'The Catcher in the Rye')
+        index.add_book(2, 'Franny and Zooey')
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.complete('the c', 5), [
+            {'kind': 'book', 'pk': 1, 'label': 'The Catcher in the Rye'}])
+        # matches both keys of the author, suggested once
+        self.assertEqual(index.complete('', 5), [])
+        self.assertEqual(
+            [s['label'] for s in index.complete('j', 5)], ['J. D. Salinger'])
+        self.assertEqual(
+            [s['label'] for s in index.complete('S', 5)], ['J. D. Salinger'])
+        index.add_book(1, 'The Catcher')
+        index.remove('book', 2)
+        self.assertEqual(
+            [s['label'] for s in index.complete('f', 5)], [])
+        self.assertEqual(
+            [s['label'] for s in index.complete('the', 5)], ['The Catcher'])
+        self.assertGreater(index.memory_usage(), 0)
+
+    def test_sorted_once(self):
+        index = typeahead.PrefixIndex(max_entries=10)
+        index.add_book(1, 'Nine stories', sort=False)
+        index.add_author(1, 'J. D.', 'Salinger', sort=False)
+        index.add_book(2, 'Franny and Zooey', sort=False)
+        index.sort()
+        self.assertEqual(index.entries, sorted(index.entries))
+        self.assertEqual(
+            [s['label'] for s in index.complete('n', 5)], ['Nine stories'])
+
+    def test_max_entries(self):
+        index = typeahead.PrefixIndex(max_entries=3)
+        self.assertTrue(index.add_author(1, 'J. D.', 'Salinger'))
+        self.assertTrue(index.add_book(1, 'Nine stories'))
+        self.assertFalse(index.add_book(2, 'Franny and Zooey'))
+        self.assertEqual(len(index), 3)
+
+    def test_endpoint(self):
+        self.client.force_login(User.objects.get(pk=2))
+        self.assertEqual(self.labels('sal'), ['J. D. Salinger'])
+        self.assertEqual(
+            self.labels('the catcher'), ['The Catcher in the Rye'])
+        self.assertEqual(len(self.labels('F')), 1)
+        self.assertEqual(self.labels('x'), [])
+
+    def test_index_updated(self):
+        self.client.force_login(User.objects.get(pk=2))
+        self.assertEqual(self.labels('ray'), [])
+        author = Author.objects.create(first_name='Ray', last_name='Bradbury')
+        book = Book.objects.create(
+            author=author, title='Fahrenheit 451', first_published=1953)
+        self.assertEqual(self.labels('ray'), ['Ray Bradbury'])
+        self.assertEqual(self.labels('fahr'), ['Fahrenheit 451'])
+
+        author.first_name = 'Raymond'
+        author.save()
+        self.assertEqual(self.labels('ray'), ['Raymond Bradbury'])
+
+        book.delete()
+        author.delete()
+        self.assertEqual(self.labels('fahr'), [])
+        self.assertEqual(self.labels('ray'), [])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('typeahead_index', stdout=out)
+        self.assertIn('5 entries', out.getvalue())
+
+
+class SimilarBooksTests(TestCase):
+
+    def setUp(self):
+        author = Author.objects.create(first_name='Jane', last_name='Austen')
+        self.books = [
+            Book.objects.create(
+                author=author, title=f'Book {i}', first_published=1800 + i)
+            for i in range(5)
+        ]
+        self.users = [
+            User.objects.create_user(f'reader{i}') for i in range(4)]
+        # books 0, 1 and 2 share their readers, 3 and 4 too
+        lists = [[0, 1, 2], [0, 1], [1, 2], [3, 4]]
+        for user, books in zip(self.users, lists):
+            for i in books:
+                BookList.objects.create(user=user, book=self.books[i])
+
+    def similar(self, book, limit=None):
+        return [
+            self.books.index(similar) for similar in
+            recommendations.get_similar_books([book.pk], limit)[book.pk]]
+
+    def test_co_listings(self):
+        # compare with the dense matrix product
+        rng = np.random.default_rng(0)
+        dense = rng.random((30, 40)) < 0.2
+        book_ids, user_ids = np.nonzero(dense)
+        matrix = recommendations.ListingMatrix(book_ids * 10, user_ids + 1)
+        rows = matrix.rows_of(np.unique(book_ids) * 10)
+        left, right, counts = matrix._co_listings_numpy(rows)
+        expected = dense.astype(int) @ dense.T.astype(int)
+        books = matrix.book_ids // 10
+        self.assertEqual(
+            sorted(zip(books[left], books[right], counts)),
+            [(i, j, expected[i, j]) for i in books for j in books
+             if expected[i, j]])
+
+    def test_blocks(self):
+        matrix = recommendations.ListingMatrix.load()
+        rows = np.arange(matrix.n_books)
+        blocks = matrix.blocks(rows, max_pairs=4)
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(np.concatenate(blocks).tolist(), rows.tolist())
+        whole = matrix.neighbours(rows, 20)
+        split = [matrix.neighbours(block, 20) for block in blocks]
+        for array, arrays in zip(whole, zip(*split)):
+            self.assertEqual(array.tolist(), np.concatenate(arrays).tolist())
+
+    def test_build(self):
+        self.assertEqual(recommendations.build_similarities(), 5)
+        self.assertEqual(self.similar(self.books[0]), [1, 2])
+        # ties are ordered by book id
+        self.assertEqual(self.similar(self.books[1]), [0, 2])
+        self.assertEqual(self.similar(self.books[1], limit=1), [0])
+        self.assertEqual(self.similar(self.books[3]), [4])
+        scores = dict(BookSimilarity.objects.filter(
+            book=self.books[0]).values_list('similar_book', 'score'))
+        self.assertAlmostEqual(scores[self.books[1].pk], 2 / 6 ** 0.5)
+        self.assertAlmostEqual(scores[self.books[2].pk], 0.5)
+        self.assertFalse(
+            BookStats.objects.filter(similarities_stale=True).exists())
+
+    def test_top_k(self):
+        recommendations.build_similarities(k=1)
+        self.assertEqual(self.similar(self.books[0]), [1])
+        self.assertEqual(BookSimilarity.objects.count(), 5)
+
+    def test_incremental(self):
+        recommendations.build_similarities()
+        self.assertEqual(recommendations.build_similarities(), 0)
+
+        # only the books sharing a reader with the new listing change
+        user = User.objects.create_user('reader4')
+        BookList.objects.create(user=user, book=self.books[4])
+        BookList.objects.create(user=user, book=self.books[2])
+        self.assertEqual(
+            set(BookStats.objects.filter(
+                similarities_stale=True).values_list('book', flat=True)),
+            {self.books[2].pk, self.books[4].pk})
+        self.assertEqual(recommendations.build_similarities(), 5)
+        self.assertEqual(self.similar(self.books[4]), [3, 2])
+
+        BookList.objects.filter(user=user).delete()
+        self.assertEqual(recommendations.build_similarities(), 5)
+        self.assertEqual(self.similar(self.books[4]), [3])
+
+        BookList.objects.filter(book=self.books[3]).delete()
+        recommendations.build_similarities()
+        self.assertEqual(self.similar(self.books[3]), [])
+        self.assertEqual(self.similar(self.books[4]), [])
+
+    def test_failed_build_stays_stale(self):
+        with mock.patch.object(
+                recommendations.ListingMatrix, 'save', side_effect=OSError):
+            with self.assertRaises(OSError):
+                recommendations.build_similarities()
+        self.assertEqual(
+            BookStats.objects.filter(similarities_stale=True).count(), 5)
+
+    def test_endpoint(self):
+        recommendations.build_similarities()
+        url = reverse('books:book_similar', args=[self.books[0].pk])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(
+            [book['label'] for book in response.json()['books']],
+            ['Jane Austen: Book 1', 'Jane Austen: Book 2'])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('build_similarities', '--full', stdout=out)
+        self.assertIn('Similar books of 5 books', out.getvalue())
+
+
+class RecommendationTests(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        author = Author.objects.create(first_name='Jane', last_name='Austen')
+        self.books = [
+            Book.objects.create(
+                author=author, title=f'Book {i}', first_published=1800 + i)
+            for i in range(5)
+        ]
+        self.users = [
+            User.objects.create_user(f'reader{i}') for i in range(4)]
+        lists = [[0, 1, 2], [0, 1], [1, 2], [3, 4]]
+        for user, books in zip(self.users, lists):
+            for i in books:
+                BookList.objects.create(user=user, book=self.books[i])
+        recommendations.build_similarities()
+        self.user = self.users[1]
+
+    def recommended(self, user):
+        return [self.books.index(Book.objects.get(pk=pk))
+                for pk in recommendations.get_recommendations(user)]
+
+    def test_scores(self):
+        users, books = recommendations.score_recommendations(
+            np.array([1, 1, 2]), np.array([10, 20, 10]),
+            np.array([5.0, 1.0, 3.0]),
+            [np.array([10, 10, 20, 20]), np.array([30, 40, 40, 10]),
+             np.array([0.5, 0.2, 0.9, 0.6])],
+            limit=2)
+        # 30 scores 5 * 0.5 for user 1, 40 scores 5 * 0.2 + 1 * 0.9
+        # and 10 is on the list already
+        self.assertEqual(users.tolist(), [1, 1, 2, 2])
+        self.assertEqual(books.tolist(), [30, 40, 30, 40])
+
+    def test_ratings_weigh(self):
+        user = User.objects.create_user('reader4')
+        liked = BookList.objects.create(user=user, book=self.books[0])
+        disliked = BookList.objects.create(user=user, book=self.books[3])
+        BookList.objects.rate(user, {liked.pk: 5, disliked.pk: 1})
+        self.assertEqual(self.recommended(user), [1, 2, 4])
+        BookList.objects.rate(user, {liked.pk: 1, disliked.pk: 5})
+        self.assertEqual(self.recommended(user), [4, 1, 2])
+
+    def test_cached_and_invalidated(self):
+        self.assertEqual(self.recommended(self.user), [2])
+        with self.assertNumQueries(0):
+            recommendations.get_recommendations(self.user)
+
+        booklist = BookList.objects.create(user=self.user, book=self.books[2])
+        self.assertEqual(self.recommended(self.user), [])
+        BookList.objects.rate(self.user, {booklist.pk: 4})
+        self.assertIsNone(get_cache().get(
+            f'books:recommendations:{self.user.pk}'))
+        booklist.delete()
+        self.assertEqual(self.recommended(self.user), [2])
+
+    def test_book_list(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('books:book_list'))
+        self.assertEqual(
+            response.context['recommended_books'], [self.books[2]])
+        self.assertContains(response, 'Readers of your books also listed')
+
+    def test_command(self):
+        User.objects.filter(pk__in=[self.users[0].pk, self.user.pk]).update(
+            last_login=timezone.now())
+        out = StringIO()
+        call_command(
+            'precompute_recommendations', '--processes', '1', stdout=out,
+            stderr=StringIO())
+        self.assertIn('Recommendations of 2 users', out.getvalue())
+        self.assertEqual(
+            get_cache().get(f'books:recommendations:{self.user.pk}'),
+            [self.books[2].pk])
+
+
 class BookCardTagTest(TestCase):
 
     fixtures = ['fewusers.json', 'booklist_without_ratings']
@@ -497,6 +1326,13 @@ class BookCardTagTest(TestCase):
         rendered = self.TEMPLATE_NO_LIST.render(Context({'book': book}))
         self.assertIn(book.title, rendered)
 
+    def test_rendering_with_annotations(self):
+        book = annotate_book_cards(Book.objects).get(pk=1)
+        with self.assertNumQueries(0):
+            rendered = self.TEMPLATE_NO_LIST.render(Context({'book': book}))
+        self.assertIn(book.title, rendered)
+        self.assertIn('This book is on 3 lists', rendered)
+
     def test_rendering_booklist_no_overrides(self):
         booklist = BookList.objects.get(pk=1)
         book = booklist.book
@@ -564,3 +1400,847 @@ class BookRateViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         booklist = BookList.objects.get(pk=1)
         self.assertEqual(booklist.rating, 5)
+
+    def test_only_rating_written(self):
+        BookList.objects.filter(pk=1).update(override_title='Mine')
+        booklist = BookList.objects.get(pk=1)
+        booklist.override_title = 'Stale'
+        self.client.force_login(self.user)
+        self.client.post(
+            reverse('books:book_rate'), {'booklist_id': 1, 'rating': 4})
+        booklist = BookList.objects.get(pk=1)
+        self.assertEqual(booklist.rating, 4)
+        self.assertEqual(booklist.override_title, 'Mine')
+        self.assertEqual(booklist.book.average_rating, 4)
+
+    def rate_batch(self, data):
+        return self.client.post(
+            reverse('books:book_rate_batch'), json.dumps(data),
+            content_type='application/json')
+
+    def test_batch(self):
+        self.client.force_login(self.user)
+        generation = get_generation()
+        # booklist 8 belongs to another user
+        response = self.rate_batch({'ratings': [
+            {'booklist_id': 1, 'rating': 5},
+            {'booklist_id': 8, 'rating': 1},
+            {'booklist_id': 2, 'rating': 3},
+            {'booklist_id': 1, 'rating': 4},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual(response.json()['ratings'], [
+            {'booklist_id': 1, 'rating': 4},
+            {'booklist_id': 2, 'rating': 3},
+        ])
+        self.assertEqual(BookList.objects.get(pk=1).rating, 4)
+        self.assertEqual(BookList.objects.get(pk=2).rating, 3)
+        self.assertIsNone(BookList.objects.get(pk=8).rating)
+        self.assertNotEqual(get_generation(), generation)
+
+        self.rate_batch({'ratings': [{'booklist_id': 1, 'rating': 2}]})
+        self.assertEqual(BookStats.objects.get(book_id=1).rating_sum, 2)
+        self.assertEqual(BookStats.objects.rebuild(dry_run=True), [])
+
+    def test_batch_invalid(self):
+        self.client.force_login(self.user)
+        for data in (
+            {},
+            {'ratings': {'booklist_id': 1}},
+            {'ratings': [{'booklist_id': 1}]},
+            {'ratings': [{'booklist_id': 1, 'rating': 6}]},
+        ):
+            response = self.rate_batch(data)
+            self.assertEqual(response.status_code, 400)
+        self.assertIsNone(BookList.objects.get(pk=1).rating)
+
+
+class StubOpenLibrary:
+    '''Local HTTP server standing in for the OpenLibrary API
+
+    routes maps paths to (status, data, delay) tuples, data may be a function
+    of the query parameters. Every request is recorded in requests as
+    (path, params).
+    '''
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                stub.requests.append((url.path, params))
+                status, data, delay = stub.routes.get(
+                    url.path, (404, {}, 0))
+                time.sleep(delay)
+                if callable(data):
+                    data = data(params)
+                body = json.dumps(data).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # the client has timed out already
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+SEARCH_RESULTS = {'docs': [
+    {
+        "cover_edition_key": "OL1M",
+        "cover_i": 1,
+        "author_name": ["Ray Bradbury"],
+        "title": "Fahrenheit 451",
+        "first_publish_year": 1953
+    },
+]}
+BOOK_DATA = {'OL1M': {
+    'title': 'Fahrenheit 451',
+    'authors': [{'name': 'Ray Bradbury'}],
+    'publish_date': 'October 1953',
+    'cover': {'medium': 'https://covers.openlibrary.org/b/id/1-M.jpg'},
+}}
+
+
+class OpenLibraryTestCase(TestCase):
+    '''Run the tests against a stub OpenLibrary server'''
+
+    fixtures = ['fewusers.json', 'threebooks.json']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = StubOpenLibrary()
+        cls.stub.start()
+        cls.settings_override = override_settings(
+            OPENLIBRARY_URL=cls.stub.url,
+            OPENLIBRARY_READ_TIMEOUT=0.2,
+            OPENLIBRARY_RETRIES=1,
+            OPENLIBRARY_BACKOFF=0,
+            OPENLIBRARY_FAILURE_THRESHOLD=2,
+        )
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        cls.stub.stop()
+
+    def setUp(self):
+        # a fresh client and circuit breaker for every test
+        reset_client(setting='OPENLIBRARY_URL')
+        self.stub.routes = {
+            '/search.json': (200, SEARCH_RESULTS, 0),
+            '/api/books': (200, BOOK_DATA, 0),
+        }
+        self.stub.requests = []
+        self.user = User.objects.get(pk=2)
+        self.client.force_login(self.user)
+
+
+class BookSearchOpenLibraryTests(OpenLibraryTestCase):
+
+    def test_search(self):
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertContains(response, 'Ray Bradbury: Fahrenheit 451 (1953)')
+        self.assertEqual(self.stub.requests, [
+            ('/search.json', {'q': 'fahrenheit'}),
+            ('/api/books',
+             {'bibkeys': 'OL1M', 'format': 'json', 'jscmd': 'data'}),
+        ])
+
+    def test_upstream_time_measured(self):
+        with mock.patch.object(
+                metrics, 'registry', metrics.Registry()) as registry:
+            self.client.get(reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertGreater(
+            registry.get('upstream_seconds', 'books:book_search').sum, 0)
+
+    def test_catalog_searched_first(self):
+        search.reset_index()
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'salinger'})
+        self.assertEqual(len(response.context['books']), 3)
+        self.assertContains(response, reverse('books:book_list_add'))
+        self.assertEqual(self.stub.requests, [])
+
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'salinger', 'remote': '1'})
+        self.assertContains(response, 'Ray Bradbury: Fahrenheit 451 (1953)')
+        self.assertEqual(
+            [path for path, params in self.stub.requests],
+            ['/search.json', '/api/books'])
+
+    def test_too_few_catalog_results(self):
+        search.reset_index()
+        BookList.objects.create(user=self.user, book_id=1)
+        # the books on the user's list don't count
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'salinger'})
+        self.assertNotIn('books', response.context)
+        self.assertEqual(
+            [path for path, params in self.stub.requests],
+            ['/search.json', '/api/books'])
+
+    def test_add_book(self):
+        response = self.client.post(
+            reverse('books:book_search'), {'book': 'OL1M'})
+        self.assertRedirects(response, reverse('books:book_list'))
+        # the book is imported in the background
+        self.assertEqual(self.stub.requests, [])
+        self.assertFalse(Book.objects.filter(title='Fahrenheit 451').exists())
+        process_next_job()
+        book = Book.objects.get(title='Fahrenheit 451')
+        self.assertEqual(book.first_published, 1953)
+        self.assertEqual(str(book.author), 'Ray Bradbury')
+        self.assertEqual(
+            book.cover, 'https://covers.openlibrary.org/b/id/1-M.jpg')
+        self.assertTrue(
+            BookList.objects.filter(user=self.user, book=book).exists())
+
+    def test_timeout(self):
+        self.stub.routes['/search.json'] = (200, SEARCH_RESULTS, 0.5)
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertEqual(response.status_code, 503)
+        self.assertContains(
+            response, "We couldn't get the book", status_code=503)
+
+    def test_server_error_retried(self):
+        self.stub.routes['/search.json'] = (500, {}, 0)
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertEqual(response.status_code, 503)
+        # the first request and one retry
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_incomplete_book_data(self):
+        self.stub.routes['/api/books'] = (200, {'OL1M': {'title': 'T'}}, 0)
+        self.client.post(reverse('books:book_search'), {'book': 'OL1M'})
+        job = process_next_job()
+        # retrying won't help
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertFalse(Book.objects.filter(title='T').exists())
+
+    def test_circuit_breaker_fails_fast(self):
+        self.stub.routes['/search.json'] = (500, {}, 0)
+        for _ in range(2):
+            self.client.get(reverse('books:book_search'), {'q': 'x'})
+        requests_made = len(self.stub.requests)
+        response = self.client.get(reverse('books:book_search'), {'q': 'x'})
+        self.assertContains(
+            response, 'OpenLibrary is not available', status_code=503)
+        self.assertEqual(len(self.stub.requests), requests_made)
+
+
+class OpenLibraryCacheTests(OpenLibraryTestCase):
+
+    def test_search_cached(self):
+        openlibrary.search('Fahrenheit 451')
+        docs = openlibrary.search('  fahrenheit   451 ')
+        self.assertEqual(docs, SEARCH_RESULTS['docs'])
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_search_expired(self):
+        openlibrary.search('fahrenheit')
+        OpenLibraryResponse.objects.update(
+            fetched=timezone.now() - timedelta(days=2))
+        openlibrary.search('fahrenheit')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_add_book_after_search(self):
+        '''The details of the edition fetched by the search are reused
+
+        The year is the edition's, not the first one of the work.
+        '''
+        self.stub.routes['/api/books'] = (
+            200, {'OL1M': {**BOOK_DATA['OL1M'], 'publish_date': '1967'}}, 0)
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertContains(response, 'Ray Bradbury: Fahrenheit 451 (1967)')
+        self.client.post(reverse('books:book_search'), {'book': 'OL1M'})
+        process_next_job()
+        self.assertEqual(
+            [path for path, params in self.stub.requests],
+            ['/search.json', '/api/books'])
+        book = Book.objects.get(title='Fahrenheit 451')
+        self.assertEqual(book.first_published, 1967)
+        self.assertEqual(
+            book.cover, 'https://covers.openlibrary.org/b/id/1-M.jpg')
+
+    def test_search_details_fall_back(self):
+        self.stub.routes['/api/books'] = (500, {}, 0)
+        response = self.client.get(
+            reverse('books:book_search'), {'q': 'fahrenheit'})
+        self.assertContains(response, 'Ray Bradbury: Fahrenheit 451 (1953)')
+        self.assertFalse(OpenLibraryResponse.objects.filter(
+            kind=OpenLibraryResponse.BOOK).exists())
+
+    def test_book_cached(self):
+        openlibrary.get_book('OL1M')
+        self.assertEqual(
+            openlibrary.get_book('OL1M'), BOOK_DATA['OL1M'])
+        self.assertEqual(len(self.stub.requests), 1)
+
+    @override_settings(OPENLIBRARY_CACHE_MAX_ENTRIES=2)
+    def test_least_recently_used_evicted(self):
+        openlibrary.search('a')
+        OpenLibraryResponse.objects.update(
+            last_used=timezone.now() - timedelta(hours=1))
+        openlibrary.search('b')
+        # using 'a' makes 'b' the least recently used
+        openlibrary.search('a')
+        openlibrary.search('c')
+        self.assertEqual(
+            set(OpenLibraryResponse.objects.filter(
+                kind=OpenLibraryResponse.SEARCH).values_list(
+                    'key', flat=True)),
+            {'a', 'c'}
+        )
+
+
+def edition_data(params):
+    '''Stub api/books response for any edition'''
+    olid = params['bibkeys']
+    return {olid: {
+        'title': f'Title of {olid}',
+        'authors': [{'name': 'Ray Bradbury'}],
+        'publish_date': 'May 3, 2001',
+        'cover': {'medium': f'https://covers.example/{olid}-M.jpg'},
+    }}
+
+
+class BookSearchAsyncTests(OpenLibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        docs = [
+            {
+                "cover_edition_key": f"OL{i}M",
+                "author_name": ["Ray Bradbury"],
+                "title": f"Book {i}",
+                "first_publish_year": 1950 + i
+            } for i in range(3)
+        ]
+        self.stub.routes = {
+            '/search.json': (200, {'docs': docs}, 0),
+            '/api/books': (200, edition_data, 0.15),
+        }
+
+    def search(self, q):
+        request = self.factory.get(reverse('books:book_search'), {'q': q})
+        request.user = self.user
+        return async_to_sync(book_search_async)(request)
+
+    def test_details_fetched_concurrently(self):
+        start = time.monotonic()
+        response = self.search('bradbury')
+        elapsed = time.monotonic() - start
+        # the year of the edition's publish date
+        self.assertContains(response, 'Ray Bradbury: Book 2 (2001)')
+        self.assertContains(response, 'https://covers.example/OL2M-M.jpg')
+        paths = [path for path, params in self.stub.requests]
+        self.assertEqual(paths.count('/api/books'), 3)
+        # three sequential fetches would take at least 0.45 seconds
+        self.assertLess(elapsed, 0.4)
+
+    def test_details_cached(self):
+        self.search('bradbury')
+        self.stub.requests = []
+        self.search('bradbury')
+        self.assertEqual(self.stub.requests, [])
+
+    def test_failed_details_fall_back_to_search_results(self):
+        self.stub.routes['/api/books'] = (404, {}, 0)
+        response = self.search('bradbury')
+        self.assertContains(response, 'Ray Bradbury: Book 1 (1951)')
+
+    def test_search_unavailable(self):
+        self.stub.routes['/search.json'] = (500, {}, 0)
+        response = self.search('bradbury')
+        self.assertEqual(response.status_code, 503)
+
+    def test_add_book(self):
+        request = self.factory.post(
+            reverse('books:book_search'), {'book': 'OL7M'})
+        request.user = self.user
+        response = async_to_sync(book_search_async)(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(ImportJob.objects.filter(
+            user=self.user, olid='OL7M', status=ImportJob.PENDING).exists())
+
+    def test_logged_out(self):
+        request = self.factory.get(reverse('books:book_search'))
+        request.user = AnonymousUser()
+        response = async_to_sync(book_search_async)(request)
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(BOOKS_IMPORT_MAX_ATTEMPTS=2, BOOKS_IMPORT_RETRY_DELAY=60)
+class ImportJobTests(OpenLibraryTestCase):
+
+    def run_command(self):
+        '''The output of process_import_jobs --once
+
+        Its close_old_connections() would close the connection of the test
+        on PostgreSQL, because of the test's transaction.
+        '''
+        out = StringIO()
+        with mock.patch(
+                'books.management.commands.process_import_jobs.'
+                'close_old_connections'):
+            call_command('process_import_jobs', once=True, stdout=out)
+        return out.getvalue()
+
+    def test_enqueued_once(self):
+        enqueue_import(self.user, 'OL1M')
+        enqueue_import(self.user, 'OL1M')
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_pending_imports_shown(self):
+        enqueue_import(self.user, 'OL1M')
+        response = self.client.get(reverse('books:book_list'))
+        self.assertContains(response, '1 book is being added')
+
+    def test_retry_with_backoff(self):
+        self.stub.routes['/api/books'] = (500, {}, 0)
+        job = enqueue_import(self.user, 'OL1M')
+        process_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.run_after, timezone.now())
+        # not due yet
+        self.assertIsNone(process_next_job())
+
+        ImportJob.objects.update(run_after=timezone.now())
+        process_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_retry_succeeds(self):
+        self.stub.routes['/api/books'] = (500, {}, 0)
+        job = enqueue_import(self.user, 'OL1M')
+        process_next_job()
+        self.stub.routes['/api/books'] = (200, BOOK_DATA, 0)
+        ImportJob.objects.update(run_after=timezone.now())
+        process_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(job.booklist.book.title, 'Fahrenheit 451')
+
+    def test_unexpected_error_retried(self):
+        job = enqueue_import(self.user, 'OL1M')
+        with mock.patch.object(
+                openlibrary, 'import_book',
+                side_effect=IntegrityError('duplicate')), \
+                self.assertLogs('books.jobs', 'ERROR'):
+            out = self.run_command()
+        self.assertIn('will retry', out)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, 'duplicate')
+        self.assertGreater(job.run_after, timezone.now())
+
+    def test_interrupted_job_failed(self):
+        # claimed for the last attempt by a worker that crashed
+        job = enqueue_import(self.user, 'OL1M')
+        ImportJob.objects.update(attempts=2)
+        process_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(self.stub.requests, [])
+
+    def test_already_rated(self):
+        author = Author.objects.create(first_name='Ray', last_name='Bradbury')
+        book = Book.objects.create(
+            author=author, title='Fahrenheit 451', first_published=1953)
+        BookList.objects.create(user=self.user, book=book, rating=4)
+        job = enqueue_import(self.user, 'OL1M')
+        process_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(job.booklist.book, book)
+        self.assertEqual(job.booklist.rating, 4)
+        self.assertEqual(BookList.objects.count(), 1)
+
+    def test_invalid_olid_not_enqueued(self):
+        self.assertIsNone(enqueue_import(self.user, 'OL' + '1' * 30 + 'M'))
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_command(self):
+        enqueue_import(self.user, 'OL1M')
+        self.assertIn('Import of OL1M for joe: done', self.run_command())
+        self.assertTrue(
+            BookList.objects.filter(book__title='Fahrenheit 451').exists())
+
+
+def dump_line(record_type, key, data):
+    return '\t'.join(
+        [record_type, key, '1', '2020-01-01T00:00:00', json.dumps(data)]
+    ) + '\n'
+
+
+class ImportOpenLibraryCommandTests(TestCase):
+
+    fixtures = ['threebooks.json']
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index = os.path.join(tmp.name, 'authors.sqlite3')
+        self.authors = os.path.join(tmp.name, 'authors.txt.gz')
+        with gzip.open(self.authors, 'wt') as f:
+            f.write(dump_line('/type/author', '/authors/OL1A', {
+                'key': '/authors/OL1A', 'name': 'J. D. Salinger'}))
+            f.write(dump_line('/type/author', '/authors/OL2A', {
+                'key': '/authors/OL2A', 'name': 'Ray Bradbury'}))
+        self.works = os.path.join(tmp.name, 'works.txt')
+        with open(self.works, 'w') as f:
+            f.write(dump_line('/type/work', '/works/OL1W', {
+                'title': 'Fahrenheit 451', 'first_publish_date': '1953',
+                'authors': [{'author': {'key': '/authors/OL2A'}}],
+                'covers': [12345],
+            }))
+            f.write(dump_line('/type/edition', '/books/OL1M', {
+                'title': 'Nine stories', 'publish_date': 'April 1953',
+                'authors': [{'key': '/authors/OL1A'}],
+            }))
+            f.write(dump_line('/type/work', '/works/OL2W', {
+                'title': 'Raise High the Roof Beam, Carpenters',
+                'first_publish_date': '1963',
+                'authors': [{'author': {'key': '/authors/OL1A'}}],
+            }))
+            # unknown author and missing date
+            f.write(dump_line('/type/work', '/works/OL3W', {
+                'title': 'Unknown', 'first_publish_date': '1900',
+                'authors': [{'author': {'key': '/authors/OL3A'}}],
+            }))
+            f.write(dump_line('/type/work', '/works/OL4W', {
+                'title': 'Undated',
+                'authors': [{'author': {'key': '/authors/OL1A'}}],
+            }))
+
+    def import_dump(self, **options):
+        out = StringIO()
+        options.setdefault('batch_size', 2)
+        call_command('import_openlibrary', self.works, author_index=self.index,
+                     stdout=out, **options)
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.import_dump(authors=self.authors)
+        self.assertIn('books: 5 rows, 2 skipped', out)
+        self.assertIn('rows/s', out)
+        # the existing author and book are reused
+        self.assertEqual(Author.objects.count(), 2)
+        self.assertEqual(Book.objects.count(), 5)
+        book = Book.objects.get(title='Fahrenheit 451')
+        self.assertEqual(book.author.first_name, 'Ray')
+        self.assertEqual(book.author.last_name, 'Bradbury')
+        self.assertEqual(book.first_published, 1953)
+        self.assertEqual(
+            book.cover, 'https://covers.openlibrary.org/b/id/12345-M.jpg')
+        self.assertEqual(book.number_of_listings, 0)
+
+        # the author index is reused, importing again changes nothing
+        self.import_dump()
+        self.assertEqual(Book.objects.count(), 5)
+
+    def test_stats_created(self):
+        self.import_dump(authors=self.authors)
+        self.assertFalse(Book.objects.filter(stats__isnull=True).exists())
+        book = Book.objects.get(title='Nine stories')
+        for username in ['joe', 'ann', 'bob']:
+            book.add_to_booklist(User.objects.create_user(username), 5)
+        self.assertEqual(BookStats.objects.get(book=book).listing_count, 3)
+        self.assertEqual(get_most_read_books()[0], book)
+        self.assertEqual(get_top_rated_books()[0], book)
+
+    def test_resume(self):
+        self.import_dump(authors=self.authors, batch_size=100)
+        Book.objects.filter(title='Fahrenheit 451').delete()
+        with open(self.works, 'rb') as f:
+            offset = len(f.readline())
+        self.import_dump(offset=offset)
+        self.assertFalse(Book.objects.filter(title='Fahrenheit 451').exists())
+
+    def test_empty_index(self):
+        with self.assertRaises(CommandError):
+            self.import_dump()
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(2, 10, clock=lambda: self.now)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_half_open_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        # only one trial request is let through
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow_request())
+        self.now = 20
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_interrupted_trial_ended(self):
+        client = openlibrary.OpenLibraryClient(
+            'http://openlibrary.invalid', 1, 1, breaker=self.breaker)
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        with mock.patch.object(
+                client.session, 'get', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            client.get('/search.json', {'q': 'x'})
+        self.assertTrue(self.breaker.is_open)
+        # the next call is the trial
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_cancelled_async_trial_ended(self):
+        client = openlibrary.AsyncOpenLibraryClient(
+            'http://openlibrary.invalid', 1, 1, breaker=self.breaker)
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        with mock.patch.object(
+                client.client, 'get', side_effect=asyncio.CancelledError), \
+                self.assertRaises(asyncio.CancelledError):
+            async_to_sync(client.get)('/search.json', {'q': 'x'})
+        self.assertTrue(self.breaker.allow_request())
+
+
+class MetricsTests(TestCase):
+
+    fixtures = ['fewusers.json', 'threebooks.json']
+
+    def setUp(self):
+        get_cache().clear()
+        patcher = mock.patch.object(metrics, 'registry', metrics.Registry())
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_histogram(self):
+        histogram = metrics.LogHistogram((1, 2, 4))
+        for value in [0.5, 1, 3, 3, 10]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 0, 2, 1])
+        self.assertEqual(list(histogram.cumulative_counts()), [
+            (1, 2), (2, 2), (4, 4), ('+Inf', 5)])
+        self.assertEqual(histogram.sum, 17.5)
+
+    def test_request_measured(self):
+        self.client.get(reverse('books:dashboard'))
+        queries = self.registry.get('db_queries', 'books:dashboard')
+        self.assertEqual(queries.count, 1)
+        self.assertGreater(queries.sum, 0)
+        for metric in ['request_seconds', 'db_seconds', 'template_seconds']:
+            self.assertGreater(
+                self.registry.get(metric, 'books:dashboard').sum, 0)
+        self.assertEqual(
+            self.registry.get('upstream_seconds', 'books:dashboard').sum, 0)
+
+        self.client.get('/no/such/page/')
+        self.assertEqual(
+            self.registry.get('request_seconds', 'unresolved').count, 1)
+
+    def test_db_connect_measured(self):
+        def view(request):
+            metrics.record_db_connect(0.25)
+            metrics.record_db_connect(0.5)
+            return None
+
+        metrics.record_db_connect(1)
+        metrics.MetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(
+            self.registry.get('db_connect_seconds', 'unresolved').sum, 0.75)
+
+    def test_large_sum_rendered(self):
+        self.registry.observe('books:dashboard', {'db_queries': 1234567})
+        self.registry.observe('books:dashboard', {'db_queries': 1})
+        self.registry.observe('books:dashboard', {'db_seconds': 1234567.125})
+        output = self.registry.render()
+        self.assertIn(
+            'bookr_db_queries_sum{view="books:dashboard"} 1234568\n', output)
+        self.assertIn(
+            'bookr_db_seconds_sum{view="books:dashboard"} 1234567.125\n',
+            output)
+
+    @override_settings(METRICS_QUERY_BUDGET=1)
+    def test_query_budget(self):
+        with self.assertLogs('bookr.metrics', 'WARNING') as logs:
+            self.client.get(reverse('books:dashboard'))
+        self.assertIn('books:dashboard made', logs.output[0])
+
+    def test_endpoint(self):
+        self.client.get(reverse('books:dashboard'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 302)
+
+        self.client.force_login(User.objects.get(pk=1))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '# TYPE bookr_db_queries histogram')
+        self.assertContains(
+            response,
+            'bookr_request_seconds_count{view="books:dashboard"} 1')
+        self.assertContains(
+            response, 'bookr_db_queries_bucket{view="metrics",le="+Inf"} 1')
+
+
+@skipUnless('replica' in settings.DATABASES, 'no replica database')
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaTests(TransactionTestCase):
+    '''The writes of the tests don't reach the replica, like a lagging one
+
+    The tests can't run in a transaction, which would read from the default
+    database.
+    '''
+
+    databases = {'default', 'replica'}
+    fixtures = ['threebooks.json']
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create_user('joe')
+        # the signals of the fixtures only created the stats on the default
+        BookStats.objects.using('replica').bulk_create(BookStats.objects.all())
+        Book.objects.using('replica').filter(pk=1).update(title='Lagging')
+
+    def test_read_only_view(self):
+        response = self.client.get(reverse('books:dashboard'))
+        self.assertContains(response, 'Lagging')
+        self.assertNotContains(response, 'The Catcher in the Rye')
+
+    def test_sticky_after_write(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('books:book_list'))
+        self.assertNotContains(response, 'Franny and Zooey')
+
+        self.client.post(reverse('books:book_list_add'), {'book': 2})
+        response = self.client.get(reverse('books:book_list'))
+        self.assertContains(response, 'Franny and Zooey')
+
+        session = self.client.session
+        session[replicas.SESSION_KEY] = time.time() - 1
+        session.save()
+        response = self.client.get(reverse('books:book_list'))
+        self.assertNotContains(response, 'Franny and Zooey')
+
+    def test_rankings(self):
+        self.assertIn('Lagging', [book.title for book in get_recent_books()])
+        # in a transaction, e.g. after a write
+        with transaction.atomic():
+            self.assertIn(
+                'The Catcher in the Rye',
+                [book.title for book in get_recent_books()])
+
+    def test_writes_go_to_default(self):
+        book = Book.objects.using('replica').get(pk=1)
+        book.title = 'Saved'
+        book.save()
+        self.assertEqual(Book.objects.get(pk=1).title, 'Saved')
+        self.assertEqual(
+            Book.objects.using('replica').get(pk=1).title, 'Lagging')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'not PostgreSQL')
+class ConnectionPoolTests(SimpleTestCase):
+    '''The pool of bookr.postgresql with health checks, as in production
+
+    Each test takes its connections from a pool of its own, like a request,
+    and gives them back with close_if_unusable_or_obsolete().
+    '''
+
+    databases = {'default'}
+
+    def setUp(self):
+        # psycopg2 isn't installed with SQLite
+        from bookr.postgresql.base import DatabaseWrapper, _pools
+
+        self.wrapper = DatabaseWrapper({
+            **connection.settings_dict,
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': True,
+            'POOL': {'MIN_SIZE': 1, 'MAX_SIZE': 2},
+        }, alias='pooled')
+        # without the pool, to break its connections
+        self.admin = DatabaseWrapper(connection.settings_dict, alias='admin')
+
+        def close():
+            self.wrapper.close()
+            self.admin.close()
+            connection_pool = _pools.pop((os.getpid(), 'pooled'), None)
+            if connection_pool is not None:
+                connection_pool.closeall()
+        self.addCleanup(close)
+
+    def request(self):
+        '''The id of the backend process of the connection taken'''
+        self.wrapper.close_if_unusable_or_obsolete()
+        try:
+            with self.wrapper.cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()')
+                self.assertTrue(self.wrapper.get_autocommit())
+                return cursor.fetchone()[0]
+        finally:
+            self.wrapper.close_if_unusable_or_obsolete()
+
+    def test_connection_reused(self):
+        backend = self.request()
+        self.assertEqual(self.request(), backend)
+        self.assertEqual(self.request(), backend)
+
+    def test_broken_connection_replaced(self):
+        backend = self.request()
+        with self.admin.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [backend])
+        self.assertNotEqual(self.request(), backend)
+        self.assertNotEqual(self.request(), None)
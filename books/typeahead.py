@@ -0,0 +1,217 @@
+'''Suggestions of book titles and authors while the user is typing
+
+The titles and the names of the authors are kept in memory in one sorted
+list, so the completions of a prefix are found by bisecting it. The index is
+built from the most listed books first, up to BOOKS_TYPEAHEAD_MAX_ENTRIES
+entries, which bounds its memory use (see PrefixIndex.memory_usage()).
+It's built when the server starts (see bookr/wsgi.py and bookr/asgi.py) or
+on the first suggestion, then the signals of the books and authors update it
+in the process which saved them.
+
+Settings:
+    BOOKS_TYPEAHEAD_RESULTS: maximum number of suggestions
+    BOOKS_TYPEAHEAD_MAX_ENTRIES: maximum number of entries in the index
+'''
+
+from bisect import bisect_left, insort
+import logging
+import sys
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import F
+
+from .models import Book
+from .search import tokenize
+
+logger = logging.getLogger(__name__)
+
+BOOK = 'book'
+AUTHOR = 'author'
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+class PrefixIndex:
+    '''Sorted entries of (key, kind, pk, label) searched by key prefix
+
+    The books are indexed by their title, the authors by their full name and
+    their last name.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = []
+        # pk -> entries of each kind, to remove them
+        self.keys = {BOOK: {}, AUTHOR: {}}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, kind, pk, label, keys, sort=True):
+        '''Add or replace the entries of a book or author
+
+        Without sort, the entries are only appended, and the index can't be
+        searched until sort() is called: inserting each entry in order would
+        make building a large index quadratic.
+        '''
+        entries = sorted({(normalize(key), kind, pk, label) for key in keys})
+        with self.lock:
+            self._remove(kind, pk)
+            if len(self.entries) + len(entries) > self.max_entries:
+                return False
+            if sort:
+                for entry in entries:
+                    insort(self.entries, entry)
+            else:
+                self.entries.extend(entries)
+            self.keys[kind][pk] = entries
+            return True
+
+    def add_book(self, pk, title, sort=True):
+        return self.add(BOOK, pk, title, [title], sort)
+
+    def add_author(self, pk, first_name, last_name, sort=True):
+        return self.add(
+            AUTHOR, pk, f'{first_name} {last_name}',
+            [f'{first_name} {last_name}', last_name], sort)
+
+    def sort(self):
+        with self.lock:
+            self.entries.sort()
+
+    def remove(self, kind, pk):
+        with self.lock:
+            self._remove(kind, pk)
+
+    def _remove(self, kind, pk):
+        for entry in self.keys[kind].pop(pk, ()):
+            i = bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+
+    def complete(self, prefix, limit):
+        '''Suggestions for the prefix in alphabetical order
+
+        Returns:
+            suggestions(list): dicts of the kind, pk and label of the matches
+        '''
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        suggestions = []
+        seen = set()
+        with self.lock:
+            i = bisect_left(self.entries, (prefix,))
+            # an author can match by both of their keys
+            while len(suggestions) < limit and i < len(self.entries):
+                key, kind, pk, label = self.entries[i]
+                i += 1
+                if not key.startswith(prefix):
+                    break
+                if (kind, pk) not in seen:
+                    seen.add((kind, pk))
+                    suggestions.append(
+                        {'kind': kind, 'pk': pk, 'label': label})
+        return suggestions
+
+    def memory_usage(self):
+        '''Approximate number of bytes used by the entries'''
+        with self.lock:
+            size = sys.getsizeof(self.entries)
+            for entry in self.entries:
+                size += sys.getsizeof(entry) + sum(
+                    sys.getsizeof(value) for value in entry)
+            # the entries themselves are shared with the lists of keys
+            for entries in self.keys.values():
+                size += sys.getsizeof(entries) + sum(
+                    sys.getsizeof(value) for value in entries.values())
+        return size
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def build_index():
+    '''Index the most listed books and their authors'''
+    index = PrefixIndex(settings.BOOKS_TYPEAHEAD_MAX_ENTRIES)
+    authors = set()
+    books = Book.objects.order_by(
+        F('stats__listing_count').desc(nulls_last=True), 'pk',
+    ).values_list(
+        'pk', 'title', 'author_id', 'author__first_name', 'author__last_name')
+    for pk, title, author_id, first_name, last_name in books.iterator():
+        if author_id not in authors:
+            if not index.add_author(
+                    author_id, first_name, last_name, sort=False):
+                break
+            authors.add(author_id)
+        if not index.add_book(pk, title, sort=False):
+            break
+    index.sort()
+    logger.info('Typeahead index built: %d entries, %d bytes',
+                len(index), index.memory_usage())
+    return index
+
+
+def get_index():
+    '''The prefix index of the catalog, built on the first call'''
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = build_index()
+        return _index
+
+
+def reset_index():
+    '''Drop the prefix index, it's rebuilt on the next call of get_index()'''
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def warm_up():
+    '''Build the index when the server starts, if the database is ready'''
+    try:
+        get_index()
+    except DatabaseError:
+        logger.exception("Couldn't build the typeahead index")
+    finally:
+        # no request will close the connection of the thread starting the
+        # server, give it back (e.g. to the pool of bookr.postgresql)
+        connection.close()
+
+
+def suggest(prefix, limit=None):
+    if limit is None:
+        limit = settings.BOOKS_TYPEAHEAD_RESULTS
+    return get_index().complete(prefix, limit)
+
+
+def index_book(book):
+    '''Update the book in the prefix index, if it's built already'''
+    if _index is not None:
+        if (_index.add_book(book.pk, book.title)
+                and book.author_id not in _index.keys[AUTHOR]):
+            author = book.author
+            _index.add_author(author.pk, author.first_name, author.last_name)
+
+
+def unindex_book(book_id):
+    if _index is not None:
+        _index.remove(BOOK, book_id)
+
+
+def index_author(author):
+    if _index is not None and author.pk in _index.keys[AUTHOR]:
+        _index.add_author(author.pk, author.first_name, author.last_name)
+
+
+def unindex_author(author_id):
+    if _index is not None:
+        _index.remove(AUTHOR, author_id)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
@@ -5,8 +6,16 @@ app_name = 'books'
 
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
+    path(
+        'books/<int:pk>/similar/', views.book_similar, name='book_similar'
+    ),
     path('my/books/', views.book_list, name='book_list'),
+    path(
+        'my/books/export.<str:format>', views.book_list_export,
+        name='book_list_export'
+    ),
     path('my/books/add/', views.book_list_add, name='book_list_add'),
+    path('my/books/add/books/', views.book_picker, name='book_picker'),
     path(
         'my/books/edit/<int:pk>/', views.book_list_edit,
         name='book_list_edit'
@@ -15,6 +24,19 @@ urlpatterns = [
         'my/books/delete/<int:pk>/', views.book_list_delete,
         name='book_list_delete'
     ),
-    path('my/books/search/', views.book_search, name='book_search'),
+    path(
+        'my/books/search/',
+        views.book_search_async if settings.BOOKS_ASYNC_SEARCH
+        else views.book_search,
+        name='book_search'
+    ),
+    path(
+        'my/books/typeahead/', views.book_typeahead,
+        name='book_typeahead'
+    ),
     path('my/books/rate/', views.book_rate, name='book_rate'),
+    path(
+        'my/books/rate/batch/', views.book_rate_batch,
+        name='book_rate_batch'
+    ),
 ]
@@ -1,48 +1,162 @@
-from django.db.models import Avg, Count
+from datetime import timedelta
+import json
+
+from asgiref.sync import sync_to_async
+from django.db.models import (
+    Case, ExpressionWrapper, F, FloatField, Max, Sum, Value, When
+)
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.contrib.auth.views import redirect_to_login
+from django.http import (
+    Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse,
+    StreamingHttpResponse
+)
 from django.forms import modelform_factory
 from django.shortcuts import render, redirect, get_object_or_404
-from django.views.decorators.http import require_POST
-import requests
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from django.views.decorators.http import condition, require_POST
+
+from bookr.replicas import read_from_replica, read_only
 
-from .forms import BookListAddForm, SearchResultsForm
-from .models import Author, Book, BookList
+from . import export, openlibrary, recommendations, search, typeahead
+from .cache import (
+    cached_ranking, cached_value, get_booklist_count, get_generation,
+    get_timeout
+)
+from .forms import BookListAddForm, get_unlisted_books
+from .jobs import enqueue_import
+from .models import Book, BookList, DailyListingCount, ImportJob
+from .openlibrary import OpenLibraryError, OpenLibraryUnavailable
+from .pagination import KeysetPaginator
 
 # Helper functions #
 
 
+def annotate_book_cards(books):
+    '''Prepare a Book queryset for rendering with the book_card tag
+
+    Fetches the authors in the same query and annotates the stats read by the
+    card, so rendering the cards doesn't need any further queries.
+    '''
+    return books.select_related('author').annotate(
+        num_lists=F('stats__listing_count'),
+        avg_rating=F('stats__average_rating')
+    )
+
+
+@read_from_replica
 def get_most_read_books():
     '''Get books added on the most lists
 
     If two or more books are on the same number of lists, the oldest book
     gets higher rank'''
 
-    return Book.objects.annotate(
-        num_lists=Count('booklist')).order_by('-num_lists', 'added')[:5]
+    # the inner join with the stats lets the database read them in the order
+    # of bookstats_listings_idx, the pk of the books in the order they were
+    # added
+    return annotate_book_cards(Book.objects).filter(
+        stats__isnull=False
+    ).order_by('-stats__listing_count', 'stats__book')[:5]
 
 
+@read_from_replica
 def get_recent_books():
     '''Get 5 most recently added books to the db'''
-    return Book.objects.order_by('-added')[:5]
+    return annotate_book_cards(Book.objects).order_by('-added')[:5]
 
 
+@read_from_replica
 def get_top_rated_books():
-    '''Get the top 5 books with highest average rating
+    '''Get the top 5 rated books by their score (see BookStats)
 
-    If two or more books has the same average rating, then the next criteria is
+    If two or more books has the same score, then the next criteria is
     number of listings, then time added (oldest higher rank)
     '''
 
-    return Book.objects.annotate(
-        num_lists=Count('booklist'),
-        avg_rating=Avg('booklist__rating')
-    ).order_by('-avg_rating', '-num_lists', 'added')[:5]
+    # the inner join with the stats lets the database read them in the order
+    # of bookstats_score_idx
+    return annotate_book_cards(Book.objects).filter(
+        stats__isnull=False
+    ).order_by(
+        '-stats__score', '-stats__listing_count', 'added'
+    )[:5]
+
+
+@read_from_replica
+def get_trending_books():
+    '''Get the top 5 books added to the most lists lately
+
+    The listings of the last BOOKS_TRENDING_DAYS days are summed from the
+    daily counts, each day weighted by BOOKS_TRENDING_DECAY more than the
+    day after it, so the books listed today count the most.
+    '''
+    today = timezone.localdate()
+    decay = settings.BOOKS_TRENDING_DECAY
+    days = [today - timedelta(days=age)
+            for age in range(settings.BOOKS_TRENDING_DAYS)]
+    weight = Case(
+        *(When(daily_listings__day=day, then=Value(decay ** age))
+          for age, day in enumerate(days)),
+        output_field=FloatField()
+    )
+    # the books are looked up from their recent counts: the weights left
+    # join the counts, which would make the planners read them book by book
+    recent = DailyListingCount.objects.filter(day__in=days)
+    return annotate_book_cards(Book.objects).filter(
+        pk__in=recent.values('book'), daily_listings__day__in=days
+    ).annotate(
+        trend=Sum(ExpressionWrapper(
+            F('daily_listings__count') * weight, output_field=FloatField()))
+    ).order_by('-trend', 'added')[:5]
+
+
+def get_recommended_books(user):
+    '''Get the books recommended to the user, see books.recommendations'''
+    book_ids = recommendations.get_recommendations(user)
+    if not book_ids:
+        return []
+    books = annotate_book_cards(Book.objects).in_bulk(book_ids)
+    return [books[pk] for pk in book_ids if pk in books]
+
+
+def get_last_modified():
+    '''Get the time the books or booklists were last added or updated'''
+    latest = (
+        Book.objects.aggregate(latest=Max('added'))['latest'],
+        BookList.objects.aggregate(latest=Max('updated'))['latest'],
+    )
+    latest = [time for time in latest if time is not None]
+    return max(latest) if latest else None
+
+
+def dashboard_last_modified(request):
+    '''Last-Modified of the dashboard for anonymous users'''
+    if request.user.is_authenticated:
+        return None
+    # wrapped in a tuple as None can't be cached
+    return cached_value(
+        'last_modified', lambda: (get_last_modified(),))[0]
+
+
+def dashboard_etag(request):
+    '''ETag of the dashboard for anonymous users
+
+    Deleting a booklist doesn't change the Last-Modified time, so the ETag
+    includes the cache generation, which changes on every write, and the day,
+    which changes the trending books.
+    '''
+    if request.user.is_authenticated:
+        return None
+    last_modified = dashboard_last_modified(request)
+    timestamp = last_modified.timestamp() if last_modified else 0
+    return f'{timestamp}-{get_generation()}-{timezone.localdate()}'
 
 
 def create_book_choices(results):
     '''
-    Helper function to create choices for the SearchResultsForm
+    Helper function to create the choices of the search results
 
     Params:
         results(list): list of books found on OpenLibrary
@@ -52,8 +166,7 @@ def create_book_choices(results):
 
     choices = tuple(
         (
-            b["cover_edition_key"] if "cover_edition_key" in b
-            else b["edition_key"][0],
+            openlibrary.get_doc_olid(b),
             (
                 f'{b["author_name"][0]}: {b["title"]} '
                 f'({b["first_publish_year"]})'
@@ -66,27 +179,116 @@ def create_book_choices(results):
     return choices
 
 
+def create_search_results(docs, books):
+    '''
+    Helper function to list the search results with the details of the books
+
+    Params:
+        docs(list): list of books found on OpenLibrary
+        books(dict): OpenLibrary ID -> data of the editions
+    Returns:
+        results(list): dicts with the olid, author, title, year and cover,
+            the year and cover of the edition are used when available
+    '''
+    results = []
+    for olid, label in create_book_choices(docs):
+        doc = next(d for d in docs if openlibrary.get_doc_olid(d) == olid)
+        book = books.get(olid, {})
+        cover = book.get('cover', {}).get('medium', '')
+        if not cover and 'cover_i' in doc:
+            cover = openlibrary.COVER_URL.format(doc['cover_i'])
+        try:
+            year = openlibrary.parse_year(book['publish_date'])
+        except (KeyError, TypeError, ValueError):
+            year = doc['first_publish_year']
+        results.append({
+            'olid': olid,
+            'author': doc['author_name'][0],
+            'title': doc['title'],
+            'year': year,
+            'cover': cover,
+        })
+    return results
+
+
 # Views #
 
+@read_only
+@condition(
+    etag_func=dashboard_etag, last_modified_func=dashboard_last_modified)
 def dashboard(request):
+    '''Show the rankings of the books
+
+    The page is the same for every anonymous user, so it's cached as a whole
+    for them; conditional requests are answered by the condition decorator
+    before getting here.
+    '''
+    if request.user.is_authenticated:
+        return render_dashboard(request)
+
+    response = None
+
+    def render_page():
+        nonlocal response
+        response = render_dashboard(request)
+        return response.content
+
+    content = cached_value('dashboard_page', render_page)
+    return response or HttpResponse(content)
+
+
+def render_dashboard(request):
+    # the rankings are evaluated lazily, only for the sections
+    # which are not in the fragment cache
     ctx = {
-        "most_read_books": get_most_read_books(),
-        "recent_books": get_recent_books(),
-        "top_books": get_top_rated_books()
+        "most_read_books": SimpleLazyObject(
+            lambda: cached_ranking('most_read', get_most_read_books)),
+        "recent_books": SimpleLazyObject(
+            lambda: cached_ranking('recent', get_recent_books)),
+        "top_books": SimpleLazyObject(
+            lambda: cached_ranking('top_rated', get_top_rated_books)),
+        "trending_books": SimpleLazyObject(
+            lambda: cached_ranking('trending', get_trending_books)),
+        "generation": get_generation(),
+        "cache_timeout": get_timeout(),
     }
     return render(request, 'books/index.html', ctx)
 
 
+@read_only
 @login_required
 def book_list(request):
+    paginator = KeysetPaginator(
+        BookList.objects.filter(
+            user=request.user).select_related('book__author'),
+        ordering=('book__author__last_name', 'book__title', 'pk'),
+        per_page=settings.BOOKS_BOOKLIST_PAGE_SIZE
+    )
     ctx = {
-        "mybooks": BookList.objects.filter(
-            user=request.user).order_by(
-                'book__author__last_name', 'book__title')
+        "mybooks": paginator.page(
+            after=request.GET.get('after'), before=request.GET.get('before')),
+        "total": get_booklist_count(request.user),
+        "recommended_books": get_recommended_books(request.user),
+        "pending_imports": ImportJob.objects.filter(
+            user=request.user, status=ImportJob.PENDING).count()
     }
     return render(request, 'books/book_list.html', ctx)
 
 
+@read_only
+@login_required
+def book_list_export(request, format):
+    '''Download the user's list, streamed, see books.export'''
+    if format not in export.FORMATS:
+        raise Http404
+    response = StreamingHttpResponse(
+        export.stream(request.user, format),
+        content_type=export.FORMATS[format])
+    response['Content-Disposition'] = (
+        f'attachment; filename="my-books.{format}"')
+    return response
+
+
 @login_required
 def book_list_add(request):
     form = BookListAddForm(request.POST or None, user=request.user)
@@ -96,6 +298,37 @@ def book_list_add(request):
     return render(request, 'books/book_list_add.html', {'form': form})
 
 
+@read_only
+@login_required
+def book_picker(request):
+    '''Books for the picker of book_list_add which aren't on the list yet
+
+    Without a query, the books are paginated by their author and title with
+    the cursor of the "after" parameter. With a query (q), only the best
+    matches of the search are returned.
+    '''
+    q = request.GET.get('q', '')
+    per_page = settings.BOOKS_PICKER_PAGE_SIZE
+    if q:
+        books = exclude_listed(request.user, search.search_books(q, per_page))
+        next_cursor = None
+    else:
+        paginator = KeysetPaginator(
+            get_unlisted_books(request.user).select_related('author'),
+            ordering=('author__last_name', 'title', 'pk'),
+            per_page=per_page
+        )
+        page = paginator.page(after=request.GET.get('after'))
+        books, next_cursor = page.object_list, page.next_cursor
+    return JsonResponse({
+        'books': [
+            {'pk': book.pk, 'label': f'{book} ({book.first_published})'}
+            for book in books
+        ],
+        'next': next_cursor,
+    })
+
+
 @login_required
 def book_list_edit(request, pk):
     bl_item = get_object_or_404(BookList, pk=pk, user=request.user)
@@ -132,53 +365,128 @@ def book_list_delete(request, pk):
 
 @login_required
 def book_search(request):
-    '''Search OpenLibrary then use results as input for a create book form'''
+    '''Search OpenLibrary and list the results, with the details of the top
+    editions (see openlibrary.get_search_details())
+
+    Our catalog is searched first, OpenLibrary only if there are too few
+    results there or the user asks for it (remote=1). The books found in the
+    catalog are added to the list by book_list_add.
+
+    If OpenLibrary is failing, the page is rendered with an error message
+    instead of the results. The chosen book is imported in the background,
+    see books.jobs.
+    '''
     if request. method == "GET":
         q = request.GET.get('q', '')
+        results = None
+        if q and not request.GET.get('remote'):
+            books = search_catalog(request.user, q)
+            if books:
+                return render(
+                    request, 'books/book_search.html',
+                    {'books': books, 'q': q})
         if q:
-            # TODO: handle exceptions
-            # TODO: test with mocks
-            response = requests.get(
-                "https://openlibrary.org/search.json",
-                params={'q': q}
-            )
-            results = response.json()['docs'][:10]
-            book_choices = create_book_choices(results)
-            form = SearchResultsForm(book_choices=book_choices)
-        else:
-            form = None
-        return render(request, 'books/book_search.html', {'form': form})
+            try:
+                docs = openlibrary.search(q)
+            except OpenLibraryError as e:
+                return search_unavailable(request, e)
+            books = openlibrary.get_search_details(
+                docs, settings.OPENLIBRARY_SEARCH_DETAILS)
+            results = create_search_results(docs, books)
+        return render(
+            request, 'books/book_search.html', {'results': results})
     elif request. method == "POST":
         olid = request.POST.get("book", '')
         if olid:
-            # TODO: handle exceptions
-            # TODO: test with mocks
-            response = requests.get(
-                "https://openlibrary.org/api/books",
-                params={'bibkeys': olid, 'format': 'json', 'jscmd': 'data'}
-            )
-            result = response.json()[olid]
-            # assume that the last word is the last name
-            first_name, last_name = result['authors'][0]['name'].rsplit(' ', 1)
-            # some pub dates are full dates, some just years
-            # if it's a full date, than extract the year from the full date
-            if ' ' in result['publish_date']:
-                pub_year = int(result['publish_date'].rsplit(' ', 1)[1])
-            else:
-                pub_year = int(result['publish_date'])
-            # check if the author in already the db
-            # if not, add it
-            author, a_created = Author.objects.get_or_create(
-                first_name=first_name, last_name=last_name)
-            # check if we book is already in the db
-            # if not, add it
-            book, b_created = Book.objects.get_or_create(
-                author=author, title=result['title'], first_published=pub_year)
-            if b_created and 'cover' in result:
-                book.cover = result['cover']['medium']
-                book.save()
-            book.add_to_booklist(request.user)
+            # the book is imported by the process_import_jobs command
+            enqueue_import(request.user, olid)
+        return redirect('books:book_list')
+
+
+async def book_search_async(request):
+    '''Asynchronous version of book_search for ASGI deployments
+
+    Besides the search, it gets the details of the top editions concurrently,
+    so the results can show their covers and publish years.
+    '''
+    user = await sync_to_async(get_authenticated_user)(request)
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+    if request.method == "GET":
+        q = request.GET.get('q', '')
+        results = None
+        if q and not request.GET.get('remote'):
+            books = await sync_to_async(search_catalog)(user, q)
+            if books:
+                return await sync_to_async(render)(
+                    request, 'books/book_search.html',
+                    {'books': books, 'q': q})
+        if q:
+            try:
+                docs, books = await openlibrary.search_async(
+                    q, details=settings.OPENLIBRARY_SEARCH_DETAILS)
+            except OpenLibraryError as e:
+                return await sync_to_async(search_unavailable)(request, e)
+            results = create_search_results(docs, books)
+        return await sync_to_async(render)(
+            request, 'books/book_search.html', {'results': results})
+    elif request.method == "POST":
+        olid = request.POST.get("book", '')
+        if olid:
+            await sync_to_async(enqueue_import)(user, olid)
         return redirect('books:book_list')
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+@login_required
+def book_typeahead(request):
+    '''Suggestions of titles and authors while typing a search'''
+    return JsonResponse(
+        {'suggestions': typeahead.suggest(request.GET.get('q', ''))})
+
+
+@read_only
+def book_similar(request, pk):
+    '''Books listed by the readers of the book, the most similar first'''
+    books = recommendations.get_similar_books([pk])[pk]
+    return JsonResponse(
+        {'books': [{'pk': book.pk, 'label': str(book)} for book in books]})
+
+
+def search_catalog(user, q):
+    '''Search our catalog for books which aren't on the user's list yet
+
+    Returns:
+        books(list): or None if there are too few of them, so OpenLibrary
+        should be searched instead
+    '''
+    books = exclude_listed(user, search.search_books(q))
+    if len(books) < settings.BOOKS_SEARCH_MIN_RESULTS:
+        return None
+    return books
+
+
+def exclude_listed(user, books):
+    '''Leave out the books which are on the user's list from a list'''
+    if not books:
+        return books
+    listed = set(BookList.objects.filter(
+        user=user, book__in=books).values_list('book_id', flat=True))
+    return [book for book in books if book.pk not in listed]
+
+
+def get_authenticated_user(request):
+    return request.user if request.user.is_authenticated else None
+
+
+def search_unavailable(request, error):
+    '''Degraded search page for when OpenLibrary is failing'''
+    unavailable = isinstance(error, OpenLibraryUnavailable)
+    return render(
+        request, 'books/book_search.html',
+        {'form': None, 'error': error, 'unavailable': unavailable},
+        status=503
+    )
 
 
 @require_POST
@@ -187,12 +495,35 @@ def book_rate(request):
     booklist_id = int(request.POST.get('booklist_id', 0))
     new_rating = int(request.POST.get('rating', 0))
     if booklist_id and new_rating in range(1, 6):
-        bl_item = get_object_or_404(
-            BookList, pk=booklist_id, user=request.user)
-        bl_item.rating = new_rating
-        bl_item.save()
+        rated = BookList.objects.rate(request.user, {booklist_id: new_rating})
+        if not rated:
+            raise Http404('No BookList matches the given query.')
         return JsonResponse({
-            'booklist_id': bl_item.id, 'rating': bl_item.rating
+            'booklist_id': booklist_id, 'rating': rated[booklist_id]
         })
     else:
         return JsonResponse({}, status=404)
+
+
+@require_POST
+@login_required
+def book_rate_batch(request):
+    '''Rate several books of the user's list at once
+
+    The body is JSON: {"ratings": [{"booklist_id": 1, "rating": 5}, ...]},
+    the response has the ratings of the items found on the user's list.
+    '''
+    try:
+        ratings = {
+            int(item['booklist_id']): int(item['rating'])
+            for item in json.loads(request.body)['ratings']
+        }
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid ratings'}, status=400)
+    if (len(ratings) > settings.BOOKS_RATE_BATCH_SIZE
+            or not all(rating in range(1, 6) for rating in ratings.values())):
+        return JsonResponse({'error': 'Invalid ratings'}, status=400)
+    rated = BookList.objects.rate(request.user, ratings)
+    return JsonResponse({'ratings': [
+        {'booklist_id': pk, 'rating': rating} for pk, rating in rated.items()
+    ]})